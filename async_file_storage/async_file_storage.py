@@ -2,25 +2,134 @@ import argparse
 import yaml
 import os
 import asyncio
-from aiohttp import web, ClientSession, client_exceptions
+import email.utils
+import hashlib
+import mimetypes
+import tempfile
+from aiohttp import web, ClientResponse, ClientSession, ClientTimeout, TCPConnector, client_exceptions
 import collections
 
+import compress
+from blobs import BlobStore
+from cache import TTLCache
+from ring import HashRing
+
 Neighbour = collections.namedtuple('Neighbour', 'name, host, port, url')
+# Соединения к соседям: сколько держать открытыми к каждому, сколько секунд хранить
+# простаивающее (0 - новое соединение на каждый запрос) и таймауты в секундах.
+ClientConfig = collections.namedtuple(
+    'ClientConfig', 'connections_per_neighbour, keepalive_timeout, connect_timeout, read_timeout',
+    defaults=(8, 30.0, 1.0, 10.0))
+# Кэши поиска: время жизни в секундах отсутствующих имен, адресов соседей с файлом
+# и содержимого маленьких файлов (0 выключает кэш), число записей в первых двух,
+# общий объем кэша содержимого и предельный размер файла в нем в байтах.
+CacheConfig = collections.namedtuple(
+    'CacheConfig', 'negative_ttl, location_ttl, content_ttl, max_entries, content_size, max_file_size',
+    defaults=(5.0, 60.0, 10.0, 10000, 0, 2**16))
+# Размещение по консистентному хешу: сколько нод хранят каждый файл, точек на ноду
+# на кольце и искать ли у остальных нод, если у владельцев файла нет.
+PlacementConfig = collections.namedtuple('PlacementConfig', 'replicas, virtual_nodes, fallback',
+                                         defaults=(2, 100, True))
+# Сжатие: кодировки в порядке предпочтения (недоступные в окружении пропускаются),
+# уровень, минимальный размер файла в байтах, сколько запросов за hot_window секунд
+# делают файл горячим, принимать ли сжатые ответы от соседей и во сколько раз
+# сжатая копия должна быть меньше файла, чтобы ее стоило хранить.
+CompressionConfig = collections.namedtuple(
+    'CompressionConfig', 'encodings, level, min_size, hot_requests, hot_window, neighbours, max_ratio',
+    defaults=(('zstd', 'gzip', 'deflate'), 6, 1024, 2, 60.0, True, 0.9))
+
+
+def validators(mtime, size):
+    # ETag из размера и времени изменения в целых секундах: точнее время между нодами
+    # не передается (Last-Modified), и у копии файла на другой ноде тот же ETag
+    mtime = int(mtime)
+    return f'{mtime:x}-{size:x}', mtime
+
+
+def http_time(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def etag_match(etag, etags, weak):
+    return any(e.value == '*' or e.value == etag and (weak or not e.is_weak) for e in etags)
+
+
+def precondition(request, etag, last_modified):
+    # Статус ответа на условный запрос (412 или 304) или None, если файл нужно отдать
+    if_match, if_none_match = request.if_match, request.if_none_match
+    if if_match is not None and not etag_match(etag, if_match, weak=False):
+        return 412
+    if if_match is None and request.if_unmodified_since is not None and \
+            last_modified > request.if_unmodified_since.timestamp():
+        return 412
+    if if_none_match is not None and etag_match(etag, if_none_match, weak=True):
+        return 304
+    if if_none_match is None and request.if_modified_since is not None and \
+            last_modified <= request.if_modified_since.timestamp():
+        return 304
+    return None
+
+
+def range_applies(request, etag, last_modified):
+    # If-Range: Range выполняется, только если файл не изменился с указанной версии
+    if_range = request.headers.get('If-Range')
+    if if_range is None:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == f'"{etag}"'
+    date = http_time(if_range)
+    return date is not None and last_modified <= date
+
+
+class StoredFileResponse(web.FileResponse):
+    # FileResponse с валидаторами сервера вместо взятых у inode. Условия запроса к этому
+    # моменту проверены по ним, поэтому FileResponse получает запрос без условных
+    # заголовков, а свои ETag и Last-Modified ставит в on_response_prepare.
+    dropped_headers = ('If-Match', 'If-Unmodified-Since', 'If-None-Match', 'If-Modified-Since', 'If-Range')
+
+    def __init__(self, path, etag, last_modified, with_range=True, headers=None):
+        super().__init__(path, headers=headers)
+        self.validators = etag, last_modified
+        self.with_range = with_range
+
+    async def prepare(self, request):
+        headers = request.headers.copy()
+        for header in self.dropped_headers + (() if self.with_range else ('Range',)):
+            headers.popall(header, None)
+        return await super().prepare(request.clone(headers=headers))
+
+    @staticmethod
+    async def set_validators(request, response):
+        if isinstance(response, StoredFileResponse):
+            response.etag, response.last_modified = response.validators
 
 
 class StaticServerConfig:
-    def __init__(self, host, port, directory, save_found, neighbours):
+    def __init__(self, host, port, directory, save_found, neighbours, client=ClientConfig(), skip_check=False,
+                 cache=CacheConfig(), name=None, placement=None, dedup=False, compression=None):
         self.host = host
         self.port = port
         self.directory = directory
         self.save_found = save_found
         self.neighbours = neighbours
+        self.client = client
+        self.skip_check = skip_check
+        self.cache = cache
+        self.name = name
+        self.placement = placement
+        self.dedup = dedup
+        self.compression = compression
 
     @classmethod
     def load_from_yaml(cls, config_path):
         with open(config_path, 'rb') as config_file:
-            config = yaml.load(config_file)
+            return cls.from_dict(yaml.safe_load(config_file))
 
+    @classmethod
+    def from_dict(cls, config):
         def parse_neighbours():
             n_list = []
             for n_name, n_conf in config['neighbours'].items():
@@ -30,13 +139,141 @@ class StaticServerConfig:
                 n_list.append(Neighbour(n_name, host, port, url))
             return n_list
 
-        return cls(config['host'], config['port'], config['directory'], config['save_found'], parse_neighbours())
+        placement = None
+        if 'placement' in config:
+            # Кольцо строится по именам нод, поэтому нода должна знать, как ее называют соседи
+            if 'name' not in config:
+                raise ValueError('placement requires the node name')
+            placement = PlacementConfig(**(config['placement'] or {}))
+        compression = None
+        if 'compression' in config:
+            compression = CompressionConfig(**(config['compression'] or {}))
+
+        return cls(config['host'], config['port'], config['directory'], config['save_found'], parse_neighbours(),
+                   ClientConfig(**config.get('client', {})), config.get('skip_check', False),
+                   CacheConfig(**config.get('cache', {})), config.get('name'), placement, config.get('dedup', False),
+                   compression)
+
+
+class Flight:
+    # Одно скачивание файла у соседа на все одновременные запросы этого имени. Данные
+    # пишутся во временный файл в хранилище, а читатели идут по нему следом за записью.
+    # Файл живет, пока его кто-то читает, затем с save_found становится файлом
+    # хранилища, иначе удаляется. С хранилищем по содержимому полет считает хеш
+    # данных, а если у соседа оказалось содержимое, которое уже есть локально,
+    # вместо скачивания отдается имеющийся объект blob.
+    def __init__(self, loop, directory, file_name, hops, blobs=None):
+        self.loop = loop
+        self.hops = hops
+        self.directory = directory
+        self.file_name = file_name
+        self.file_path = os.path.join(directory, file_name)
+        self.blobs = blobs
+        self.digest = hashlib.sha256() if blobs is not None else None
+        self.blob = None
+        self.blob_mtime = None
+        self.found = loop.create_future()
+        self.content_type = None
+        self.content_length = None
+        self.headers = {}
+        self.file = None
+        self.size = 0
+        # Последняя записанная часть и ее смещение: читатели, не отставшие от
+        # записи, берут ее из памяти, а не с диска.
+        self.tail_offset = 0
+        self.tail = b''
+        self.done = False
+        self.failed = False
+        self.readers = 0
+        self.progress = asyncio.Event()
+
+    async def open(self):
+        self.file = await self.loop.run_in_executor(
+            None, lambda: tempfile.NamedTemporaryFile(dir=self.directory, prefix='.', suffix='.part',
+                                                      buffering=0, delete=False))
+
+    async def write(self, chunk):
+        # Читатели получают часть сразу, пока она пишется на диск. Все, что раньше
+        # нее, к этому моменту уже записано.
+        self.tail_offset, self.tail = self.size, chunk
+        self.size += len(chunk)
+        self.notify()
+        await self.loop.run_in_executor(None, self.write_chunk, chunk)
+
+    def write_chunk(self, chunk):
+        self.file.write(chunk)
+        if self.digest is not None:
+            self.digest.update(chunk)
+
+    def notify(self):
+        self.progress.set()
+        self.progress = asyncio.Event()
+
+    def finish(self, failed=False):
+        self.done = True
+        self.failed = failed
+        self.notify()
+
+    async def stream(self, response, chunk_size):
+        file = await self.loop.run_in_executor(None, open, self.file.name, 'rb')
+        try:
+            offset = 0
+            while offset < self.size or not self.done:
+                if offset == self.size:
+                    await self.progress.wait()
+                    continue
+                if offset == self.tail_offset:
+                    chunk = self.tail
+                else:
+                    if file.tell() != offset:
+                        await self.loop.run_in_executor(None, file.seek, offset)
+                    chunk = await self.loop.run_in_executor(None, file.read, min(chunk_size, self.tail_offset - offset))
+                offset += len(chunk)
+                await response.write(chunk)
+        finally:
+            await self.loop.run_in_executor(None, file.close)
+        if self.failed:
+            raise ConnectionResetError(f'Download of {self.file_path!r} from a neighbour failed')
+
+    def close(self, keep):
+        self.file.close()
+        if not keep:
+            os.remove(self.file.name)
+            return
+        # Время изменения как у соседа, чтобы ETag и If-Modified-Since были одинаковыми на всех нодах.
+        # Объект хранилища по содержимому может быть общим с другими именами, поэтому
+        # время имени записывается в индекс, а не ставится файлу.
+        mtime = http_time(self.headers.get('Last-Modified'))
+        if self.blobs is not None:
+            self.blobs.add(self.file.name, self.digest.hexdigest(), self.file_name, mtime)
+            return
+        if mtime is not None:
+            os.utime(self.file.name, (mtime, mtime))
+        os.replace(self.file.name, self.file_path)
 
 
 class StaticServer:
 
     n_download_endpoint = 'neighbour_download'
     n_check_endpoint = 'neighbour_check'
+    stats_endpoint = 'stats'
+    hops_header = 'X-Storage-Hops'
+    # Хеш содержимого файла в ответах соседям, если хранилище дедуплицирует по содержимому
+    content_hash_header = 'X-Content-Hash'
+    # Заголовки частичных и условных запросов, которые передаются соседу как есть,
+    # и заголовки его ответа, которые передаются клиенту
+    conditional_headers = ('Range', 'If-Range', 'If-Match', 'If-None-Match', 'If-Modified-Since', 'If-Unmodified-Since')
+    validator_headers = ('ETag', 'Last-Modified', 'Accept-Ranges')
+    # Сжатые копии горячих файлов лежат в этой поддиректории хранилища
+    encoded_dir = '.encoded'
+    # Что стоит сжимать; файлы без расширения считаются текстом
+    compressible_types = ('text/', 'application/json', 'application/xml', 'application/javascript', 'image/svg+xml')
+    # Статусы ответа соседа, означающие, что файл у него есть
+    found_statuses = (200, 206, 304, 416)
+    # Сколько пересылок может пройти запрос в режиме размещения: пользователь -
+    # нода - владелец - нода, у которой файл есть на самом деле.
+    max_hops = 2
+    chunk_size = 2**18
 
     def __init__(self, config, loop=None):
         if loop is None:
@@ -48,50 +285,117 @@ class StaticServer:
         self.setup_routes()
         self.runner = None
         self.site = None
+        self.session = None
+        self.flights = {}
+        self.neighbour_requests = 0
+        self.neighbour_bytes = 0
+        self.ring = None
+        if config.placement:
+            self.ring = HashRing([config.name] + [n.name for n in config.neighbours], config.placement.virtual_nodes)
+            self.neighbours_by_name = {n.name: n for n in config.neighbours}
+        cache = config.cache
+        self.negative_cache = TTLCache(cache.negative_ttl, cache.max_entries)
+        self.location_cache = TTLCache(cache.location_ttl, cache.max_entries)
+        self.content_cache = TTLCache(cache.content_ttl, cache.content_size)
+        self.blobs = BlobStore(config.directory) if config.dedup else None
+        self.encodings = []
+        if config.compression:
+            self.encodings = compress.available(config.compression.encodings)
+            self.request_counts = TTLCache(config.compression.hot_window, cache.max_entries)
+            self.compressing = set()
+            self.incompressible = set()
+        self.app.on_startup.append(self.start_session)
+        if self.blobs is not None:
+            self.app.on_startup.append(self.scan_blobs)
+        self.app.on_cleanup.append(self.close_session)
+        self.app.on_response_prepare.append(StoredFileResponse.set_validators)
 
     def run(self):
-        web.run_app(self.app, host=self.config.host, port=self.config.port)
+        web.run_app(self.app, host=self.config.host, port=self.config.port, loop=self.loop)
 
     def setup_routes(self):
         self.app.add_routes([
             web.get('/{file_name}', self.main_download),
             web.get(f'/{self.n_download_endpoint}/{{file_name}}', self.neighbour_download),
-            web.get(f'/{self.n_check_endpoint}/{{file_name}}', self.neighbour_check)
+            web.get(f'/{self.n_check_endpoint}/{{file_name}}', self.neighbour_check),
+            web.get(f'/{self.stats_endpoint}/cache', self.cache_stats),
+            web.get(f'/{self.stats_endpoint}/neighbours', self.neighbour_stats),
+            web.get(f'/{self.stats_endpoint}/blobs', self.blob_stats)
         ])
 
-    async def prepare_file_response(self, file_bytes):
-        try:
-            file_text = await self.loop.run_in_executor(None, file_bytes.decode, 'utf8')
-            return web.Response(text=file_text)
-        except UnicodeDecodeError:
-            return web.Response(body=file_bytes)
+    async def start_session(self, app):
+        # Одна сессия на весь сервер: соединения к соседям переиспользуются между запросами
+        client = self.config.client
+        if client.keepalive_timeout:
+            connector = TCPConnector(limit=0, limit_per_host=client.connections_per_neighbour,
+                                     keepalive_timeout=client.keepalive_timeout)
+        else:
+            connector = TCPConnector(limit=0, limit_per_host=client.connections_per_neighbour, force_close=True)
+        timeout = ClientTimeout(total=None, sock_connect=client.connect_timeout, sock_read=client.read_timeout)
+        # Сжатые ответы соседей распаковываются в треде, а не в цикле событий
+        self.session = ClientSession(connector=connector, timeout=timeout, auto_decompress=False)
+
+    async def close_session(self, app):
+        await self.session.close()
+
+    async def scan_blobs(self, app):
+        # Файлы, положенные в хранилище до запуска, переносятся в объекты
+        await self.loop.run_in_executor(None, self.blobs.scan)
 
     async def main_download(self, request):
         file_name = request.match_info.get('file_name')
 
-        search_in_neighbour = False
-
-        file_bytes = await self.get_file_from_storage(file_name)
-        if not file_bytes:
-            file_bytes = await self.ask_neighbours(file_name)
-            search_in_neighbour = True
+        response = await self.local_file_response(request, file_name)
+        if response:
+            return response
 
-        if not file_bytes:
+        # Имя, которого недавно не нашлось ни у кого, не рассылается соседям повторно
+        if self.negative_cache and self.negative_cache.get(file_name):
             raise web.HTTPNotFound(text=f'There is no file with name {file_name!r}')
 
-        if search_in_neighbour and self.config.save_found:
-            await self.loop.run_in_executor(None, self.write_file_to_storage, file_name, file_bytes)
-
-        return await self.prepare_file_response(file_bytes)
+        return await self.serve_from_neighbours(request, file_name, self.max_hops)
+
+    async def serve_from_neighbours(self, request, file_name, hops):
+        # Частичный или условный запрос нельзя обслужить общим полетом за всем файлом:
+        # он пересылается соседу со своими заголовками, и ответ отдается как есть.
+        conditions = {h: request.headers[h] for h in self.conditional_headers if h in request.headers}
+        if conditions:
+            n_response = await self.fetch_from_neighbours(file_name, hops, conditions)
+            if n_response is None:
+                raise web.HTTPNotFound(text=f'There is no file with name {file_name!r}')
+            async with n_response:
+                return await self.proxy_response(request, n_response)
+
+        # Одновременные промахи одного имени ждут одно и то же скачивание у соседа
+        flight = self.flights.get(file_name)
+        if flight is None:
+            flight = self.flights[file_name] = Flight(self.loop, self.config.directory, file_name, hops, self.blobs)
+            asyncio.ensure_future(self.fetch_flight(file_name, flight))
+
+        flight.readers += 1
+        try:
+            if not await asyncio.shield(flight.found):
+                raise web.HTTPNotFound(text=f'There is no file with name {file_name!r}')
+            return await self.proxy_flight(request, flight)
+        finally:
+            flight.readers -= 1
+            if flight.done and not flight.readers:
+                await self.land_flight(file_name, flight)
 
     async def neighbour_download(self, request):
         file_name = request.match_info.get('file_name')
 
-        file_bytes = await self.get_file_from_storage(file_name)
-        if not file_bytes:
-            raise web.HTTPNotFound(text=f'Sry, neighbour, there is no file with name {file_name!r}')
+        response = await self.local_file_response(request, file_name)
+        if response:
+            if self.blobs is not None:
+                response.headers[self.content_hash_header] = await self.file_digest(file_name)
+            return response
 
-        return await self.prepare_file_response(file_bytes)
+        # В режиме размещения сосед может разрешить поискать файл дальше
+        hops = int(request.headers.get(self.hops_header, 0))
+        if self.ring is not None and hops > 0:
+            return await self.serve_from_neighbours(request, file_name, hops)
+        raise web.HTTPNotFound(text=f'Sry, neighbour, there is no file with name {file_name!r}')
 
     async def neighbour_check(self, request):
         file_name = request.match_info.get('file_name')
@@ -100,62 +404,378 @@ class StaticServer:
         if not file_path:
             raise web.HTTPNotFound(text=f'Sry, neighbour, there is no file with name {file_name!r}')
 
-        return web.Response(text='File found')
+        # Сосед по хешу узнает, не лежит ли у него то же содержимое под другим именем,
+        # а по Last-Modified - время изменения, с которым сохранить такое имя у себя
+        if self.blobs is None:
+            return web.Response(text='File found')
+        digest = await self.file_digest(file_name)
+        response = web.Response(text='File found', headers={self.content_hash_header: digest})
+        response.last_modified = (await self.loop.run_in_executor(None, self.file_validators, file_name, file_path))[1]
+        return response
+
+    async def file_digest(self, file_name):
+        return await self.loop.run_in_executor(None, self.blobs.digest, file_name)
+
+    async def cache_stats(self, request):
+        return web.json_response({'negative': self.negative_cache.stats(), 'location': self.location_cache.stats(),
+                                  'content': self.content_cache.stats()})
+
+    async def neighbour_stats(self, request):
+        return web.json_response({'requests': self.neighbour_requests, 'bytes': self.neighbour_bytes})
+
+    async def blob_stats(self, request):
+        if self.blobs is None:
+            raise web.HTTPNotFound(text='Deduplication is off')
+        return web.json_response(await self.loop.run_in_executor(None, self.blobs.stats))
+
+    async def local_file_response(self, request, file_name):
+        # Горячий файл отдается сжатой копией, если клиент принимает ее кодировку,
+        # иначе файл отдается как есть
+        encoding = self.choose_encoding(request, file_name)
+        if encoding is not None:
+            response = await self.stored_file_response(request, file_name, encoding)
+            if response:
+                return response
+        response = await self.stored_file_response(request, file_name)
+        if response and self.encodings and self.compressible(file_name):
+            response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    async def stored_file_response(self, request, file_name, encoding=None):
+        # Маленькие файлы отдаются из кэша содержимого, остальные - FileResponse,
+        # который передает файл через sendfile, не читая его в память, и сам
+        # отвечает 206 на Range и 304 на условные запросы.
+        use_cache = self.content_cache and not any(h in request.headers for h in self.conditional_headers)
+        key = (file_name, encoding) if encoding else file_name
+        if use_cache:
+            cached = self.content_cache.get(key)
+            if cached is not None:
+                return self.content_response(file_name, *cached, encoding)
 
-    def check_file_in_storage(self, file_name):
-        file_path = os.path.join(self.config.directory, file_name)
-        if not os.path.exists(file_path):
+        file_path = self.check_file_in_storage(file_name)
+        if not file_path:
             return None
-        return file_path
+        if encoding is not None:
+            file_path = self.encoded_file(file_name, file_path, encoding)
+            if file_path is None:
+                return None
+
+        if use_cache and os.path.getsize(file_path) <= self.config.cache.max_file_size:
+            cached = await self.loop.run_in_executor(None, self.read_file_from_storage, file_name, file_path)
+            self.content_cache.put(key, cached, len(cached[0]))
+            return self.content_response(file_name, *cached, encoding)
+        return await self.file_response(request, file_name, file_path,
+                                        self.encoded_headers(file_name, encoding) if encoding else None)
+
+    async def file_response(self, request, file_name, file_path, headers=None, mtime=None):
+        # Файл с диска через sendfile: FileResponse сам отвечает 206 на Range, а на условные
+        # запросы здесь отвечается по валидаторам сервера, одинаковым на всех нодах
+        try:
+            etag, last_modified = await self.loop.run_in_executor(
+                None, self.file_validators, file_name, file_path, mtime)
+        except FileNotFoundError:
+            return None
+        status = precondition(request, etag, last_modified)
+        if status is not None:
+            response = web.Response(status=status)
+            if status == 304:
+                response.etag, response.last_modified = etag, last_modified
+            return response
+        return StoredFileResponse(file_path, etag, last_modified, range_applies(request, etag, last_modified),
+                                  headers)
+
+    def file_validators(self, file_name, file_path, mtime=None):
+        # Сжатая копия имеет то же время изменения, что и файл, а размер - свой. С хранилищем
+        # по содержимому время изменения у каждого имени свое и берется из индекса.
+        st = os.stat(file_path)
+        if mtime is None and self.blobs is not None:
+            mtime = self.blobs.mtime(file_name)
+        return validators(st.st_mtime if mtime is None else mtime, st.st_size)
+
+    def encoded_headers(self, file_name, encoding):
+        return {'Content-Type': self.content_type(file_name), 'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'}
 
     @staticmethod
-    def read_file_from_storage(path):
+    def content_type(file_name):
+        return mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+
+    def content_response(self, file_name, content, etag, last_modified, encoding=None):
+        # Content-Type только в заголовках: aiohttp не принимает его одновременно и в content_type
+        headers = {'Accept-Ranges': 'bytes', 'Content-Type': self.content_type(file_name)}
+        if encoding is not None:
+            headers.update(self.encoded_headers(file_name, encoding))
+        response = web.Response(body=content, headers=headers)
+        response.etag = etag
+        response.last_modified = last_modified
+        return response
+
+    def compressible(self, file_name):
+        content_type = mimetypes.guess_type(file_name)[0]
+        return content_type is None or content_type.startswith(self.compressible_types)
+
+    def choose_encoding(self, request, file_name):
+        # Range относится к байтам файла, поэтому частичные запросы не сжимаются
+        if not self.encodings or 'Range' in request.headers or not self.compressible(file_name):
+            return None
+        return compress.negotiate(request.headers.get('Accept-Encoding', ''), self.encodings)
+
+    def encoded_file(self, file_name, file_path, encoding):
+        # Путь к свежей сжатой копии файла или None. Копия свежая, если у нее то же время
+        # изменения, что у файла. Файл, который запрашивают часто, сжимается в треде в
+        # фоне, а пока отдается как есть.
+        st = os.stat(file_path)
+        config = self.config.compression
+        if st.st_size < config.min_size or (file_name, st.st_mtime_ns) in self.incompressible:
+            return None
+        encoded_path = os.path.join(self.config.directory, self.encoded_dir, file_name + compress.SUFFIXES[encoding])
+        try:
+            if os.stat(encoded_path).st_mtime_ns == st.st_mtime_ns:
+                return encoded_path
+        except FileNotFoundError:
+            pass
+        requests = (self.request_counts.get(file_name) or 0) + 1
+        self.request_counts.put(file_name, requests)
+        if requests >= config.hot_requests and (file_name, encoding) not in self.compressing:
+            asyncio.ensure_future(self.compress_file(file_name, file_path, encoded_path, encoding, st))
+        return None
+
+    async def compress_file(self, file_name, file_path, encoded_path, encoding, st):
+        self.compressing.add((file_name, encoding))
+        config = self.config.compression
+        try:
+            await self.loop.run_in_executor(None, os.makedirs, os.path.dirname(encoded_path), 0o777, True)
+            size = await self.loop.run_in_executor(
+                None, compress.compress_file, file_path, encoded_path, encoding, config.level)
+            # Плохо сжимающийся файл (уже сжатый или случайные данные) не сжимается повторно
+            if size > st.st_size * config.max_ratio:
+                self.incompressible.add((file_name, st.st_mtime_ns))
+                await self.loop.run_in_executor(None, os.remove, encoded_path)
+        except OSError:
+            # Файл успели удалить или заменить
+            pass
+        finally:
+            self.compressing.discard((file_name, encoding))
+
+    def read_file_from_storage(self, file_name, path):
+        # Валидаторы те же, что у файла с диска, чтобы ETag не зависел от того, отдан
+        # файл из кэша или нет
         with open(path, 'rb') as file:
-            return file.read()
+            return (file.read(),) + self.file_validators(file_name, path)
 
-    def write_file_to_storage(self, file_name, file_bytes):
+    def check_file_in_storage(self, file_name):
         file_path = os.path.join(self.config.directory, file_name)
-        with open(file_path, 'wb') as file:
-            return file.write(file_bytes)
-
-    async def get_file_from_storage(self, file_name):
-        file_path = self.check_file_in_storage(file_name)
-        if not file_path:
+        if not os.path.exists(file_path):
             return None
-        file_bytes = await self.loop.run_in_executor(None, self.read_file_from_storage, file_path)
-        return file_bytes
-
-    async def ask_neighbours(self, file_name):
-        tasks = []
-        async with ClientSession() as session:
-            for n in self.config.neighbours:
-                task = asyncio.ensure_future(self.ask_neighbour(n, file_name, session))
-                tasks.append(task)
+        return file_path
 
-            responses = await asyncio.gather(*tasks)
+    def owners(self, file_name):
+        return self.ring.owners(file_name, self.config.placement.replicas)
+
+    async def fetch_from_neighbours(self, file_name, hops, conditions=None):
+        # Возвращает открытый ответ соседа с файлом или None. Сначала пробуется сосед,
+        # у которого файл нашелся в прошлый раз. С skip_check сразу скачивание
+        # у всех соседей, без отдельного запроса проверки. С хранилищем по содержимому
+        # проверка возвращает хеш, и если такое содержимое уже есть локально, вместо
+        # ответа соседа возвращается этот хеш: скачивать ничего не нужно.
+        neighbour = self.location_cache.get(file_name) if self.location_cache else None
+        if neighbour is not None:
+            n_response = await self.open_download(neighbour, file_name, 0, conditions)
+            if n_response is not None:
+                return n_response
+            self.location_cache.pop(file_name)
+
+        if self.ring is not None:
+            return await self.fetch_from_owners(file_name, hops, conditions)
+        if self.config.skip_check:
+            return await self.race_neighbours(self.open_download, self.config.neighbours, file_name, 0, conditions)
+        found = await self.race_neighbours(self.ask_neighbour, self.config.neighbours, file_name)
+        if found is None:
+            return None
+        neighbour, digest, mtime = found
+        if digest and not conditions and await self.has_blob(digest):
+            return digest, mtime
+        return await self.open_download(neighbour, file_name, 0, conditions)
+
+    async def has_blob(self, digest):
+        return self.blobs is not None and await self.loop.run_in_executor(None, self.blobs.has, digest)
+
+    async def fetch_from_owners(self, file_name, hops, conditions):
+        # Запрос идет только владельцам имени, без рассылки всем. Чужая нода пересылает
+        # его владельцам, и те сами ищут дальше. Владелец спрашивает остальных
+        # владельцев, а если файла нет и у них - с fallback всех остальных.
+        owners = self.owners(file_name)
+        others = [self.neighbours_by_name[name] for name in owners if name != self.config.name]
+        if self.config.name not in owners:
+            return await self.race_neighbours(self.open_download, others, file_name, hops - 1, conditions)
+        n_response = await self.race_neighbours(self.open_download, others, file_name, 0, conditions)
+        if n_response is None and self.config.placement.fallback:
+            rest = [n for n in self.config.neighbours if n.name not in owners]
+            n_response = await self.race_neighbours(self.open_download, rest, file_name, 0, conditions)
+        return n_response
+
+    async def race_neighbours(self, ask, neighbours, *args):
+        # Соседи опрашиваются одновременно, результат - первый положительный ответ.
+        # Остальные запросы отменяются, так что медленный или мертвый сосед
+        # не задерживает ответ, если файл есть у другого.
+        pending = {asyncio.ensure_future(ask(n, *args)) for n in neighbours}
+        winner = None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if winner is None:
+                        winner = task.result()
+                    else:
+                        self.discard_answer(task)
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(self.discard_answer)
+        return winner
 
-            for neighbour, result in filter(lambda n_and_res: bool(n_and_res[1]), responses):
-                return await self.download_from_neighbour(neighbour, file_name, session)
-            else:
-                return None
+    @staticmethod
+    def discard_answer(task):
+        # Проигравший сосед мог успеть ответить: его соединение закрывается без чтения тела
+        if not task.cancelled() and task.exception() is None and isinstance(task.result(), ClientResponse):
+            task.result().close()
 
-    async def download_from_neighbour(self, neighbour, file_name, session):
+    async def open_download(self, neighbour, file_name, hops=0, conditions=None):
         download_url = f'{neighbour.url}/{self.n_download_endpoint}/{file_name}'
-
-        async with session.get(download_url) as response:
-            if response.status == 200:
-                return await response.read()
+        headers = dict(conditions or {})
+        # Условный запрос относится к байтам файла, его ответ не сжимается
+        compressed = not conditions and self.encodings and self.config.compression.neighbours
+        headers['Accept-Encoding'] = ', '.join(self.encodings) if compressed else 'identity'
+        if hops > 0:
+            headers[self.hops_header] = str(hops)
+        self.neighbour_requests += 1
+        try:
+            response = await self.session.get(download_url, headers=headers)
+        except (client_exceptions.ClientError, asyncio.TimeoutError):
+            return None
+        if response.status not in self.found_statuses:
+            response.release()
             return None
+        self.location_cache.put(file_name, neighbour)
+        return response
 
-    async def ask_neighbour(self, neighbour, file_name, session):
+    async def fetch_flight(self, file_name, flight):
+        # Файл соседа по частям пишется во временный файл полета, в памяти лежит
+        # не больше одной части. Полет не привязан к запросу, который его начал:
+        # если этот клиент отключится, остальные получат файл.
+        try:
+            n_response = await self.fetch_from_neighbours(file_name, flight.hops)
+            if n_response is None:
+                self.negative_cache.put(file_name, True)
+                flight.found.set_result(False)
+                flight.finish()
+                return
+            if isinstance(n_response, tuple):
+                await self.land_blob(file_name, flight, *n_response)
+                return
+            async with n_response:
+                # Без отдельной проверки хеш приходит в ответе на скачивание: если такое
+                # содержимое уже есть, соединение закрывается, не дочитав тело
+                digest = n_response.headers.get(self.content_hash_header)
+                if digest and await self.has_blob(digest):
+                    mtime = http_time(n_response.headers.get('Last-Modified'))
+                    n_response.close()
+                    await self.land_blob(file_name, flight, digest, mtime)
+                    return
+                flight.content_type = n_response.content_type
+                flight.headers = {h: n_response.headers[h] for h in self.validator_headers if h in n_response.headers}
+                encoding = n_response.headers.get('Content-Encoding')
+                decompressor = compress.CODECS[encoding].decompressor() if encoding else None
+                if decompressor is None:
+                    flight.content_length = n_response.content_length
+                else:
+                    # Длина и ETag сжатого ответа к самому файлу не относятся
+                    flight.headers.pop('ETag', None)
+                await flight.open()
+                flight.found.set_result(True)
+                async for chunk in n_response.content.iter_chunked(self.chunk_size):
+                    self.neighbour_bytes += len(chunk)
+                    if decompressor is not None:
+                        chunk = await self.loop.run_in_executor(None, decompressor.decompress, chunk)
+                    if chunk:
+                        await flight.write(chunk)
+                tail = decompressor.flush() if decompressor is not None else b''
+                if tail:
+                    await flight.write(tail)
+            flight.finish()
+        except Exception as e:
+            if not flight.found.done():
+                flight.found.set_exception(e)
+            flight.finish(failed=True)
+        finally:
+            if not flight.readers:
+                await self.land_flight(file_name, flight)
+
+    async def proxy_response(self, request, n_response):
+        # Ответ соседа передается клиенту по частям вместе со статусом и валидаторами
+        headers = {h: n_response.headers[h] for h in self.validator_headers + ('Content-Range',)
+                   if h in n_response.headers}
+        response = web.StreamResponse(status=n_response.status, headers=headers)
+        if n_response.status != 304:
+            response.content_type = n_response.content_type
+            if n_response.content_length is not None:
+                response.content_length = n_response.content_length
+        await response.prepare(request)
+        async for chunk in n_response.content.iter_chunked(self.chunk_size):
+            self.neighbour_bytes += len(chunk)
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+    async def land_blob(self, file_name, flight, digest, mtime):
+        # Содержимое уже лежит в хранилище под другим именем: имя становится ссылкой
+        # на объект, если файл нужно сохранить, и читатели получают объект с диска
+        # с временем изменения, как у соседа
+        if self.keep_found(file_name):
+            await self.loop.run_in_executor(None, self.blobs.link_name, digest, file_name, mtime)
+        flight.blob, flight.blob_mtime = digest, mtime
+        flight.found.set_result(True)
+        flight.finish()
+
+    async def proxy_flight(self, request, flight):
+        if flight.blob is not None:
+            return await self.file_response(request, flight.file_name, self.blobs.blob_path(flight.blob),
+                                            {'Content-Type': self.content_type(flight.file_name)}, flight.blob_mtime)
+        response = web.StreamResponse(headers=flight.headers)
+        response.content_type = flight.content_type
+        if flight.content_length is not None:
+            response.content_length = flight.content_length
+        await response.prepare(request)
+        await flight.stream(response, self.chunk_size)
+        await response.write_eof()
+        return response
+
+    async def land_flight(self, file_name, flight):
+        # Последний читатель закончил: полет забывается, файл сохраняется или удаляется
+        if self.flights.get(file_name) is not flight:
+            return
+        del self.flights[file_name]
+        if flight.file is not None:
+            keep = self.keep_found(file_name) and not flight.failed
+            await self.loop.run_in_executor(None, flight.close, keep)
+
+    def keep_found(self, file_name):
+        # В режиме размещения найденный файл остается только у его владельцев
+        if self.ring is not None:
+            return self.config.name in self.owners(file_name)
+        return self.config.save_found
+
+    async def ask_neighbour(self, neighbour, file_name):
         asking_url = f'{neighbour.url}/{self.n_check_endpoint}/{file_name}'
+        self.neighbour_requests += 1
         try:
-            async with session.get(asking_url) as response:
+            async with self.session.get(asking_url) as response:
                 if response.status == 200:
-                    return neighbour, await response.read()
-                return neighbour, None
-        except client_exceptions.ClientConnectionError:
-            return neighbour, None
+                    self.location_cache.put(file_name, neighbour)
+                    return (neighbour, response.headers.get(self.content_hash_header),
+                            http_time(response.headers.get('Last-Modified')))
+                return None
+        except (client_exceptions.ClientError, asyncio.TimeoutError):
+            return None
 
 
 def create_args_parser():
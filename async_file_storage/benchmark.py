@@ -0,0 +1,388 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import tempfile
+import time
+
+from aiohttp import ClientSession
+
+import compress
+from harness import SCRIPT, Cluster, cluster, download, mb, percentile
+from ring import HashRing
+
+
+def disk_usage(directory):
+    # Место на диске с учетом жестких ссылок: каждый inode считается один раз
+    seen = set()
+    total = 0
+    for path, _, files in os.walk(directory):
+        for file_name in files:
+            st = os.stat(os.path.join(path, file_name))
+            if st.st_ino not in seen:
+                seen.add(st.st_ino)
+                total += st.st_blocks * 512
+    return total
+
+
+async def neighbour_requests(nodes, field='requests'):
+    async with ClientSession() as session:
+        total = 0
+        for node in nodes:
+            async with session.get(f'{node.url}/stats/neighbours') as response:
+                total += (await response.json())[field] if response.status == 200 else 0
+        return total
+
+
+def bench_stream(args):
+    # Узел A пустой, файл лежит на B: прямое скачивание с B - отдача с диска,
+    # скачивание с A - проксирование от соседа.
+    for size in args.sizes:
+        size = int(size * 2**20)
+        with tempfile.TemporaryDirectory() as root:
+            nodes = cluster(root, 2, args.port, script=args.script)
+            nodes[1].put('file', size)
+            for node in nodes:
+                node.start()
+            try:
+                for node, mode in ((nodes[1], 'local'), (nodes[0], 'neighbour')):
+                    base = node.status('VmRSS')
+
+                    async def run():
+                        async with ClientSession() as session:
+                            started = time.perf_counter()
+                            for _ in range(args.repeat):
+                                status, got = await download(session, f'{node.url}/file')
+                                assert status == 200 and got == size, (status, got)
+                            return time.perf_counter() - started
+
+                    elapsed = asyncio.run(run())
+                    print(f'{mb(size):>8.0f} MB {mode:<10} {mb(size) * args.repeat / elapsed:>9.1f} MB/s   '
+                          f'RSS {mb(base):6.1f} MB   peak {mb(node.status("VmHWM")):6.1f} MB')
+            finally:
+                for node in nodes:
+                    node.stop()
+
+
+async def timed_downloads(base_url, names, concurrency, expected_size=None):
+    # Конкурентные клиенты берут имена из общего списка по очереди
+    latencies = []
+    names = iter(names)
+
+    async def worker(session):
+        for name in names:
+            started = time.perf_counter()
+            status, size = await download(session, f'{base_url}/{name}')
+            assert expected_size is None or (status == 200 and size == expected_size), (status, size)
+            latencies.append(time.perf_counter() - started)
+
+    async with ClientSession() as session:
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - started
+        async with session.get(f'{base_url}/stats/cache') as response:
+            stats = await response.json() if response.status == 200 else {}
+        return elapsed, latencies, stats
+
+
+def distinct_names(count, requests):
+    # Промахи по разным именам: одновременные запросы одного имени сервер объединяет
+    return [f'file{i % count}' for i in range(requests)]
+
+
+NO_LOOKUP_CACHE = {'negative_ttl': 0, 'location_ttl': 0}
+
+
+def report(name, elapsed, latencies):
+    print(f'{name:<28} {len(latencies) / elapsed:>8.0f} req/s   '
+          f'p50 {percentile(latencies, 0.5) * 1000:8.2f} ms   p99 {percentile(latencies, 0.99) * 1000:8.2f} ms')
+
+
+def bench_pool(args):
+    # Промах на A: A опрашивает B и C и скачивает файл с C.
+    for keepalive in (0, 30):
+        client = {'connections_per_neighbour': args.connections, 'keepalive_timeout': keepalive}
+        with tempfile.TemporaryDirectory() as root:
+            nodes = cluster(root, 3, args.port, script=args.script, client=client, cache=NO_LOOKUP_CACHE)
+            for i in range(args.files):
+                nodes[2].put(f'file{i}', args.size)
+            for node in nodes:
+                node.start()
+            try:
+                for concurrency in args.concurrency:
+                    names = distinct_names(args.files, concurrency * args.requests)
+                    elapsed, latencies, _ = asyncio.run(
+                        timed_downloads(nodes[0].url, names, concurrency, args.size))
+                    mode = 'keep-alive' if keepalive else 'new connections'
+                    report(f'{mode} x{concurrency}', elapsed, latencies)
+            finally:
+                for node in nodes:
+                    node.stop()
+
+
+def bench_race(args):
+    # У A три соседа: B с файлом, пустой C и D, который принимает соединения, но не отвечает.
+    # Ответ A должен зависеть от B, а не от таймаута чтения у D.
+    blackhole = socket.create_server(('127.0.0.1', args.port + 10), backlog=1024)
+    try:
+        for skip_check in (False, True):
+            with tempfile.TemporaryDirectory() as root:
+                nodes = cluster(root, 3, args.port, extra_neighbours=[('D', args.port + 10)], script=args.script,
+                                skip_check=skip_check, client={'read_timeout': args.read_timeout},
+                                cache=NO_LOOKUP_CACHE)
+                for i in range(args.files):
+                    nodes[1].put(f'file{i}', args.size)
+                for node in nodes:
+                    node.start()
+                try:
+                    names = distinct_names(args.files, args.concurrency * args.requests)
+                    elapsed, latencies, _ = asyncio.run(
+                        timed_downloads(nodes[0].url, names, args.concurrency, args.size))
+                    report('skip check' if skip_check else 'check, then download', elapsed, latencies)
+                finally:
+                    for node in nodes:
+                        node.stop()
+    finally:
+        blackhole.close()
+
+
+def zipf(count, size, s, seed=0):
+    # Номера от 0 до count - 1, номер k выпадает с вероятностью ~ 1 / (k + 1)^s
+    weights = [1 / (k + 1) ** s for k in range(count)]
+    return random.Random(seed).choices(range(count), weights, k=size)
+
+
+def bench_cache(args):
+    # Файлы разложены по трем нодам, каждое пятое имя нет нигде. Запросы идут на A,
+    # имена выбираются по закону Ципфа: несколько популярных и длинный хвост.
+    names = [f'file{i}' for i in zipf(args.files, args.requests, args.s)]
+    disabled = {'negative_ttl': 0, 'location_ttl': 0, 'content_ttl': 0}
+    enabled = {'content_size': args.content_size}
+    for mode, cache in (('no cache', disabled), ('cache', enabled)):
+        with tempfile.TemporaryDirectory() as root:
+            nodes = cluster(root, 3, args.port, script=args.script, cache=cache)
+            for i in range(args.files):
+                if i % 5 != 4:
+                    nodes[i % 3].put(f'file{i}', args.size)
+            for node in nodes:
+                node.start()
+            try:
+                elapsed, latencies, stats = asyncio.run(timed_downloads(nodes[0].url, names, args.concurrency))
+                report(mode, elapsed, latencies)
+                for name, counters in stats.items():
+                    print(f'    {name:<10} hits {counters["hits"]:>7}   misses {counters["misses"]:>7}')
+            finally:
+                for node in nodes:
+                    node.stop()
+
+
+def bench_placement(args):
+    # Промахи на A по файлам, которых на A нет. Без размещения файл лежит на одной
+    # случайной ноде и A опрашивает всех, с размещением - у своих владельцев.
+    for count in args.nodes:
+        names = [f'file{i}' for i in range(args.files)]
+        ring = HashRing([node_name(i) for i in range(count)], 100)
+        for mode in ('broadcast', 'placement'):
+            options = {'cache': NO_LOOKUP_CACHE, 'skip_check': True}
+            if mode == 'placement':
+                options['placement'] = {'replicas': args.replicas}
+            with tempfile.TemporaryDirectory() as root:
+                cluster_nodes = Cluster(root, count, args.port, script=args.script, **options)
+                by_name = {node.name: node for node in cluster_nodes.nodes}
+                rnd = random.Random(0)
+                missing = []
+                for name in names:
+                    owners = ring.owners(name, args.replicas)
+                    if 'A' in owners:
+                        continue
+                    holders = owners if mode == 'placement' else [rnd.choice(owners)]
+                    for holder in holders:
+                        by_name[holder].put(name, args.size)
+                    missing.append(name)
+                with cluster_nodes as nodes:
+                    elapsed, latencies, _ = asyncio.run(
+                        timed_downloads(nodes[0].url, missing, args.concurrency, args.size))
+                    per_lookup = asyncio.run(neighbour_requests(nodes)) / len(missing)
+                report(f'{count:>3} nodes {mode}', elapsed, latencies)
+                print(f'{"":<28} {per_lookup:8.2f} neighbour requests per miss')
+
+
+def bench_dedup(args):
+    # Каждое содержимое лежит под несколькими именами на B или C, затем все имена
+    # запрашиваются у каждой ноды, так что в итоге каждая нода хранит все файлы.
+    # Имена идут по кругу, чтобы копии одного содержимого не запрашивались подряд
+    names = [f'file{i}-{j}' for j in range(args.copies) for i in range(args.contents)]
+    for dedup in (False, True):
+        with tempfile.TemporaryDirectory() as root:
+            cluster_nodes = Cluster(root, 3, args.port, script=args.script, save_found=True, dedup=dedup)
+            nodes = cluster_nodes.nodes
+            for i in range(args.contents):
+                holder = nodes[1 + i % 2]
+                source = holder.put(f'file{i}-0', args.size)
+                for j in range(1, args.copies):
+                    holder.copy(f'file{i}-{j}', source)
+            stored = sum(disk_usage(node.directory) for node in nodes)
+            with cluster_nodes:
+                started = time.perf_counter()
+                for node in nodes:
+                    asyncio.run(timed_downloads(node.url, names, args.concurrency, args.size))
+                elapsed = time.perf_counter() - started
+                transferred = asyncio.run(neighbour_requests(nodes, 'bytes'))
+            used = sum(disk_usage(node.directory) for node in nodes)
+        mode = 'dedup' if dedup else 'plain'
+        print(f'{mode:<8} {elapsed:6.2f} s   transferred {mb(transferred):8.1f} MB   '
+              f'disk {mb(stored):8.1f} MB before, {mb(used):8.1f} MB after')
+
+
+def sample_files(size, seed=0):
+    # Файлы разных типов примерно одного размера: логи, JSON, CSV и несжимаемые данные
+    rnd = random.Random(seed)
+    levels = ['INFO'] * 8 + ['WARNING', 'ERROR']
+    paths = ['/', '/index.html', '/api/v1/items', '/api/v1/users', '/static/app.js']
+
+    def repeat(line):
+        lines = []
+        total = 0
+        while total < size:
+            lines.append(line(len(lines)))
+            total += len(lines[-1])
+        return b''.join(lines)[:size]
+
+    return {
+        'app.log': repeat(lambda i: (f'2024-05-01 12:{i // 60 % 60:02d}:{i % 60:02d},{rnd.randrange(1000):03d} '
+                                     f'{rnd.choice(levels)} worker-{rnd.randrange(16)} GET {rnd.choice(paths)} '
+                                     f'{rnd.choice((200, 200, 200, 404, 500))} {rnd.random() * 100:.2f}ms\n').encode()),
+        'items.json': repeat(lambda i: json.dumps({'id': i, 'name': f'item {rnd.randrange(10**6)}',
+                                                    'price': round(rnd.random() * 1000, 2),
+                                                    'tags': rnd.sample(['a', 'b', 'c', 'd', 'e'], 2)}).encode() + b',\n'),
+        'table.csv': repeat(lambda i: f'{i},{rnd.randrange(10**9)},{rnd.random():.6f},{rnd.choice(levels)}\n'.encode()),
+        'photo.jpg': rnd.randbytes(size),
+    }
+
+
+def bench_compression(args):
+    # Сначала степень и скорость сжатия по типам файлов в этом процессе, затем
+    # передача тех же файлов от B к A без сжатия и со сжатием между соседями.
+    files = sample_files(args.size)
+    encodings = compress.available(args.encodings)
+    with tempfile.TemporaryDirectory() as root:
+        print(f'{"file":<12} {"encoding":<8} {"ratio":>6} {"compress":>14} {"decompress":>14}')
+        for file_name, data in files.items():
+            source = os.path.join(root, file_name)
+            with open(source, 'wb') as file:
+                file.write(data)
+            for encoding in encodings:
+                target = source + compress.SUFFIXES[encoding]
+                started = time.process_time()
+                size = compress.compress_file(source, target, encoding, args.level)
+                compress_time = time.process_time() - started
+                with open(target, 'rb') as file:
+                    encoded = file.read()
+                started = time.process_time()
+                decompressor = compress.CODECS[encoding].decompressor()
+                decoded = decompressor.decompress(encoded) + decompressor.flush()
+                decompress_time = time.process_time() - started
+                assert decoded == data
+                print(f'{file_name:<12} {encoding:<8} {size / len(data):6.3f} '
+                      f'{mb(len(data)) / max(compress_time, 1e-9):9.1f} MB/s {mb(len(data)) / max(decompress_time, 1e-9):9.1f} MB/s')
+
+    print()
+    for mode in ('identity', 'compressed'):
+        options = {'cache': NO_LOOKUP_CACHE}
+        if mode == 'compressed':
+            options['compression'] = {'encodings': encodings, 'level': args.level, 'hot_requests': 1}
+        with tempfile.TemporaryDirectory() as root:
+            cluster_nodes = Cluster(root, 2, args.port, script=args.script, **options)
+            a, b = cluster_nodes.nodes
+            for file_name, data in files.items():
+                with open(os.path.join(b.directory, file_name), 'wb') as file:
+                    file.write(data)
+            with cluster_nodes:
+                async def run():
+                    async with ClientSession() as session:
+                        # Прогрев: файлы на B становятся горячими и сжимаются
+                        for file_name in files:
+                            await download(session, f'{b.url}/{file_name}')
+                        await asyncio.sleep(1)
+                        cpu = a.cpu_time() + b.cpu_time()
+                        started = time.perf_counter()
+                        for _ in range(args.repeat):
+                            for file_name, data in files.items():
+                                status, size = await download(session, f'{a.url}/{file_name}')
+                                assert (status, size) == (200, len(data)), (status, size)
+                        return time.perf_counter() - started, a.cpu_time() + b.cpu_time() - cpu
+
+                elapsed, cpu = asyncio.run(run())
+                transferred = asyncio.run(neighbour_requests([a], 'bytes'))
+        total = sum(map(len, files.values())) * args.repeat
+        print(f'{mode:<12} wire {mb(transferred):8.1f} MB of {mb(total):8.1f} MB   '
+              f'{elapsed:6.2f} s   cpu {cpu:6.2f} s')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Async file storage benchmarks')
+    parser.add_argument('--port', type=int, default=7000)
+    parser.add_argument('--script', default=SCRIPT, help='Daemon to benchmark, e.g. an older version')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    stream = subparsers.add_parser('stream', help='Throughput and server memory by file size')
+    stream.add_argument('--sizes', type=float, nargs='+', default=[1, 16, 256], help='File sizes in MB')
+    stream.add_argument('--repeat', type=int, default=3)
+    stream.set_defaults(run=bench_stream)
+
+    pool = subparsers.add_parser('pool', help='Miss path latency with and without pooled neighbour connections')
+    pool.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64])
+    pool.add_argument('--requests', type=int, default=100, help='Requests per concurrent client')
+    pool.add_argument('--connections', type=int, default=8, help='Connections per neighbour')
+    pool.add_argument('--files', type=int, default=256, help='Distinct file names')
+    pool.add_argument('--size', type=int, default=1024, help='File size in bytes')
+    pool.set_defaults(run=bench_pool)
+
+    race = subparsers.add_parser('race', help='Miss path latency with a neighbour that never answers')
+    race.add_argument('--concurrency', type=int, default=8)
+    race.add_argument('--requests', type=int, default=50, help='Requests per concurrent client')
+    race.add_argument('--read-timeout', type=float, default=2, help='Neighbour read timeout in seconds')
+    race.add_argument('--files', type=int, default=256, help='Distinct file names')
+    race.add_argument('--size', type=int, default=1024, help='File size in bytes')
+    race.set_defaults(run=bench_race)
+
+    cache = subparsers.add_parser('cache', help='Zipfian request mix with and without lookup caches')
+    cache.add_argument('--files', type=int, default=1000)
+    cache.add_argument('--requests', type=int, default=5000)
+    cache.add_argument('--s', type=float, default=1.1, help='Zipf exponent')
+    cache.add_argument('--concurrency', type=int, default=16)
+    cache.add_argument('--size', type=int, default=4096, help='File size in bytes')
+    cache.add_argument('--content-size', type=int, default=2**24, help='Content cache size in bytes')
+    cache.set_defaults(run=bench_cache)
+
+    placement = subparsers.add_parser('placement', help='Miss path cost by cluster size, broadcast or hash placement')
+    placement.add_argument('--nodes', type=int, nargs='+', default=[3, 6, 12])
+    placement.add_argument('--replicas', type=int, default=2)
+    placement.add_argument('--files', type=int, default=600)
+    placement.add_argument('--concurrency', type=int, default=8)
+    placement.add_argument('--size', type=int, default=1024, help='File size in bytes')
+    placement.set_defaults(run=bench_placement)
+
+    dedup = subparsers.add_parser('dedup', help='Bytes transferred and disk used with duplicated content')
+    dedup.add_argument('--contents', type=int, default=20, help='Distinct file contents')
+    dedup.add_argument('--copies', type=int, default=10, help='Names per content')
+    dedup.add_argument('--concurrency', type=int, default=4)
+    dedup.add_argument('--size', type=int, default=2**20, help='File size in bytes')
+    dedup.set_defaults(run=bench_dedup)
+
+    compression = subparsers.add_parser('compression', help='Compression ratio and CPU cost by file type')
+    compression.add_argument('--encodings', nargs='+', default=['zstd', 'gzip', 'deflate'])
+    compression.add_argument('--level', type=int, default=6)
+    compression.add_argument('--size', type=int, default=2**22, help='Size of each file in bytes')
+    compression.add_argument('--repeat', type=int, default=5)
+    compression.set_defaults(run=bench_compression)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    arguments.run(arguments)
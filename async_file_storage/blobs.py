@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobStore:
+    # Хранилище по содержимому: объекты лежат в <directory>/.blobs под sha256 своих
+    # данных, а файлы хранилища - жесткие ссылки на них. Файлы с одинаковым
+    # содержимым занимают место на диске один раз, а раздаются по имени как раньше.
+    # Индекс имя -> хеш хранится с размером, временем изменения и inode файла,
+    # чтобы при запуске не пересчитывать хеши неизменных файлов, и со временем
+    # изменения самого имени: inode у ссылок на объект общий, поэтому время объекта не
+    # меняется, а валидаторы имени берутся из индекса. Индекс - журнал: каждое
+    # изменение дописывается в него строкой, а при запуске он сжимается до строки на имя.
+    # Все методы блокирующие, сервер вызывает их в тредах, поэтому изменения индекса
+    # идут под блокировкой.
+    def __init__(self, directory):
+        self.directory = directory
+        self.blob_dir = os.path.join(directory, '.blobs')
+        self.index_path = os.path.join(self.blob_dir, 'index.jsonl')
+        self.index = {}
+        self.lock = threading.Lock()
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    def has(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def scan(self):
+        # Новые и измененные файлы хранилища заменяются ссылками на объекты
+        os.makedirs(self.blob_dir, exist_ok=True)
+        known = self.load_index()
+        with self.lock:
+            self.index = {}
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.startswith('.') or not os.path.isfile(path):
+                    continue
+                entry = known.get(name)
+                if entry is None or entry[1:4] != self.signature(path):
+                    self.adopt(path, file_digest(path), name)
+                else:
+                    self.index[name] = entry
+            self.rewrite_index()
+
+    def digest(self, name):
+        # Хеш файла хранилища; файл, подмененный в обход сервера, пересчитывается
+        path = os.path.join(self.directory, name)
+        entry = self.index.get(name)
+        if entry is not None and entry[1:4] == self.signature(path):
+            return entry[0]
+        if not os.path.isfile(path):
+            return None
+        with self.lock:
+            digest = self.adopt(path, file_digest(path), name)
+            self.append_index(name)
+        return digest
+
+    def mtime(self, name):
+        # Время изменения имени или None, если имени нет в индексе или файл подменили
+        entry = self.index.get(name)
+        if entry is not None and entry[1:4] == self.signature(os.path.join(self.directory, name)):
+            return entry[4]
+        return None
+
+    @staticmethod
+    def signature(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def adopt(self, path, digest, name, mtime=None):
+        # Файл path с известным хешем становится файлом хранилища name. Если такой
+        # объект уже есть, файл заменяется ссылкой на него, иначе сам становится объектом.
+        # Время изменения имени - mtime или время самого файла path.
+        if mtime is None:
+            mtime = os.stat(path).st_mtime
+        blob_path = self.blob_path(digest)
+        target = os.path.join(self.directory, name)
+        if os.path.exists(blob_path):
+            if not os.path.samefile(path, blob_path):
+                os.remove(path)
+            if not os.path.exists(target) or not os.path.samefile(target, blob_path):
+                self.link(blob_path, target)
+        else:
+            os.link(path, blob_path)
+            if path != target:
+                os.replace(path, target)
+        self.index[name] = [digest] + self.signature(target) + [mtime]
+        return digest
+
+    def link_name(self, digest, name, mtime=None):
+        # Файл с уже известным содержимым появляется без передачи данных
+        with self.lock:
+            self.adopt(self.blob_path(digest), digest, name, mtime)
+            self.append_index(name)
+
+    def add(self, path, digest, name, mtime=None):
+        with self.lock:
+            self.adopt(path, digest, name, mtime)
+            self.append_index(name)
+
+    @staticmethod
+    def link(source, target):
+        # Ссылка создается под временным именем и атомарно заменяет target
+        temp = os.path.join(os.path.dirname(target), f'.{os.path.basename(target)}.link')
+        if os.path.exists(temp):
+            os.remove(temp)
+        os.link(source, temp)
+        os.replace(temp, target)
+
+    def load_index(self):
+        # Действует последняя строка об имени; строка, недописанная при сбое, пропускается
+        index = {}
+        try:
+            with open(self.index_path) as index_file:
+                for line in index_file:
+                    try:
+                        name, *entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    index[name] = entry
+        except OSError:
+            pass
+        return index
+
+    def append_index(self, name):
+        with open(self.index_path, 'a') as index_file:
+            index_file.write(json.dumps([name] + self.index[name]) + '\n')
+
+    def rewrite_index(self):
+        temp = self.index_path + '.tmp'
+        with open(temp, 'w') as index_file:
+            for name, entry in self.index.items():
+                index_file.write(json.dumps([name] + entry) + '\n')
+        os.replace(temp, self.index_path)
+
+    def stats(self):
+        # Объем объектов на диске и сколько занимали бы файлы без дедупликации
+        blobs = [entry for entry in os.scandir(self.blob_dir) if len(entry.name) == 64]
+        return {'names': len(self.index), 'blobs': len(blobs),
+                'bytes': sum(entry.stat().st_size for entry in blobs),
+                'logical_bytes': sum(entry[1] for entry in list(self.index.values()))}
@@ -0,0 +1,48 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    # LRU-кэш с временем жизни записей. Размер записи задает вызывающий: 1 для
+    # обычных записей, длина в байтах для содержимого файлов.
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __bool__(self):
+        # Выключенный кэш (ttl или размер 0) ничего не хранит и не считает
+        return bool(self.ttl and self.max_size)
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is not None:
+            value, size, expires = item
+            if expires > time.monotonic():
+                self.items.move_to_end(key)
+                self.hits += 1
+                return value
+            self.pop(key)
+        self.misses += 1
+        return None
+
+    def put(self, key, value, size=1):
+        if not self or size > self.max_size:
+            return
+        self.pop(key)
+        self.items[key] = value, size, time.monotonic() + self.ttl
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size, _) = self.items.popitem(last=False)
+            self.size -= evicted_size
+
+    def pop(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.items), 'size': self.size}
@@ -0,0 +1,96 @@
+import os
+import tempfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ZlibCodec:
+    # gzip и deflate - один zlib с разными заголовками: в HTTP deflate означает
+    # поток в формате zlib, а не голый deflate
+    def __init__(self, wbits):
+        self.wbits = wbits
+
+    def compressor(self, level):
+        return zlib.compressobj(level, zlib.DEFLATED, self.wbits)
+
+    def decompressor(self):
+        return zlib.decompressobj(self.wbits)
+
+
+class ZstdCodec:
+    # Интерфейс zstandard приведен к compressobj/decompressobj из zlib
+    def compressor(self, level):
+        return zstandard.ZstdCompressor(level=level).compressobj()
+
+    def decompressor(self):
+        return ZstdDecompressor()
+
+
+class ZstdDecompressor:
+    def __init__(self):
+        self.decoder = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        return self.decoder.decompress(data)
+
+    def flush(self):
+        return b''
+
+
+CODECS = {'gzip': ZlibCodec(16 + zlib.MAX_WBITS), 'deflate': ZlibCodec(zlib.MAX_WBITS)}
+if zstandard is not None:
+    CODECS['zstd'] = ZstdCodec()
+SUFFIXES = {'zstd': '.zst', 'gzip': '.gz', 'deflate': '.zz'}
+
+
+def available(encodings):
+    # Кодировки из конфига, которые можно использовать в этом окружении, в порядке предпочтения
+    return [encoding for encoding in encodings if encoding in CODECS]
+
+
+def negotiate(accept_encoding, encodings):
+    # Выбор кодировки по Accept-Encoding: наибольший q, при равенстве - порядок
+    # encodings. None - отдавать как есть.
+    weights = {}
+    for item in accept_encoding.lower().split(','):
+        name, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                continue
+        weights[name.strip()] = q
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress_file(source, target, encoding, level, chunk_size=2**18):
+    # Сжимает файл по частям во временный файл рядом с target и возвращает размер
+    # результата. Время изменения копируется с исходного файла: по нему
+    # проверяется, не устарела ли сжатая копия.
+    compressor = CODECS[encoding].compressor(level)
+    directory = os.path.dirname(target)
+    with open(source, 'rb') as src, tempfile.NamedTemporaryFile(dir=directory, prefix='.', suffix='.part',
+                                                                delete=False) as dst:
+        try:
+            for chunk in iter(lambda: src.read(chunk_size), b''):
+                dst.write(compressor.compress(chunk))
+            dst.write(compressor.flush())
+            dst.close()
+            st = os.fstat(src.fileno())
+            os.utime(dst.name, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(dst.name, target)
+        except BaseException:
+            os.remove(dst.name)
+            raise
+    return os.path.getsize(target)
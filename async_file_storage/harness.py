@@ -0,0 +1,163 @@
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+import yaml
+from aiohttp import web
+
+from async_file_storage import StaticServer, StaticServerConfig
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'async_file_storage.py')
+
+
+def process_status(pid, field):
+    # VmRSS - текущая память процесса, VmHWM - пиковая
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+
+
+class Node:
+    # Нода со сгенерированным конфигом и своей директорией. start запускает демон
+    # в отдельном процессе, serve - StaticServer в текущем цикле событий.
+    def __init__(self, root, name, port, neighbours, save_found=False, script=SCRIPT, **options):
+        self.name = name
+        self.port = port
+        self.directory = os.path.join(root, name)
+        os.makedirs(self.directory, exist_ok=True)
+        self.config_path = os.path.join(root, f'{name}.yml')
+        self.config = {'name': name, 'host': '127.0.0.1', 'port': port, 'directory': self.directory,
+                       'save_found': save_found,
+                       'neighbours': {n_name: {'host': '127.0.0.1', 'port': n_port} for n_name, n_port in neighbours}}
+        self.config.update(options)
+        with open(self.config_path, 'w') as config_file:
+            yaml.safe_dump(self.config, config_file)
+        self.script = script
+        self.proc = None
+        self.runner = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    def start(self):
+        self.proc = subprocess.Popen([sys.executable, self.script, self.config_path],
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(200):
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                return self
+            except ConnectionRefusedError:
+                if self.proc.poll() is not None:
+                    break
+                time.sleep(0.05)
+        self.stop()
+        raise RuntimeError(f'Node {self.name} did not start')
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+    async def serve(self):
+        # Та же нода без отдельного процесса: всегда текущая версия демона, script не используется
+        server = StaticServer(StaticServerConfig.from_dict(self.config), asyncio.get_running_loop())
+        self.runner = web.AppRunner(server.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', self.port).start()
+        return self
+
+    async def close(self):
+        await self.runner.cleanup()
+
+    def status(self, field):
+        return process_status(self.proc.pid, field)
+
+    def cpu_time(self):
+        # Время процессора процесса (user + system) в секундах
+        with open(f'/proc/{self.proc.pid}/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def put(self, file_name, size):
+        path = os.path.join(self.directory, file_name)
+        with open(path, 'wb') as file:
+            chunk = os.urandom(2**20)
+            for _ in range(size // len(chunk)):
+                file.write(chunk)
+            file.write(chunk[:size % len(chunk)])
+        return path
+
+    def copy(self, file_name, source):
+        shutil.copyfile(source, os.path.join(self.directory, file_name))
+
+
+def node_name(i):
+    return chr(ord('A') + i) if i < 26 else f'N{i}'
+
+
+def cluster(root, count, base_port, extra_neighbours=(), **options):
+    # N нод на localhost, каждая знает всех остальных
+    ports = [base_port + i for i in range(count)]
+    return [Node(root, node_name(i), port,
+                 [(node_name(j), ports[j]) for j in range(count) if j != i] + list(extra_neighbours), **options)
+            for i, port in enumerate(ports)]
+
+
+class Cluster:
+    # Ноды в своих процессах: with Cluster(...) as nodes, либо start и stop.
+    # В одном процессе: await serve() и await close().
+    def __init__(self, root, count, base_port, **options):
+        self.nodes = cluster(root, count, base_port, **options)
+
+    def start(self):
+        started = []
+        try:
+            for node in self.nodes:
+                started.append(node.start())
+        except Exception:
+            for node in started:
+                node.stop()
+            raise
+        return self.nodes
+
+    def stop(self):
+        for node in self.nodes:
+            node.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    async def serve(self):
+        for node in self.nodes:
+            await node.serve()
+        return self.nodes
+
+    async def close(self):
+        for node in self.nodes:
+            if node.runner is not None:
+                await node.close()
+
+
+async def download(session, url):
+    size = 0
+    async with session.get(url) as response:
+        async for chunk in response.content.iter_chunked(2**16):
+            size += len(chunk)
+        return response.status, size
+
+
+def mb(size):
+    return size / 2**20
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
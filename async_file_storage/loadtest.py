@@ -0,0 +1,209 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientSession, TCPConnector
+
+from harness import Cluster, download, mb, node_name, percentile, process_status
+
+SIZE_UNITS = {'': 1, 'k': 2**10, 'm': 2**20, 'g': 2**30}
+CLASSES = ('local', 'neighbour', 'miss')
+
+
+def parse_size(text):
+    text = text.strip().lower()
+    unit = text[-1] if text[-1] in SIZE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def parse_weights(text, parse_key=str):
+    # "1k=70,64k=25,4m=5" -> [(1024, 70.0), (65536, 25.0), (4194304, 5.0)]
+    weights = []
+    for item in text.split(','):
+        key, _, weight = item.partition('=')
+        weights.append((parse_key(key), float(weight or 1)))
+    return weights
+
+
+class Corpus:
+    # Файлы каждой ноды: имя -> размер, размеры выбираются по заданным весам
+    def __init__(self, nodes, files_per_node, sizes, seed=0):
+        rnd = random.Random(seed)
+        values, weights = zip(*sizes)
+        self.seed = seed
+        self.files = {node: {f'{node}-{i}': rnd.choices(values, weights)[0] for i in range(files_per_node)}
+                      for node in nodes}
+        self.sizes = {name: size for files in self.files.values() for name, size in files.items()}
+
+    def write(self, directories):
+        # У каждого файла свое случайное содержимое, повторенное до нужного размера
+        rnd = random.Random(self.seed)
+        for node, files in self.files.items():
+            for name, size in files.items():
+                block = rnd.randbytes(min(size, 2**16))
+                with open(os.path.join(directories[node], name), 'wb') as file:
+                    for _ in range(size // len(block)):
+                        file.write(block)
+                    file.write(block[:size % len(block)])
+
+    @property
+    def total_size(self):
+        return sum(self.sizes.values())
+
+
+def plan_requests(corpus, mix, count, seed=0):
+    # Последовательность (класс, нода, имя, ожидаемый размер или None для промаха).
+    # Попадание у соседа - запрос к ноде, у которой файла нет, а есть у другой.
+    rnd = random.Random(seed)
+    classes, weights = zip(*mix)
+    names = {node: list(files) for node, files in corpus.files.items()}
+    nodes = list(names)
+    plan = []
+    for i in range(count):
+        kind = rnd.choices(classes, weights)[0]
+        node = rnd.choice(nodes)
+        if kind == 'local':
+            name = rnd.choice(names[node])
+        elif kind == 'neighbour':
+            name = rnd.choice(names[rnd.choice([n for n in nodes if n != node])])
+        else:
+            name = f'missing-{rnd.randrange(max(len(corpus.sizes), 1))}'
+        plan.append((kind, node, name, corpus.sizes.get(name)))
+    return plan
+
+
+async def drive(urls, plan, concurrency):
+    # Конкурентные клиенты берут запросы из общего плана по очереди
+    samples = []
+    requests = iter(plan)
+
+    async def worker(session):
+        for kind, node, name, expected in requests:
+            started = time.perf_counter()
+            try:
+                status, size = await download(session, f'{urls[node]}/{name}')
+                ok = (status, size) == (200, expected) if expected is not None else status == 404
+            except Exception:
+                size, ok = 0, False
+            samples.append((kind, time.perf_counter() - started, size, ok))
+
+    async with ClientSession(connector=TCPConnector(limit=0)) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+        return time.perf_counter() - started, samples
+
+
+def summarize(elapsed, samples):
+    def stats(selected):
+        latencies = [latency for _, latency, _, _ in selected]
+        return {'requests': len(selected), 'throughput': len(selected) / elapsed,
+                'mb_per_s': mb(sum(size for _, _, size, _ in selected)) / elapsed,
+                'p50_ms': percentile(latencies, 0.5) * 1000, 'p99_ms': percentile(latencies, 0.99) * 1000,
+                'errors': sum(not ok for _, _, _, ok in selected)}
+
+    result = {kind: stats([s for s in samples if s[0] == kind]) for kind in CLASSES if any(s[0] == kind for s in samples)}
+    result['total'] = stats(samples)
+    return result
+
+
+def memory(mesh, shared):
+    # Текущая и пиковая память по нодам в байтах
+    if shared:
+        return {'shared': {'rss': process_status(os.getpid(), 'VmRSS'), 'peak': process_status(os.getpid(), 'VmHWM')}}
+    return {node.name: {'rss': node.status('VmRSS'), 'peak': node.status('VmHWM')} for node in mesh.nodes}
+
+
+async def load_test(root, args):
+    # По умолчанию каждая нода - демон в своем процессе, чтобы память считалась по нодам;
+    # с --shared-process все ноды работают в цикле событий нагрузки, и память видна только общая
+    corpus = Corpus([node_name(i) for i in range(args.nodes)], args.files, parse_weights(args.sizes, parse_size),
+                    args.seed)
+    mesh = Cluster(root, args.nodes, args.port, **json.loads(args.options))
+    corpus.write({node.name: node.directory for node in mesh.nodes})
+    mix = parse_weights(args.mix)
+    urls = {node.name: node.url for node in mesh.nodes}
+    if args.shared_process:
+        await mesh.serve()
+    else:
+        await asyncio.get_running_loop().run_in_executor(None, mesh.start)
+    try:
+        if args.warmup:
+            await drive(urls, plan_requests(corpus, mix, args.warmup, args.seed + 1), args.concurrency)
+        elapsed, samples = await drive(urls, plan_requests(corpus, mix, args.requests, args.seed), args.concurrency)
+        return {'classes': summarize(elapsed, samples), 'nodes': memory(mesh, args.shared_process),
+                'elapsed': elapsed}
+    finally:
+        if args.shared_process:
+            await mesh.close()
+        else:
+            mesh.stop()
+
+
+def compare(result, baseline, tolerance):
+    # Регрессии относительно сохраненного результата: пропускная способность ниже,
+    # p99 или пиковая память выше базовых больше чем на tolerance
+    regressions = []
+    for kind, base in baseline['classes'].items():
+        current = result['classes'].get(kind)
+        if current is None:
+            continue
+        if current['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f'{kind}: throughput {current["throughput"]:.0f} < {base["throughput"]:.0f} req/s')
+        if current['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            regressions.append(f'{kind}: p99 {current["p99_ms"]:.2f} > {base["p99_ms"]:.2f} ms')
+        if current['errors'] > base['errors']:
+            regressions.append(f'{kind}: {current["errors"]} errors, was {base["errors"]}')
+    for node, base in baseline['nodes'].items():
+        current = result['nodes'].get(node)
+        if current is not None and current['peak'] > base['peak'] * (1 + tolerance):
+            regressions.append(f'{node}: peak RSS {mb(current["peak"]):.1f} > {mb(base["peak"]):.1f} MB')
+    return regressions
+
+
+def report(result):
+    print(f'{"class":<10} {"requests":>8} {"req/s":>9} {"MB/s":>8} {"p50 ms":>9} {"p99 ms":>9} {"errors":>7}')
+    for kind, stats in result['classes'].items():
+        print(f'{kind:<10} {stats["requests"]:>8} {stats["throughput"]:>9.0f} {stats["mb_per_s"]:>8.1f} '
+              f'{stats["p50_ms"]:>9.2f} {stats["p99_ms"]:>9.2f} {stats["errors"]:>7}')
+    for node, memory in result['nodes'].items():
+        print(f'node {node:<5} RSS {mb(memory["rss"]):7.1f} MB   peak {mb(memory["peak"]):7.1f} MB')
+
+
+def create_args_parser():
+    prs = argparse.ArgumentParser(description='Load test for a mesh of storage nodes on localhost')
+    prs.add_argument('--nodes', type=int, default=3)
+    prs.add_argument('--port', type=int, default=7500, help='Port of the first node, the rest follow it')
+    prs.add_argument('--files', type=int, default=200, help='Files per node')
+    prs.add_argument('--sizes', default='1k=60,64k=30,1m=9,8m=1', help='File size distribution, size=weight')
+    prs.add_argument('--mix', default='local=50,neighbour=40,miss=10', help='Request mix, class=weight')
+    prs.add_argument('--requests', type=int, default=5000)
+    prs.add_argument('--warmup', type=int, default=200)
+    prs.add_argument('--concurrency', type=int, default=32)
+    prs.add_argument('--seed', type=int, default=0)
+    prs.add_argument('--options', default='{}', help='Extra node config as JSON, e.g. {"skip_check": true}')
+    prs.add_argument('--shared-process', action='store_true', help='Run all nodes in the load generator process')
+    prs.add_argument('--json', help='Save the result to this file')
+    prs.add_argument('--baseline', help='Fail if the result regresses against this saved result')
+    prs.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression')
+    return prs
+
+
+if __name__ == '__main__':
+    arguments = create_args_parser().parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        load_result = asyncio.run(load_test(tmp, arguments))
+    report(load_result)
+    if arguments.json:
+        with open(arguments.json, 'w') as result_file:
+            json.dump(load_result, result_file, indent=2)
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline_file:
+            found = compare(load_result, json.load(baseline_file), arguments.tolerance)
+        for line in found:
+            print('REGRESSION', line)
+        sys.exit(1 if found else 0)
@@ -0,0 +1,28 @@
+import hashlib
+from bisect import bisect
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    # Консистентное хеширование: у каждой ноды virtual_nodes точек на кольце, владельцы
+    # имени - первые разные ноды по часовой стрелке от его хеша. При добавлении или
+    # удалении ноды переезжает только ее доля имен.
+    def __init__(self, nodes, virtual_nodes=100):
+        points = sorted((ring_hash(f'{node}#{i}'), node) for node in nodes for i in range(virtual_nodes))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+        self.count = len(set(nodes))
+
+    def owners(self, key, replicas):
+        owners = []
+        start = bisect(self.hashes, ring_hash(key))
+        for i in range(len(self.nodes)):
+            node = self.nodes[(start + i) % len(self.nodes)]
+            if node not in owners:
+                owners.append(node)
+                if len(owners) == min(replicas, self.count):
+                    break
+        return owners
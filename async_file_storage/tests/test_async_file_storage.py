@@ -0,0 +1,537 @@
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import time
+from collections import Counter
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from aiohttp import web, ClientSession, client_exceptions
+
+from async_file_storage import (StaticServer, StaticServerConfig, Neighbour, PlacementConfig, CacheConfig,
+                                CompressionConfig)
+from blobs import BlobStore
+from cache import TTLCache
+
+
+async def start_app(app, port=0):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class FakeNeighbour:
+    # Сосед, который считает запросы и отдает файл медленно, частями. delay - пауза
+    # перед каждым ответом, status - ответ на все запросы вместо файла, break_after -
+    # сколько байт отдать перед тем, как оборвать соединение.
+    def __init__(self, files, delay=0, status=None, break_after=None):
+        self.files = files
+        self.delay = delay
+        self.status = status
+        self.break_after = break_after
+        self.requests = Counter()
+        # Запросы, которые клиент бросил, пока сосед думал над ответом
+        self.abandoned = Counter()
+        self.app = web.Application()
+        self.app.add_routes([web.get('/{endpoint}/{file_name}', self.handle)])
+
+    async def handle(self, request):
+        endpoint, file_name = request.match_info['endpoint'], request.match_info['file_name']
+        self.requests[endpoint, file_name] += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+            if request.transport is None or request.transport.is_closing():
+                self.abandoned[endpoint, file_name] += 1
+                return web.Response()
+        if self.status is not None:
+            return web.Response(status=self.status)
+        if file_name not in self.files:
+            raise web.HTTPNotFound()
+        if endpoint == StaticServer.n_check_endpoint:
+            return web.Response(text='File found')
+        data = self.files[file_name]
+        response = web.StreamResponse()
+        response.content_length = len(data)
+        await response.prepare(request)
+        for start in range(0, len(data), 2**16):
+            if self.break_after is not None and start >= self.break_after:
+                request.transport.close()
+                return response
+            await asyncio.sleep(0.01)
+            await response.write(data[start:start + 2**16])
+        await response.write_eof()
+        return response
+
+
+class CoalescingTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(2**20)
+        self.neighbour = FakeNeighbour({'file': self.data})
+        self.neighbour_runner, neighbour_port = await start_app(self.neighbour.app)
+        neighbour = Neighbour('N', '127.0.0.1', neighbour_port, f'http://127.0.0.1:{neighbour_port}')
+        config = StaticServerConfig('127.0.0.1', 0, self.directory.name, True, [neighbour])
+        self.server = StaticServer(config)
+        self.runner, port = await start_app(self.server.app)
+        self.url = f'http://127.0.0.1:{port}'
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        await self.neighbour_runner.cleanup()
+        self.directory.cleanup()
+
+    async def herd(self, file_name, clients):
+        async def fetch(session):
+            async with session.get(f'{self.url}/{file_name}') as response:
+                return response.status, await response.read()
+
+        async with ClientSession() as session:
+            return await asyncio.gather(*[fetch(session) for _ in range(clients)])
+
+    async def test_one_fetch_for_many_clients(self):
+        results = await self.herd('file', 200)
+        self.assertEqual([(200, self.data)] * 200, results)
+        self.assertEqual(1, self.neighbour.requests[StaticServer.n_check_endpoint, 'file'])
+        self.assertEqual(1, self.neighbour.requests[StaticServer.n_download_endpoint, 'file'])
+        self.assertEqual({}, self.server.flights)
+        self.assertEqual(['file'], os.listdir(self.directory.name))
+
+    async def test_one_lookup_for_missing_file(self):
+        results = await self.herd('missing', 200)
+        self.assertEqual({404}, {status for status, _ in results})
+        self.assertEqual(1, self.neighbour.requests[StaticServer.n_check_endpoint, 'missing'])
+        self.assertEqual({}, self.server.flights)
+
+
+class RaceTest(IsolatedAsyncioTestCase):
+    # Один StaticServer и несколько поддельных соседей с разным поведением
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.runners = []
+        self.data = os.urandom(2**19)
+
+    async def asyncTearDown(self):
+        for runner in self.runners:
+            await runner.cleanup()
+        self.directory.cleanup()
+
+    async def start(self, *fakes, dead=0, save_found=False, skip_check=False):
+        neighbours = []
+        for i, fake in enumerate(fakes):
+            runner, port = await start_app(fake.app)
+            self.runners.append(runner)
+            neighbours.append(Neighbour(f'N{i}', '127.0.0.1', port, f'http://127.0.0.1:{port}'))
+        # на порту мертвого соседа никто не слушает
+        for i in range(dead):
+            port = free_port()
+            neighbours.append(Neighbour(f'D{i}', '127.0.0.1', port, f'http://127.0.0.1:{port}'))
+        config = StaticServerConfig('127.0.0.1', 0, self.directory.name, save_found, neighbours,
+                                    skip_check=skip_check)
+        self.server = StaticServer(config)
+        runner, port = await start_app(self.server.app)
+        self.runners.append(runner)
+        self.url = f'http://127.0.0.1:{port}'
+
+    async def get(self, file_name):
+        async with ClientSession() as session:
+            async with session.get(f'{self.url}/{file_name}') as response:
+                return response.status, await response.read()
+
+    async def check_first_responder_wins(self, endpoint, skip_check):
+        slow = FakeNeighbour({'file': self.data}, delay=2)
+        fast = FakeNeighbour({'file': self.data})
+        await self.start(slow, fast, dead=1, skip_check=skip_check)
+        started = self.server.loop.time()
+        self.assertEqual((200, self.data), await self.get('file'))
+        self.assertLess(self.server.loop.time() - started, 1)
+        self.assertEqual(1, fast.requests[StaticServer.n_download_endpoint, 'file'])
+        self.assertEqual(int(skip_check), slow.requests[StaticServer.n_download_endpoint, 'file'])
+        # запрос к медленному соседу отменен: он закончит думать, когда клиента уже нет
+        await asyncio.sleep(2.2)
+        self.assertEqual(1, slow.abandoned[endpoint, 'file'])
+        self.assertEqual([], os.listdir(self.directory.name))
+        self.assertEqual({}, self.server.flights)
+
+    async def test_first_check_wins(self):
+        await self.check_first_responder_wins(StaticServer.n_check_endpoint, False)
+
+    async def test_first_download_wins(self):
+        await self.check_first_responder_wins(StaticServer.n_download_endpoint, True)
+
+    async def test_all_neighbours_fail(self):
+        for skip_check in (False, True):
+            with self.subTest(skip_check=skip_check):
+                await self.start(FakeNeighbour({}), FakeNeighbour({'file': self.data}, status=500), dead=1,
+                                 skip_check=skip_check)
+                self.assertEqual(404, (await self.get('file'))[0])
+                self.assertTrue(self.server.negative_cache.get('file'))
+                self.assertEqual([], os.listdir(self.directory.name))
+                self.assertEqual({}, self.server.flights)
+
+    async def test_broken_download_leaves_no_temp_file(self):
+        await self.start(FakeNeighbour({'file': self.data}, break_after=2**17), save_found=True)
+        with self.assertRaises(client_exceptions.ClientPayloadError):
+            await self.get('file')
+        for _ in range(100):
+            if not self.server.flights:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual({}, self.server.flights)
+        self.assertEqual([], os.listdir(self.directory.name))
+
+
+class MeshTestCase(IsolatedAsyncioTestCase):
+    # Несколько StaticServer в одном цикле событий, каждый знает всех остальных
+    names = 'ABC'
+    save_found = False
+    options = {}
+
+    async def asyncSetUp(self):
+        self.directories = {name: tempfile.TemporaryDirectory() for name in self.names}
+        ports = {name: free_port() for name in self.names}
+        self.servers = {}
+        self.runners = []
+        for name, port in ports.items():
+            neighbours = [Neighbour(n, '127.0.0.1', n_port, f'http://127.0.0.1:{n_port}')
+                          for n, n_port in ports.items() if n != name]
+            config = StaticServerConfig('127.0.0.1', port, self.directories[name].name, self.save_found, neighbours,
+                                        name=name, **self.options)
+            self.servers[name] = StaticServer(config)
+            self.runners.append((await start_app(self.servers[name].app, port))[0])
+        self.urls = {name: f'http://127.0.0.1:{port}' for name, port in ports.items()}
+        self.url = self.urls[self.names[0]]
+
+    async def asyncTearDown(self):
+        for runner in self.runners:
+            await runner.cleanup()
+        for directory in self.directories.values():
+            directory.cleanup()
+
+    def put(self, name, file_name, data):
+        with open(os.path.join(self.directories[name].name, file_name), 'wb') as file:
+            file.write(data)
+
+    async def get(self, url, **headers):
+        async with ClientSession() as session:
+            async with session.get(url, headers=headers) as response:
+                return response.status, response.headers, await response.read()
+
+
+class TTLCacheTest(TestCase):
+    def test_entries_expire(self):
+        cache = TTLCache(0.05, 10)
+        cache.put('a', 1)
+        self.assertEqual(1, cache.get('a'))
+        time.sleep(0.06)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual({'hits': 1, 'misses': 1, 'entries': 0, 'size': 0}, cache.stats())
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TTLCache(60, 3)
+        for key in 'abc':
+            cache.put(key, key)
+        cache.get('a')
+        cache.put('d', 'd')
+        self.assertEqual(['c', 'a', 'd'], list(cache.items))
+        self.assertIsNone(cache.get('b'))
+
+    def test_size_in_bytes(self):
+        cache = TTLCache(60, 100)
+        cache.put('a', b'x' * 60, 60)
+        cache.put('b', b'x' * 30, 30)
+        cache.put('a', b'x' * 50, 50)
+        self.assertEqual(80, cache.size)
+        cache.put('c', b'x' * 40, 40)
+        self.assertEqual((['a', 'c'], 90), (list(cache.items), cache.size))
+        # запись больше всего кэша не вытесняет остальные
+        cache.put('d', b'x' * 101, 101)
+        self.assertEqual((['a', 'c'], 90), (list(cache.items), cache.size))
+
+    def test_disabled(self):
+        for cache in (TTLCache(0, 10), TTLCache(60, 0)):
+            self.assertFalse(cache)
+            cache.put('a', 1)
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(0, len(cache.items))
+
+
+class CacheTest(MeshTestCase):
+    names = 'ABC'
+    options = {'cache': CacheConfig(negative_ttl=0.2, location_ttl=60, content_ttl=0.2, content_size=2**20)}
+
+    async def stats(self, name):
+        status, _, body = await self.get(f'{self.urls[name]}/{StaticServer.stats_endpoint}/cache')
+        self.assertEqual(200, status)
+        return json.loads(body)
+
+    async def test_negative_cache(self):
+        a = self.servers['A']
+        self.assertEqual(404, (await self.get(f'{self.url}/file'))[0])
+        self.assertEqual(2, a.neighbour_requests)
+        # повторный промах не рассылается соседям
+        self.assertEqual(404, (await self.get(f'{self.url}/file'))[0])
+        self.assertEqual(2, a.neighbour_requests)
+        self.assertEqual({'hits': 1, 'misses': 1, 'entries': 1, 'size': 1}, (await self.stats('A'))['negative'])
+
+        # файл у соседа виден после negative_ttl, локальный файл - сразу
+        self.put('B', 'file', b'remote')
+        self.assertEqual(404, (await self.get(f'{self.url}/file'))[0])
+        self.assertEqual(404, (await self.get(f'{self.url}/local'))[0])
+        self.put('A', 'local', b'local')
+        self.assertEqual((200, b'local'), (await self.get(f'{self.url}/local'))[::2])
+        await asyncio.sleep(0.25)
+        self.assertEqual((200, b'remote'), (await self.get(f'{self.url}/file'))[::2])
+
+    async def test_location_cache(self):
+        a = self.servers['A']
+        # больше max_file_size, чтобы C не отдавал файл из своего кэша содержимого
+        data = os.urandom(2**17)
+        self.put('C', 'file', data)
+        self.assertEqual((200, data), (await self.get(f'{self.url}/file'))[::2])
+        # проверка у B и C и скачивание у C
+        self.assertEqual(3, a.neighbour_requests)
+        self.assertEqual((200, data), (await self.get(f'{self.url}/file'))[::2])
+        self.assertEqual(4, a.neighbour_requests)
+        self.assertEqual({'hits': 1, 'misses': 1, 'entries': 1, 'size': 1}, (await self.stats('A'))['location'])
+
+        # файл переехал: запомненный сосед не отвечает, и поиск идет заново
+        os.rename(os.path.join(self.directories['C'].name, 'file'), os.path.join(self.directories['B'].name, 'file'))
+        self.assertEqual((200, data), (await self.get(f'{self.url}/file'))[::2])
+        self.assertEqual(4 + 1 + 3, a.neighbour_requests)
+        self.assertEqual('B', a.location_cache.get('file').name)
+
+    async def test_content_cache(self):
+        self.put('A', 'small', b'old')
+        self.assertEqual((200, b'old'), (await self.get(f'{self.url}/small'))[::2])
+        self.put('A', 'small', b'new')
+        # до content_ttl маленький файл отдается из памяти
+        self.assertEqual((200, b'old'), (await self.get(f'{self.url}/small'))[::2])
+        self.assertEqual({'hits': 1, 'misses': 1, 'entries': 1, 'size': 3}, (await self.stats('A'))['content'])
+        await asyncio.sleep(0.25)
+        self.assertEqual((200, b'new'), (await self.get(f'{self.url}/small'))[::2])
+
+        big = os.urandom(2**17)
+        self.put('A', 'big', big)
+        self.assertEqual((200, big), (await self.get(f'{self.url}/big'))[::2])
+        self.assertEqual(['small'], list(self.servers['A'].content_cache.items))
+
+
+class PlacementTest(MeshTestCase):
+    options = {'placement': PlacementConfig(replicas=1)}
+
+    async def test_lookup_goes_through_owner(self):
+        # Файл лежит на C, владелец имени - B: A пересылает запрос B, B находит
+        # файл у C, сохраняет его у себя и отдает A.
+        file_name = next(f'file{i}' for i in range(1000) if self.servers['A'].owners(f'file{i}') == ['B'])
+        self.put('C', file_name, b'data')
+        status, _, body = await self.get(f'{self.url}/{file_name}')
+        self.assertEqual((200, b'data'), (status, body))
+
+        self.assertEqual(1, self.servers['A'].neighbour_requests)
+        # B переносит файл в хранилище, когда закончит отдавать его
+        for _ in range(100):
+            if os.listdir(self.directories['B'].name) == [file_name]:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual([file_name], os.listdir(self.directories['B'].name))
+        self.assertEqual([], os.listdir(self.directories['A'].name))
+
+
+class RangeTest(MeshTestCase):
+    names = 'AB'
+    options = {'cache': CacheConfig(content_size=2**20)}
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.data = bytes(range(256)) * 16
+        self.put('B', 'file', self.data)
+
+    async def check_range_and_revalidation(self, url):
+        status, headers, body = await self.get(url, Range='bytes=100-199')
+        self.assertEqual(206, status)
+        self.assertEqual(self.data[100:200], body)
+        self.assertEqual(f'bytes 100-199/{len(self.data)}', headers['Content-Range'])
+
+        status, headers, body = await self.get(url)
+        self.assertEqual((200, self.data), (status, body))
+        status, _, body = await self.get(url, **{'If-None-Match': headers['ETag']})
+        self.assertEqual((304, b''), (status, body))
+        status, _, _ = await self.get(url, **{'If-Modified-Since': headers['Last-Modified']})
+        self.assertEqual(304, status)
+
+    async def test_local_file(self):
+        # второй проход отдает файл из кэша содержимого с теми же валидаторами
+        for _ in range(2):
+            await self.check_range_and_revalidation(f'{self.urls["B"]}/file')
+
+    async def test_proxied_file(self):
+        await self.check_range_and_revalidation(f'{self.urls["A"]}/file')
+        self.assertEqual([], os.listdir(self.directories['A'].name))
+
+
+class ReplicaValidatorTest(MeshTestCase):
+    names = 'AB'
+    save_found = True
+
+    async def test_copy_has_origin_validators(self):
+        # У оригинала время изменения с долями секунды, а копия получает его из Last-Modified
+        data = os.urandom(2**17)
+        self.put('B', 'file', data)
+        os.utime(os.path.join(self.directories['B'].name, 'file'), ns=(1700000000123456789,) * 2)
+        _, origin, _ = await self.get(f'{self.urls["B"]}/file')
+        self.assertEqual((200, data), (await self.get(f'{self.url}/file'))[::2])
+        for _ in range(100):
+            if os.path.exists(os.path.join(self.directories['A'].name, 'file')):
+                break
+            await asyncio.sleep(0.01)
+
+        status, headers, _ = await self.get(f'{self.url}/file')
+        self.assertEqual(0, len(self.servers['A'].flights))
+        self.assertEqual((origin['ETag'], origin['Last-Modified']), (headers['ETag'], headers['Last-Modified']))
+        self.assertEqual(304, (await self.get(f'{self.url}/file', **{'If-None-Match': origin['ETag']}))[0])
+        self.assertEqual(412, (await self.get(f'{self.url}/file', **{'If-Match': '"other"'}))[0])
+        # докачка, начатая на B, продолжается на A
+        status, _, body = await self.get(f'{self.url}/file', Range='bytes=100-', **{'If-Range': origin['ETag']})
+        self.assertEqual((206, data[100:]), (status, body))
+        status, _, body = await self.get(f'{self.url}/file', Range='bytes=100-', **{'If-Range': '"old"'})
+        self.assertEqual((200, data), (status, body))
+
+
+class DedupTest(MeshTestCase):
+    names = 'AB'
+    save_found = True
+    options = {'dedup': True}
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.data = os.urandom(2**20)
+        self.put('B', 'one', self.data)
+        self.put('B', 'two', self.data)
+        # У имен с одним содержимым свое время изменения
+        self.mtimes = {'one': 1700000000, 'two': 1600000000}
+        for file_name, mtime in self.mtimes.items():
+            os.utime(os.path.join(self.directories['B'].name, file_name), (mtime, mtime))
+
+    def inode(self, name, file_name):
+        return os.stat(os.path.join(self.directories[name].name, file_name)).st_ino
+
+    async def validators(self, name, file_name):
+        _, headers, _ = await self.get(f'{self.urls[name]}/{file_name}')
+        return headers['ETag'], headers['Last-Modified']
+
+    async def check_second_name_is_linked(self):
+        a = self.servers['A']
+        origin = await self.validators('B', 'one')
+        status, _, body = await self.get(f'{self.url}/one')
+        self.assertEqual((200, self.data), (status, body))
+        self.assertEqual(len(self.data), a.neighbour_bytes)
+        # A переносит файл в хранилище, когда закончит отдавать его
+        for _ in range(100):
+            if os.path.exists(os.path.join(self.directories['A'].name, 'one')):
+                break
+            await asyncio.sleep(0.01)
+
+        # У B то же содержимое под другим именем: A узнает хеш и не скачивает файл повторно
+        status, headers, body = await self.get(f'{self.url}/two')
+        self.assertEqual((200, self.data), (status, body))
+        self.assertEqual(len(self.data), a.neighbour_bytes)
+        self.assertEqual(self.inode('A', 'one'), self.inode('A', 'two'))
+        self.assertEqual(self.inode('B', 'one'), self.inode('B', 'two'))
+        status, _, body = await self.get(f'{self.url}/{StaticServer.stats_endpoint}/blobs')
+        self.assertEqual({'names': 2, 'blobs': 1, 'bytes': len(self.data), 'logical_bytes': 2 * len(self.data)},
+                         json.loads(body))
+
+        # Ссылка на общий объект не меняет валидаторы других имен, и у каждого имени они как у оригинала
+        self.assertEqual(origin, await self.validators('B', 'one'))
+        for file_name, mtime in self.mtimes.items():
+            self.assertEqual(await self.validators('B', file_name), await self.validators('A', file_name))
+            self.assertEqual(mtime, a.blobs.mtime(file_name))
+        self.assertNotEqual(await self.validators('A', 'one'), await self.validators('A', 'two'))
+
+    async def test_hash_from_check(self):
+        await self.check_second_name_is_linked()
+
+    async def test_hash_from_download(self):
+        for server in self.servers.values():
+            server.config.skip_check = True
+        await self.check_second_name_is_linked()
+
+    async def test_index_is_appended(self):
+        await self.check_second_name_is_linked()
+        # Каждое имя дописывается в журнал строкой, а при запуске журнал сжимается
+        index_path = self.servers['A'].blobs.index_path
+        with open(index_path, 'a') as index_file:
+            index_file.write(json.dumps(['one'] + self.servers['A'].blobs.index['one']) + '\n["tw')
+        with open(index_path) as index_file:
+            self.assertEqual(4, len(index_file.readlines()))
+        blobs = BlobStore(self.directories['A'].name)
+        blobs.scan()
+        self.assertEqual(self.servers['A'].blobs.index, blobs.index)
+        with open(index_path) as index_file:
+            self.assertEqual(2, len(index_file.readlines()))
+
+
+class CompressionTest(MeshTestCase):
+    names = 'AB'
+    options = {'compression': CompressionConfig(encodings=('gzip', 'deflate'), hot_requests=1)}
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.data = b''.join(b'2024-01-01 00:00:%02d INFO request %d served\n' % (i % 60, i) for i in range(10000))
+        self.put('B', 'app.log', self.data)
+
+    async def wait_encoded(self, name, file_name):
+        path = os.path.join(self.directories[name].name, StaticServer.encoded_dir, file_name)
+        for _ in range(100):
+            if os.path.exists(path):
+                return
+            await asyncio.sleep(0.01)
+        self.fail(f'{path} was not created')
+
+    async def test_hot_file_is_served_compressed(self):
+        url = f'{self.urls["B"]}/app.log'
+        # Первый запрос отдает файл как есть и запускает сжатие
+        status, headers, body = await self.get(url)
+        self.assertEqual((200, self.data), (status, body))
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual('Accept-Encoding', headers['Vary'])
+        await self.wait_encoded('B', 'app.log.gz')
+
+        status, headers, body = await self.get(url)
+        self.assertEqual((200, self.data), (status, body))
+        self.assertEqual('gzip', headers['Content-Encoding'])
+        status, headers, body = await self.get(url, **{'Accept-Encoding': 'deflate'})
+        self.assertEqual(self.data, body)
+        self.assertNotIn('Content-Encoding', headers)
+        status, headers, body = await self.get(url, Range='bytes=0-9')
+        self.assertEqual((206, self.data[:10]), (status, body))
+        self.assertNotIn('Content-Encoding', headers)
+
+    async def test_neighbour_transfer_is_compressed(self):
+        await self.get(f'{self.urls["B"]}/app.log')
+        await self.wait_encoded('B', 'app.log.gz')
+
+        status, headers, body = await self.get(f'{self.url}/app.log')
+        self.assertEqual((200, self.data), (status, body))
+        self.assertLess(self.servers['A'].neighbour_bytes, len(self.data) / 5)
+
+
+class CachedCompressionTest(CompressionTest):
+    # Сжатые копии маленьких файлов отдаются из кэша содержимого
+    options = dict(CompressionTest.options, cache=CacheConfig(content_size=2**20))
+
+    async def test_compressed_copy_is_cached(self):
+        await self.test_hot_file_is_served_compressed()
+        self.assertIn(('app.log', 'gzip'), self.servers['B'].content_cache.items)
+        status, headers, body = await self.get(f'{self.urls["B"]}/app.log')
+        self.assertEqual((200, self.data, 'gzip'), (status, body, headers['Content-Encoding']))
+        self.assertEqual(StaticServer.content_type('app.log'), headers['Content-Type'])
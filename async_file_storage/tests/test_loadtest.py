@@ -0,0 +1,32 @@
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from loadtest import create_args_parser, load_test, compare, parse_size, parse_weights
+from tests.test_async_file_storage import free_port
+
+
+class LoadTestTest(IsolatedAsyncioTestCase):
+    async def test_small_mesh(self):
+        args = create_args_parser().parse_args([
+            '--shared-process', '--nodes', '3', '--port', str(free_port()), '--files', '5', '--sizes', '1k=1,64k=1',
+            '--requests', '100', '--warmup', '0', '--concurrency', '8'])
+        with tempfile.TemporaryDirectory() as root:
+            result = await load_test(root, args)
+        self.assertEqual(['local', 'neighbour', 'miss', 'total'], list(result['classes']))
+        self.assertEqual(100, result['classes']['total']['requests'])
+        self.assertEqual(0, result['classes']['total']['errors'])
+        self.assertEqual(['shared'], list(result['nodes']))
+        self.assertEqual([], compare(result, result, 0.0))
+
+
+class CompareTest(TestCase):
+    def test_regressions(self):
+        baseline = {'classes': {'local': {'throughput': 100, 'p99_ms': 10, 'errors': 0}},
+                    'nodes': {'A': {'rss': 1, 'peak': 2**20}}}
+        result = {'classes': {'local': {'throughput': 70, 'p99_ms': 11, 'errors': 0}},
+                  'nodes': {'A': {'rss': 1, 'peak': 2**21}}}
+        self.assertEqual(['local: throughput 70 < 100 req/s', 'A: peak RSS 2.0 > 1.0 MB'],
+                         compare(result, baseline, 0.2))
+
+    def test_parsing(self):
+        self.assertEqual([(1024, 3.0), (2**23, 1.0)], parse_weights('1k=3,8m', parse_size))
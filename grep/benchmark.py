@@ -0,0 +1,121 @@
+import argparse
+import os
+import random
+import resource
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grep.py')
+
+
+def generate_log(path, size, seed=0):
+    # Лог из блока строк, повторенного до нужного размера. Раз в блок попадается
+    # редкая строка, чтобы было что искать кроме частых совпадений.
+    rnd = random.Random(seed)
+    levels = ['INFO'] * 8 + ['WARNING', 'ERROR']
+    lines = [f'2024-05-01 12:{i // 60 % 60:02d}:{i % 60:02d} {rnd.choice(levels)} worker-{rnd.randrange(16)} '
+             f'request {rnd.randrange(10**6)} served in {rnd.random() * 100:.2f}ms\n' for i in range(100000)]
+    block = ''.join(lines).encode()
+    rare = b'2024-05-01 12:00:00 ERROR worker-0 connection timeout after 30s\n'
+    with open(path, 'wb') as file:
+        written = 0
+        while written < size:
+            chunk = (block + rare)[:size - written]
+            file.write(chunk)
+            written += len(chunk)
+
+
+def old_script(rev):
+    # Реализация из истории репозитория для сравнения
+    source = subprocess.run(['git', 'show', f'{rev}:grep/grep.py'], check=True, capture_output=True,
+                            cwd=os.path.dirname(SCRIPT)).stdout
+    file = tempfile.NamedTemporaryFile('wb', suffix='.py', delete=False)
+    with file:
+        file.write(source)
+    return file.name
+
+
+def root_revision():
+    return subprocess.run(['git', 'rev-list', '--max-parents=0', 'HEAD'], check=True, capture_output=True,
+                          text=True, cwd=os.path.dirname(SCRIPT)).stdout.split()[0]
+
+
+def available_memory():
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+
+
+def run(command, stdin_path=None, memory_limit=None):
+    # Время до первой строки вывода, общее время и пиковая память процесса
+    def limit():
+        if memory_limit:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    stdin = open(stdin_path, 'rb') if stdin_path else subprocess.DEVNULL
+    started = time.perf_counter()
+    proc = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            preexec_fn=limit)
+    first = proc.stdout.readline()
+    first_output = time.perf_counter() - started if first else None
+    lines = 1 if first else 0
+    for _ in proc.stdout:
+        lines += 1
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - started
+    if stdin_path:
+        stdin.close()
+    return {'ok': status == 0, 'elapsed': elapsed, 'first_output': first_output, 'lines': lines,
+            'peak': usage.ru_maxrss * 1024}
+
+
+def report(name, result):
+    if not result['ok']:
+        print(f'{name:<8} failed (out of memory?) after {result["elapsed"]:.1f} s, peak {result["peak"] / 2**20:.0f} MB')
+        return
+    first = f'{result["first_output"]:7.2f} s' if result['first_output'] is not None else '      -  '
+    print(f'{name:<8} {result["elapsed"]:7.2f} s   first line {first}   peak {result["peak"] / 2**20:8.1f} MB   '
+          f'{result["lines"]} lines')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare grep with an older version on a large file')
+    parser.add_argument('--size', type=float, default=5, help='Log size in GB')
+    parser.add_argument('--path', help='Log file, generated if it does not exist')
+    parser.add_argument('--old-rev', help='Revision of the old grep.py, the first commit by default')
+    parser.add_argument('--memory-limit', type=float, help='Address space limit for the old version in GB, '
+                                                           'available memory by default')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[os.cpu_count()],
+                        help='Also search the file with this many processes')
+    parser.add_argument('--no-old', action='store_true', help='Skip the old version and standard input')
+    parser.add_argument('patterns', nargs='*', default=["'connection timeout'", '-c ERROR', '-n -C2 timeout'],
+                        help='grep arguments, one quoted string per run')
+    args = parser.parse_args()
+
+    size = int(args.size * 2**30)
+    path = args.path or os.path.join(tempfile.gettempdir(), f'grep-bench-{size}.log')
+    if not os.path.exists(path) or os.path.getsize(path) != size:
+        generate_log(path, size)
+    old = old_script(args.old_rev or root_revision())
+    memory_limit = int(args.memory_limit * 2**30) if args.memory_limit else available_memory()
+    try:
+        for pattern in args.patterns:
+            print(f'grep {pattern} ({size / 2**30:.1f} GB)')
+            grep_args = shlex.split(pattern)
+            if not args.no_old:
+                report('old', run([sys.executable, old] + grep_args, path, memory_limit))
+                report('stdin', run([sys.executable, SCRIPT] + grep_args, path))
+            report('file', run([sys.executable, SCRIPT] + grep_args + [path]))
+            for jobs in args.jobs:
+                if jobs > 1:
+                    report(f'-j {jobs}', run([sys.executable, SCRIPT, '-j', str(jobs)] + grep_args + [path]))
+    finally:
+        os.remove(old)
+
+
+if __name__ == '__main__':
+    main()
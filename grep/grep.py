@@ -1,32 +1,72 @@
 import argparse
+import array
+import collections
+import itertools
+import mmap
+import multiprocessing
+import os
 import sys
 import re
 
+# Файл просматривается окнами такого размера, выровненными по концу строки. Страницы
+# пройденных окон отдаются системе, так что память процесса не растет с размером файла.
+SCAN_WINDOW = 2**24
+# Размер куска большого файла для параллельного режима
+PARALLEL_CHUNK = 2**26
+# "?" при поиске по байтам: символ UTF-8 целиком, без разрыва многобайтовой последовательности
+UTF8_CHAR = r'(?:[^\n\x80-\xff]|[\xc0-\xdf][\x80-\xbf]|[\xe0-\xef][\x80-\xbf]{2}|[\xf0-\xf7][\x80-\xbf]{3})'
+
 
 def output(line):
     print(line)
 
 
-def create_req(params):
-    params.pattern = re.sub('[?]', '.', params.pattern)
-    params.pattern = re.sub('[*]', '.*', params.pattern)
-    req = re.compile(params.pattern, re.I) if params.ignore_case else re.compile(params.pattern)
+def translate(pattern, any_char='.'):
+    pattern = re.sub('[*]', '.*', pattern)
+    return re.sub('[?]', lambda match: any_char, pattern)
+
+
+def binary_search(params):
+    # По байтам UTF-8 ищется только образец, который совпадает с ними так же, как со строкой:
+    # ASCII без -i (re.I для bytes не знает регистров не-ASCII букв), без . и [...], которые
+    # в байтах берут один байт, и без \w, \b, \d, \s и подобных, которые в байтах знают только
+    # ASCII. Остальные образцы проверяются по декодированным строкам.
+    if not params.pattern.isascii() or params.ignore_case:
+        return False
+    for escape, char in re.findall(r'(\\?)(.)', params.pattern, re.S):
+        if escape and (char == '?' or char.isalpha() and char not in 'ntrfvaAZ') or not escape and char in '.[':
+            return False
+    return True
+
+
+def create_req(params, binary=False):
+    if binary and binary_search(params):
+        # Поиск по байтам файла: ^ и $ привязаны к строкам, а не к файлу
+        return re.compile(translate(params.pattern, UTF8_CHAR).encode(), re.M)
+    pattern = translate(params.pattern)
+    req = re.compile(pattern, re.I) if params.ignore_case else re.compile(pattern)
     return req
 
 
-def str_format(params, idx, line, context_line):
+def str_format(params, idx, line, context_line, name=None):
     index = str(idx + 1) if params.line_number else ''
     if params.line_number:
         index += ':' if context_line else '-'
+    if name is not None:
+        index = name + (':' if context_line else '-') + index
     out_str = index + line
     return out_str
 
 
-def grep(lines, params):
+def context_size(params):
+    return max(params.before_context, params.context), max(params.context, params.after_context)
+
+
+def grep(lines, params, name=None):
+    # Строки обрабатываются по одной по мере чтения, в памяти только строки контекста
     req = create_req(params)
-    before_line = max(params.before_context, params.context)
-    after_line = max(params.context, params.after_context)
-    context_lines = []
+    before_line, after_line = context_size(params)
+    context_lines = collections.deque(maxlen=before_line)
     last_matched = -1 - after_line
 
     if params.count:
@@ -34,24 +74,351 @@ def grep(lines, params):
         for line in lines:
             if params.invert ^ bool(req.search(line)):
                 num_count += 1
-        output(str(num_count))
+        output(str(num_count) if name is None else f'{name}:{num_count}')
         return
 
     for idx, line in enumerate(lines):
         if params.invert ^ bool(req.search(line)):
-            for item in context_lines:
-                begin = 0 if idx - before_line < 0 else idx - before_line
-                output(str_format(params, begin, item, False))
+            for context_idx, item in context_lines:
+                output(str_format(params, context_idx, item, False, name))
             context_lines.clear()
-            output(str_format(params, idx, line, True))
+            output(str_format(params, idx, line, True, name))
             last_matched = idx
         else:
             if idx - last_matched <= after_line:
-                output(str_format(params, idx, line, False))
+                output(str_format(params, idx, line, False, name))
             elif before_line > 0:
-                context_lines.append(line)
-                if len(context_lines) > before_line:
-                    del context_lines[0]
+                context_lines.append((idx, line))
+
+
+def stream_lines(stream):
+    for line in stream:
+        yield line.rstrip('\n')
+
+
+def release(buf, start, stop):
+    # Страницы отображения отдаются системе: данные остаются в кэше страниц, а при
+    # повторном обращении (строки контекста) просто отображаются снова
+    if isinstance(buf, mmap.mmap) and hasattr(mmap, 'MADV_DONTNEED'):
+        start -= start % mmap.PAGESIZE
+        stop -= stop % mmap.PAGESIZE
+        if stop > start:
+            buf.madvise(mmap.MADV_DONTNEED, start, stop - start)
+
+
+def matching_lines(buf, req, lo=0, hi=None):
+    # (начало, конец) строк между lo и hi, где есть совпадение. Строки выделяются
+    # только вокруг найденного, остальной файл просматривает сам re. Совпадение,
+    # захватившее перевод строки (например, через \s), проверяется по своей строке
+    # отдельно. lo и hi - начала строк.
+    size = len(buf) if hi is None else hi
+    pos = lo
+    released = lo
+    while pos < size:
+        if pos - released >= SCAN_WINDOW:
+            release(buf, released, pos)
+            released = pos
+        stop = buf.find(b'\n', min(pos + SCAN_WINDOW, size), size)
+        if stop == -1:
+            stop = size
+        match = req.search(buf, pos, stop)
+        if match is None:
+            pos = stop + 1
+            continue
+        # Пустое совпадение за последним переводом строки - не строка файла
+        if match.start() == size and buf[size - 1:size] == b'\n':
+            return
+        start = buf.rfind(b'\n', 0, match.start()) + 1
+        end = buf.find(b'\n', match.start(), size)
+        if end == -1:
+            end = size
+        if match.end() <= end or req.search(buf[start:end]):
+            yield start, end
+        pos = end + 1
+
+
+def all_lines(buf, start, stop):
+    # Строки между start и stop по одной
+    released = start
+    while start < stop:
+        if start - released >= SCAN_WINDOW:
+            release(buf, released, start)
+            released = start
+        end = buf.find(b'\n', start, stop)
+        if end == -1:
+            end = stop
+        yield start, end
+        start = end + 1
+
+
+def decoded_lines(buf, req, invert, lo, hi):
+    # Строковый образец проверяется по каждой строке, декодированной так же, как при выводе
+    for start, end in all_lines(buf, lo, hi):
+        if invert ^ bool(req.search(buf[start:end].decode(errors='replace'))):
+            yield start, end
+
+
+def selected_lines(buf, req, invert, lo=0, hi=None):
+    hi = len(buf) if hi is None else hi
+    if isinstance(req.pattern, str):
+        yield from decoded_lines(buf, req, invert, lo, hi)
+        return
+    if not invert:
+        yield from matching_lines(buf, req, lo, hi)
+        return
+    pos = lo
+    for start, end in matching_lines(buf, req, lo, hi):
+        yield from all_lines(buf, pos, start)
+        pos = end + 1
+    yield from all_lines(buf, pos, hi)
+
+
+def count_newlines(buf, start, stop):
+    # Окнами, чтобы не копировать в память большие куски файла
+    count = 0
+    for window in range(start, stop, SCAN_WINDOW):
+        window_stop = min(window + SCAN_WINDOW, stop)
+        count += buf[window:window_stop].count(b'\n')
+        release(buf, window, window_stop)
+    return count
+
+
+def line_count(buf, lo=0, hi=None):
+    hi = len(buf) if hi is None else hi
+    if hi == lo:
+        return 0
+    return count_newlines(buf, lo, hi) + (buf[hi - 1:hi] != b'\n')
+
+
+class LineNumbers:
+    # Номер строки по смещению в файле (или от начала куска pos). Смещения запрашиваются
+    # по возрастанию, поэтому переводы строк считаются один раз от последнего известного места.
+    def __init__(self, buf, pos=0):
+        self.buf = buf
+        self.pos = pos
+        self.idx = 0
+
+    def __call__(self, pos):
+        self.idx += count_newlines(self.buf, self.pos, pos)
+        self.pos = pos
+        return self.idx
+
+
+def line_numbers(buf, params, lo=0):
+    # Номера строк считаются, только если они нужны для вывода
+    return LineNumbers(buf, lo) if params.line_number else lambda pos: 0
+
+
+def numbered(spans, line_idx):
+    for start, end in spans:
+        yield start, end, line_idx(start)
+
+
+def print_lines(buf, spans, params, name=None):
+    # Вывод выбранных строк (начало, конец, номер) с контекстом. Строки контекста
+    # находятся поиском переводов строк назад и вперед от выбранной, не дальше уже
+    # выведенного, а их номера отсчитываются от номера выбранной. Выведенное
+    # отдается системе так же, как при просмотре.
+    before_line, after_line = context_size(params)
+    printed = 0
+    released = 0
+    printed_idx = -1
+    after = 0
+
+    def emit(start, end, idx, matched):
+        output(str_format(params, idx, buf[start:end].decode(errors='replace'), matched, name))
+
+    for start, end, idx in spans:
+        while after and printed < start:
+            line_end = buf.find(b'\n', printed, start)
+            printed_idx += 1
+            emit(printed, line_end, printed_idx, False)
+            printed = line_end + 1
+            after -= 1
+        context_start = start
+        for _ in range(before_line):
+            if context_start <= printed:
+                break
+            context_start = buf.rfind(b'\n', printed, context_start - 1) + 1
+            if context_start == 0 and printed > 0:
+                context_start = printed
+        context = []
+        pos = context_start
+        while pos < start:
+            line_end = buf.find(b'\n', pos, start)
+            context.append((pos, line_end))
+            pos = line_end + 1
+        for i, (context_line_start, context_line_end) in enumerate(context):
+            emit(context_line_start, context_line_end, idx - len(context) + i, False)
+        emit(start, end, idx, True)
+        printed = end + 1
+        printed_idx = idx
+        after = after_line
+        if printed - released >= SCAN_WINDOW:
+            release(buf, released, printed)
+            released = printed
+    size = len(buf)
+    while after and printed < size:
+        line_end = buf.find(b'\n', printed)
+        if line_end == -1:
+            line_end = size
+        printed_idx += 1
+        emit(printed, line_end, printed_idx, False)
+        printed = line_end + 1
+        after -= 1
+
+
+def output_count(num_count, name):
+    output(str(num_count) if name is None else f'{name}:{num_count}')
+
+
+def grep_file(path, params, name=None):
+    # Файл отображается в память и просматривается как байты: память не растет с
+    # размером файла, а строки выводятся сразу по мере нахождения
+    with open(path, 'rb') as file:
+        try:
+            buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Пустой файл и то, что не отображается (каналы, устройства), читаются построчно
+            grep(stream_lines(line.decode(errors='replace') for line in file), params, name)
+            return
+        try:
+            req = create_req(params, binary=True)
+            if params.count:
+                num_count = sum(1 for _ in selected_lines(buf, req, False))
+                if params.invert:
+                    num_count = line_count(buf) - num_count
+                output_count(num_count, name)
+                return
+            spans = numbered(selected_lines(buf, req, params.invert), line_numbers(buf, params))
+            print_lines(buf, spans, params, name)
+        finally:
+            buf.close()
+
+
+def expand_paths(paths, recursive):
+    # С -r директории обходятся рекурсивно, файлы внутри - по порядку имен
+    for path in paths:
+        if recursive and os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for file_name in sorted(files):
+                    yield os.path.join(root, file_name)
+        else:
+            yield path
+
+
+def file_names(paths, params):
+    # Как у grep: при нескольких файлах или обходе директорий строки предваряются именем файла
+    paths = list(expand_paths(paths, params.recursive))
+    named = len(paths) > 1 or params.recursive
+    return [(path, path if named else None) for path in paths]
+
+
+def grep_path(path, params, name=None):
+    # Как у grep: ошибка открытия печатается в stderr, а остальные файлы просматриваются дальше
+    try:
+        grep_file(path, params, name)
+    except (FileNotFoundError, IsADirectoryError, PermissionError) as error:
+        print(f'grep: {path}: {error.strerror}', file=sys.stderr)
+        return False
+    return True
+
+
+def grep_paths(paths, params):
+    # False, если какой-то файл не удалось прочитать
+    if params.jobs != 1:
+        return grep_paths_parallel(paths, params)
+    ok = True
+    for path, name in file_names(paths, params):
+        ok = grep_path(path, params, name) and ok
+    return ok
+
+
+def split_file(path, chunk_size):
+    # Границы кусков по началам строк. Пустой файл - один пустой кусок, то, что нельзя
+    # отобразить в память, - None: его читает основной процесс.
+    if not os.path.isfile(path):
+        return None
+    size = os.path.getsize(path)
+    if size <= chunk_size:
+        return [(0, size)]
+    bounds = [0]
+    with open(path, 'rb') as file:
+        while bounds[-1] + chunk_size < size:
+            file.seek(bounds[-1] + chunk_size)
+            file.readline()
+            if file.tell() >= size:
+                break
+            bounds.append(file.tell())
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def grep_chunk(path, lo, hi, params):
+    # Работа процесса пула: выбранные строки куска плоским массивом (начало, конец,
+    # номер от начала куска), число строк куска для номеров следующих и счетчик для -c
+    spans = array.array('q')
+    if hi == lo:
+        return spans, 0, 0
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        req = create_req(params, binary=True)
+        if params.count:
+            num_count = sum(1 for _ in selected_lines(buf, req, False, lo, hi))
+            if params.invert:
+                num_count = line_count(buf, lo, hi) - num_count
+            return spans, 0, num_count
+        line_idx = line_numbers(buf, params, lo)
+        for span in numbered(selected_lines(buf, req, params.invert, lo, hi), line_idx):
+            spans.extend(span)
+        return spans, line_idx(hi), len(spans) // 3
+
+
+def ordered_results(pool, tasks, window):
+    # Результаты по порядку задач. Вперед считается не больше window кусков, чтобы
+    # память не росла, если вывод не успевает за пулом.
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(grep_chunk, task))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def grep_paths_parallel(paths, params):
+    # Большие файлы делятся на куски по границам строк, маленькие идут в пул целиком.
+    # Основной процесс собирает результаты по порядку: счетчики складываются, номера
+    # строк сдвигаются на число строк предыдущих кусков, а контекст выводится по всему
+    # файлу, поэтому не теряется на границах кусков.
+    jobs = params.jobs or os.cpu_count()
+    files = [(path, name, split_file(path, PARALLEL_CHUNK)) for path, name in file_names(paths, params)]
+    tasks = [(path, lo, hi, params) for path, _, chunks in files if chunks for lo, hi in chunks]
+    ok = True
+    with multiprocessing.Pool(jobs) as pool:
+        results = ordered_results(pool, tasks, jobs * 2)
+        for path, name, chunks in files:
+            if chunks is None:
+                ok = grep_path(path, params, name) and ok
+            elif params.count:
+                output_count(sum(num_count for _, _, num_count in itertools.islice(results, len(chunks))), name)
+            else:
+                chunk_results = itertools.islice(results, len(chunks))
+                with open(path, 'rb') as file:
+                    if chunks == [(0, 0)]:
+                        list(chunk_results)
+                        continue
+                    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                        print_lines(buf, merged_spans(chunk_results), params, name)
+    return ok
+
+
+def merged_spans(chunk_results):
+    base = 0
+    for spans, lines, _ in chunk_results:
+        for i in range(0, len(spans), 3):
+            yield spans[i], spans[i + 1], base + spans[i + 2]
+        base += lines
 
 
 def parse_args(args):
@@ -101,13 +468,31 @@ def parse_args(args):
         type=int,
         default=0,
         help='Print num lines of leading context before each match.')
+    parser.add_argument(
+        '-r',
+        action="store_true",
+        dest="recursive",
+        default=False,
+        help='Recursively search files in the given directories.')
+    parser.add_argument(
+        '-j',
+        action="store",
+        dest="jobs",
+        type=int,
+        default=1,
+        help='Search files with num processes, 0 for one per CPU.')
     parser.add_argument('pattern', action="store", help='Search pattern. Can contain magic symbols: ?*')
+    parser.add_argument('files', nargs='*', help='Files to search, standard input if none')
     return parser.parse_args(args)
 
 
 def main():
     params = parse_args(sys.argv[1:])
-    grep(sys.stdin.readlines(), params)
+    if params.files:
+        if not grep_paths(params.files, params):
+            sys.exit(2)
+    else:
+        grep(stream_lines(sys.stdin), params)
 
 
 if __name__ == '__main__':
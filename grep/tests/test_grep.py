@@ -1,5 +1,9 @@
 
-from unittest import TestCase
+import contextlib
+import io
+import os
+import tempfile
+from unittest import TestCase, mock
 
 import grep
 
@@ -143,3 +147,155 @@ class GrepLineNumbersTest(TestCase):
         params = grep.parse_args(['-n', '-C1', '???'])
         grep.grep(self.lines, params)
         self.assertEqual(lst, ['1-vr', '2:baab', '3:abbb', '4-fc', '5:bbb', '6-cc'])
+
+class GrepFileTest(TestCase):
+
+    lines = ['vr', 'baab', 'abbb', 'fc', 'bbb', 'cc']
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.write('lines.txt', '\n'.join(self.lines) + '\n')
+
+    def tearDown(self):
+        global lst
+        lst.clear()
+        self.directory.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(text)
+        return path
+
+    def assert_same_as_lines(self, args):
+        lst.clear()
+        grep.grep(self.lines, grep.parse_args(args))
+        expected = list(lst)
+        lst.clear()
+        grep.grep_file(self.path, grep.parse_args(args))
+        self.assertEqual(lst, expected)
+
+    def test_same_as_lines(self):
+        for args in (['ab'], ['-v', 'b'], ['-c', 'b'], ['-c', '-v', 'b'], ['-i', 'A'], ['-n', '-C1', 'aa'],
+                     ['-n', '-B2', 'fc'], ['-n', '-A1', '-B1', 'bbb'], ['-v', '-n', '-A1', 'b'], ['^b.*b$'],
+                     ['-n', '???']):
+            with self.subTest(args=args):
+                self.assert_same_as_lines(args)
+
+    def test_before_context_numbers(self):
+        grep.grep_file(self.path, grep.parse_args(['-n', '-B2', 'fc']))
+        self.assertEqual(lst, ['2-baab', '3-abbb', '4:fc'])
+
+    def test_last_line_without_newline(self):
+        path = self.write('tail.txt', 'a\nb')
+        grep.grep_file(path, grep.parse_args(['-n', 'b']))
+        self.assertEqual(lst, ['2:b'])
+
+    def test_empty_file(self):
+        path = self.write('empty.txt', '')
+        grep.grep_file(path, grep.parse_args(['-c', 'a']))
+        self.assertEqual(lst, ['0'])
+
+    def test_several_files(self):
+        other = self.write('other.txt', 'fc\n')
+        grep.grep_paths([self.path, other], grep.parse_args(['-n', '-A1', 'fc']))
+        self.assertEqual(lst, [f'{self.path}:4:fc', f'{self.path}-5-bbb', f'{other}:1:fc'])
+        lst.clear()
+        grep.grep_paths([self.path, other], grep.parse_args(['-c', 'b']))
+        self.assertEqual(lst, [f'{self.path}:3', f'{other}:0'])
+
+    def test_cyrillic(self):
+        # "?" - одна буква, а не один байт, и -i учитывает регистр кириллицы
+        self.lines = ['Привет, мир', 'пока', 'aжb', 'ПОКА мир', 'ab']
+        self.path = self.write('cyrillic.txt', '\n'.join(self.lines) + '\n')
+        for args in (['мир'], ['-i', 'пока'], ['-i', '-c', 'ПРИВЕТ'], ['-n', 'п?ка'], ['a?b'], ['-v', '-i', 'мИр'],
+                     ['-n', '-A1', '-i', 'привет'], ['^????$']):
+            with self.subTest(args=args):
+                self.assert_same_as_lines(args)
+        lst.clear()
+        grep.grep_file(self.path, grep.parse_args(['-i', 'пока']))
+        self.assertEqual(lst, ['пока', 'ПОКА мир'])
+        lst.clear()
+        grep.grep_file(self.path, grep.parse_args(['a?b']))
+        self.assertEqual(lst, ['aжb'])
+
+    def test_byte_classes_on_cyrillic(self):
+        # ., [...] и \w, \b, \d, \s по файлу совпадают с символами, а не с байтами UTF-8
+        self.lines = ['ёж', 'ab', 'Ёлка 12', 'x-ж', 'жж\tж', 'a.b', '№5', '']
+        self.path = self.write('classes.txt', '\n'.join(self.lines) + '\n')
+        patterns = ['^..$', '\\w', '\\W', '\\bж', 'ж\\b', '\\B', '\\d', '\\D$', '\\s', '^\\S+$', '[а-яё]',
+                    '[^a-z]', '^.?$', 'a\\.b', '^\\w*$', '^$', 'x?ж', '*ж*']
+        for pattern in patterns:
+            for args in ([pattern], ['-v', '-n', pattern], ['-c', pattern]):
+                with self.subTest(args=args):
+                    self.assert_same_as_lines(args)
+        lst.clear()
+        grep.grep_file(self.path, grep.parse_args(['^..$']))
+        self.assertEqual(lst, ['ёж', 'ab', '№5'])
+
+    def test_missing_and_directory(self):
+        missing = os.path.join(self.directory.name, 'missing.txt')
+        for jobs in ('1', '2'):
+            with self.subTest(jobs=jobs):
+                lst.clear()
+                stderr = io.StringIO()
+                with contextlib.redirect_stderr(stderr):
+                    ok = grep.grep_paths([missing, self.directory.name, self.path],
+                                         grep.parse_args(['-j', jobs, '-c', 'b']))
+                self.assertFalse(ok)
+                self.assertEqual(stderr.getvalue().splitlines(),
+                                 [f'grep: {missing}: No such file or directory',
+                                  f'grep: {self.directory.name}: Is a directory'])
+                self.assertEqual(lst, [f'{self.path}:3'])
+        self.assertTrue(grep.grep_paths([self.path], grep.parse_args(['b'])))
+
+class GrepParallelTest(TestCase):
+
+    lines = ['a%d' % i if i % 7 else 'match %d' % i for i in range(100)]
+
+    def setUp(self):
+        # Маленькие куски, чтобы совпадения и контекст попадали на их границы
+        self.chunk = grep.PARALLEL_CHUNK
+        grep.PARALLEL_CHUNK = 50
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = [os.path.join(self.directory.name, name) for name in ('one.txt', 'two.txt')]
+        for i, path in enumerate(self.paths):
+            with open(path, 'w') as file:
+                file.write('\n'.join(self.lines[i:]) + '\n')
+
+    def tearDown(self):
+        lst.clear()
+        grep.PARALLEL_CHUNK = self.chunk
+        self.directory.cleanup()
+
+    def run_grep(self, paths, args):
+        lst.clear()
+        grep.grep_paths(paths, grep.parse_args(args))
+        return list(lst)
+
+    def test_same_as_serial(self):
+        for args in (['match'], ['-n', 'match'], ['-n', '-C2', 'match'], ['-n', '-B3', '-A1', 'match'],
+                     ['-v', '-n', 'a'], ['-c', 'match'], ['-c', '-v', 'match']):
+            for paths in (self.paths[:1], self.paths):
+                with self.subTest(args=args, files=len(paths)):
+                    self.assertEqual(self.run_grep(paths, args + ['-j', '4']), self.run_grep(paths, args))
+
+    def test_decoded_search_uses_pool(self):
+        # -i и образцы, которые ищутся по декодированным строкам, тоже делятся на куски
+        for args in (['-i', 'MATCH'], ['-n', '-C1', 'match \\d'], ['-c', '-v', '^a.$']):
+            with self.subTest(args=args):
+                with mock.patch.object(grep, 'ordered_results', wraps=grep.ordered_results) as ordered:
+                    parallel = self.run_grep(self.paths, args + ['-j', '2'])
+                self.assertGreater(len(ordered.call_args.args[1]), len(self.paths))
+                self.assertEqual(parallel, self.run_grep(self.paths, args))
+
+    def test_count_is_aggregated(self):
+        self.assertEqual(self.run_grep(self.paths[:1], ['-j', '4', '-c', 'match']), ['15'])
+
+    def test_recursive(self):
+        nested = os.path.join(self.directory.name, 'nested')
+        os.mkdir(nested)
+        with open(os.path.join(nested, 'three.txt'), 'w') as file:
+            file.write('match\n')
+        self.assertEqual(self.run_grep([self.directory.name], ['-r', '-j', '2', '-c', 'match']),
+                         [f'{self.paths[0]}:15', f'{self.paths[1]}:14', f'{nested}/three.txt:1'])
@@ -0,0 +1,44 @@
+import weakref
+
+
+class Segment(bytearray):
+    # У bytearray нет слабых ссылок, а по ним отслеживается освобождение сегмента
+    __slots__ = ('__weakref__',)
+
+
+class PayloadArena:
+    # Маленькие данные заданий складываются подряд в общие сегменты, а не хранятся
+    # отдельными объектами bytes. Сегмент освобождается вместе с последним заданием,
+    # которое на него ссылается.
+    segment_size = 2**18
+    max_inline = 2**14
+
+    def __init__(self, budget=None):
+        # Бюджет памяти платит за каждый живой сегмент целиком: одно маленькое
+        # задание держит в памяти весь свой сегмент.
+        self.budget = budget
+        self.segment = None
+        self.used = 0
+
+    def store(self, data):
+        length = len(data)
+        if length > self.max_inline:
+            return (data if isinstance(data, (bytes, bytearray)) else bytes(data)), 0
+        if self.segment is None or self.used + length > len(self.segment):
+            self.segment = self.adopt(Segment(self.segment_size))
+            self.used = 0
+        offset = self.used
+        self.segment[offset:offset + length] = data
+        self.used += length
+        return self.segment, offset
+
+    def adopt(self, segment):
+        # Сегмент, созданный здесь или загруженный из снимка, учитывается в бюджете до своего освобождения
+        if self.budget is not None:
+            self.budget.charge(len(segment))
+            weakref.finalize(segment, self.budget.charge, -len(segment))
+        return segment
+
+    @staticmethod
+    def owns(buffer):
+        return isinstance(buffer, Segment)
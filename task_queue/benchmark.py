@@ -0,0 +1,524 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+
+def start_server(port, *server_args):
+    path = os.path.join(tempfile.mkdtemp(), 'db.pickle')
+    proc = subprocess.Popen([sys.executable, 'server.py', '-i', '127.0.0.1', '-p', str(port), '-c', path,
+                             *server_args], stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return proc
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError('Server did not start')
+
+
+def stop_server(proc):
+    proc.terminate()
+    proc.wait()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def report(name, commands, elapsed, latencies):
+    print(f'{name:<24} {commands / elapsed:>12.0f} cmd/s   '
+          f'p50 {percentile(latencies, 0.5) * 1000:8.3f} ms   p99 {percentile(latencies, 0.99) * 1000:8.3f} ms')
+
+
+async def single_shot_client(port, commands, latencies):
+    for command in commands:
+        started = time.perf_counter()
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(command)
+                await reader.read()
+                writer.close()
+                break
+            except ConnectionError:
+                # серверу с listen(1) при перегрузке случается сбросить соединение
+                continue
+        latencies.append(time.perf_counter() - started)
+
+
+async def persistent_client(port, commands, latencies, depth):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    for start in range(0, len(commands), depth):
+        batch = commands[start:start + depth]
+        started = time.perf_counter()
+        writer.write(b''.join(command + b'\n' for command in batch))
+        for _ in batch:
+            await reader.readline()
+        latencies.extend([time.perf_counter() - started] * len(batch))
+    writer.close()
+
+
+def load_commands(client_id, count):
+    queue = b'q%d' % client_id
+    commands = []
+    while len(commands) < count:
+        commands += [b'ADD ' + queue + b' 5 12345', b'GET ' + queue]
+    return commands[:count]
+
+
+def add_commands(client_id, count):
+    return [b'ADD q%d 5 12345' % client_id] * count
+
+
+def run_load(port, clients, count, persistent, depth, commands=load_commands):
+    async def main():
+        latencies = []
+        if persistent:
+            workers = [persistent_client(port, commands(i, count), latencies, depth) for i in range(clients)]
+        else:
+            workers = [single_shot_client(port, commands(i, count), latencies) for i in range(clients)]
+        started = time.perf_counter()
+        await asyncio.gather(*workers)
+        return time.perf_counter() - started, latencies
+
+    return asyncio.run(main())
+
+
+def bench_load(args):
+    proc = start_server(args.port, '-b')
+    try:
+        elapsed, latencies = run_load(args.port, args.one_shot_clients, args.commands, False, 1)
+        report('blocking, one-shot', len(latencies), elapsed, latencies)
+    finally:
+        stop_server(proc)
+
+    proc = start_server(args.port)
+    try:
+        elapsed, latencies = run_load(args.port, args.one_shot_clients, args.commands, False, 1)
+        report('event loop, one-shot', len(latencies), elapsed, latencies)
+        elapsed, latencies = run_load(args.port, args.clients, args.commands, True, 1)
+        report('event loop, persistent', len(latencies), elapsed, latencies)
+        elapsed, latencies = run_load(args.port, args.clients, args.commands, True, args.depth)
+        report(f'event loop, pipeline {args.depth}', len(latencies), elapsed, latencies)
+    finally:
+        stop_server(proc)
+
+
+def bench_depth(args):
+    from server import TaskQueueServer
+
+    server = TaskQueueServer('127.0.0.1', args.port, os.path.join(tempfile.mkdtemp(), 'db.pickle'), 300)
+    depth = 0
+    print(f'{"depth":>10} {"GET us":>10} {"IN us":>10} {"ACK us":>10}')
+    for target in args.depths:
+        while depth < target:
+            server.add_cmd(b'ADD q 5 12345')
+            depth += 1
+        timings = []
+        replies = []
+        started = time.perf_counter()
+        for _ in range(args.ops):
+            replies.append(server.get_cmd(b'GET q').split(b' ', 1)[0])
+        timings.append(time.perf_counter() - started)
+        for name in (b'IN', b'ACK'):
+            started = time.perf_counter()
+            for task_id in replies:
+                server.handle_connection(name + b' q ' + task_id)
+            timings.append(time.perf_counter() - started)
+        depth -= args.ops
+        print(f'{target:>10} ' + ' '.join(f'{t / args.ops * 10**6:>10.2f}' for t in timings))
+
+
+def bench_priority(args):
+    from server import TaskQueueServer
+
+    # Для каждого вида очереди: ADD при заполнении до глубины, затем GET на этой глубине.
+    # У отложенных заданий время наступает сразу после заполнения, GET берет их из кучи.
+    print(f'{"depth":>10} {"kind":>10} {"ADD us":>10} {"GET us":>10}')
+    for target in args.depths:
+        for kind in ('fifo', 'priority', 'delayed'):
+            server = TaskQueueServer('127.0.0.1', args.port, os.path.join(tempfile.mkdtemp(), 'db.pickle'), 300)
+            now = time.time()
+            options = {'fifo': lambda i: None,
+                       'priority': lambda i: {b'priority': b'%d' % (i * 7919 % 100)},
+                       'delayed': lambda i: {b'not_before': b'%f' % (now + 3600 + i % 1000)}}[kind]
+            started = time.perf_counter()
+            for i in range(target):
+                server.add_task(b'q', b'12345', options(i))
+            add_time = (time.perf_counter() - started) / target
+            server.promote_tasks(now + 7200)
+            started = time.perf_counter()
+            for _ in range(args.ops):
+                server.take_task(b'q')
+            get_time = (time.perf_counter() - started) / args.ops
+            print(f'{target:>10} {kind:>10} {add_time * 10**6:>10.2f} {get_time * 10**6:>10.2f}')
+
+
+def bench_metrics(args):
+    from server import TaskQueueServer
+
+    # Сначала сервер целиком, с сетью и конвейером команд.
+    rates = {}
+    for name, server_args in (('off', ['-M']), ('on', [])):
+        proc = start_server(args.port, *server_args)
+        try:
+            for _ in range(args.rounds):
+                elapsed, latencies = run_load(args.port, args.clients, args.load_commands, True, args.depth)
+                rates[name] = max(rates.get(name, 0), len(latencies) / elapsed)
+        finally:
+            stop_server(proc)
+        print(f'{"server, metrics " + name:<24} {rates[name]:>12.0f} cmd/s')
+    print(f'overhead {(1 - rates["on"] / rates["off"]) * 100:.1f}%')
+
+    # Затем только выполнение команд, без сети, поэтому доля метрик здесь больше.
+    commands = [b'ADD q 5 12345', b'GET q', b'IN q 0', b'ADD q 5 12345 priority=1', b'MGET q 2']
+    results = {}
+    for _ in range(args.rounds):
+        for metrics in (False, True):
+            server = TaskQueueServer('127.0.0.1', args.port, os.path.join(tempfile.mkdtemp(), 'db.pickle'), 300,
+                                     metrics=metrics)
+            started = time.perf_counter()
+            for _ in range(args.commands // len(commands)):
+                for command in commands:
+                    server.execute(command)
+            elapsed = time.perf_counter() - started
+            results[metrics] = min(results.get(metrics, elapsed), elapsed)
+    for metrics in (False, True):
+        print(f'{"in-process, metrics " + ("on" if metrics else "off"):<24} {args.commands / results[metrics]:>12.0f} cmd/s')
+    print(f'overhead {(results[True] / results[False] - 1) * 100:.1f}%')
+    started = time.perf_counter()
+    server.stats()
+    print(f'STATS with {len(server.queues)} queue: {(time.perf_counter() - started) * 1000:.3f} ms')
+
+
+def raw_cycle(port, queue, data):
+    # Так работают клиенты в тестах: новое соединение на каждую команду.
+    def call(command):
+        s = socket.create_connection(('127.0.0.1', port))
+        s.sendall(command)
+        reply = s.recv(2**20)
+        s.close()
+        return reply
+
+    call(b'ADD %s %d %s' % (queue, len(data), data))
+    task_id = call(b'GET ' + queue).split(b' ', 1)[0]
+    call(b'ACK %s %s' % (queue, task_id))
+
+
+def run_threads(concurrency, tasks, cycle):
+    import threading
+
+    latencies = []
+
+    def worker(number):
+        queue = b'c%d' % number
+        for _ in range(tasks // concurrency):
+            started = time.perf_counter()
+            cycle(queue)
+            latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, latencies
+
+
+async def run_coroutines(concurrency, tasks, cycle):
+    latencies = []
+
+    async def worker(number):
+        queue = b'c%d' % number
+        for _ in range(tasks // concurrency):
+            started = time.perf_counter()
+            await cycle(queue)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker(number) for number in range(concurrency)])
+    return time.perf_counter() - started, latencies
+
+
+def bench_client(args):
+    from client import Client, AsyncClient
+
+    data = b'x' * args.size
+    batch = args.batch
+
+    def sync_cycle(queue):
+        client.add(queue, data)
+        task_id, _ = client.get(queue)
+        client.ack(queue, task_id)
+
+    def pipeline_cycle(queue):
+        with client.pipeline() as pipe:
+            for _ in range(batch):
+                pipe.add(queue, data)
+            for _ in range(batch):
+                pipe.get(queue)
+        client.ack_many(queue, [task_id for task_id, _ in pipe.results[batch:]])
+
+    async def async_cycle(async_client, queue):
+        await async_client.add(queue, data)
+        task_id, _ = await async_client.get(queue)
+        await async_client.ack(queue, task_id)
+
+    async def async_batch_cycle(async_client, queue):
+        await async_client.add_many(queue, [data] * batch)
+        tasks = await async_client.get_many(queue, batch)
+        await async_client.ack_many(queue, [task_id for task_id, _ in tasks])
+
+    async def run_async(cycle, tasks):
+        async with AsyncClient(port=args.port, pool_size=args.pool_size, shards=args.shards) as async_client:
+            return await run_coroutines(args.concurrency, tasks, lambda queue: cycle(async_client, queue))
+
+    server_args = ['-n', str(args.shards)] if args.shards > 1 else []
+    proc = start_server(args.port, *server_args)
+    try:
+        # Один цикл - ADD, GET и ACK одного задания, в пакетных режимах - batch заданий.
+        elapsed, latencies = run_threads(min(args.concurrency, 16), args.tasks // 10,
+                                         lambda queue: raw_cycle(args.port, queue, data))
+        report('connection per command', 3 * len(latencies), elapsed, latencies)
+        client = Client(port=args.port, pool_size=args.concurrency, shards=args.shards)
+        elapsed, latencies = run_threads(args.concurrency, args.tasks, sync_cycle)
+        report('Client, threads', 3 * len(latencies), elapsed, latencies)
+        elapsed, latencies = run_threads(args.concurrency, args.tasks // batch, pipeline_cycle)
+        report(f'Client, pipeline {batch}', 3 * batch * len(latencies), elapsed, latencies)
+        client.close()
+        elapsed, latencies = asyncio.run(run_async(async_cycle, args.tasks))
+        report('AsyncClient', 3 * len(latencies), elapsed, latencies)
+        elapsed, latencies = asyncio.run(run_async(async_batch_cycle, args.tasks // batch))
+        report(f'AsyncClient, batch {batch}', 3 * batch * len(latencies), elapsed, latencies)
+    finally:
+        stop_server(proc)
+
+
+def bench_durability(args):
+    for name, server_args in (('durability off', []), ('durability on', ['-d'])):
+        proc = start_server(args.port, *server_args)
+        try:
+            elapsed, latencies = run_load(args.port, args.clients, args.commands, True, args.depth, add_commands)
+            report(f'ADD, {name}', len(latencies), elapsed, latencies)
+        finally:
+            stop_server(proc)
+
+
+async def text_payload_client(port, data, count):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=2**21)
+    for _ in range(count):
+        writer.write(b'ADD big %d %s\nGET big\n' % (len(data), data))
+        task_id = (await reader.readline()).rstrip(b'\n')
+        await reader.readexactly(len(task_id) + len(b' %d ' % len(data)) + len(data) + 1)
+    writer.close()
+
+
+async def binary_payload_client(port, data, count):
+    from server import request_header, response_header, BINARY_ADD, BINARY_GET
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'BINARY\n')
+    await reader.readline()
+    for _ in range(count):
+        writer.writelines([request_header.pack(BINARY_ADD, 3, 0, len(data)), b'big', data,
+                           request_header.pack(BINARY_GET, 3, 0, 0), b'big'])
+        for _ in range(2):
+            _, id_len, data_len = response_header.unpack(await reader.readexactly(response_header.size))
+            await reader.readexactly(id_len + data_len)
+    writer.close()
+
+
+def bench_payload(args):
+    proc = start_server(args.port)
+    try:
+        for size in args.sizes:
+            data = b'x' * size
+            for name, client in (('text', text_payload_client), ('binary', binary_payload_client)):
+                started = time.perf_counter()
+                asyncio.run(client(args.port, data, args.count))
+                elapsed = time.perf_counter() - started
+                print(f'{name:<8} {size:>8} B   {args.count / elapsed:>10.0f} ADD+GET/s   '
+                      f'{2 * size * args.count / elapsed / 2**20:>8.1f} MB/s')
+    finally:
+        stop_server(proc)
+
+
+async def polling_consumer(port, latencies, stats, long_poll, stop):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    command = b'GET lp timeout=1\n' if long_poll else b'GET lp\n'
+    while not stop.is_set():
+        writer.write(command)
+        reply = await reader.readline()
+        stats['gets'] += 1
+        if reply != b'NONE\n':
+            task_id, _, sent = reply.split()
+            latencies.append(time.perf_counter() - float(sent))
+            writer.write(b'ACK lp %s\n' % task_id)
+            await reader.readline()
+    writer.close()
+
+
+async def run_long_poll(port, consumers, tasks, interval, long_poll):
+    latencies = []
+    stats = {'gets': 0}
+    stop = asyncio.Event()
+    workers = [asyncio.ensure_future(polling_consumer(port, latencies, stats, long_poll, stop))
+               for _ in range(consumers)]
+    await asyncio.sleep(0.5)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    started = time.perf_counter()
+    for _ in range(tasks):
+        sent = b'%.6f' % time.perf_counter()
+        writer.write(b'ADD lp %d %s\n' % (len(sent), sent))
+        await reader.readline()
+        await asyncio.sleep(interval)
+    while len(latencies) < tasks:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await asyncio.gather(*workers)
+    writer.close()
+    return latencies, stats['gets'] / elapsed
+
+
+def bench_long_poll(args):
+    for name, long_poll in (('busy polling', False), ('long poll', True)):
+        proc = start_server(args.port)
+        try:
+            latencies, gets = asyncio.run(run_long_poll(args.port, args.consumers, args.tasks, args.interval,
+                                                        long_poll))
+            print(f'{name:<14} ADD->receipt p50 {percentile(latencies, 0.5) * 1000:8.3f} ms   '
+                  f'p99 {percentile(latencies, 0.99) * 1000:8.3f} ms   {gets:>10.0f} GET/s')
+        finally:
+            stop_server(proc)
+
+
+async def routed_client(port, shards, queue, count, depth, direct, latencies):
+    # direct - клиент сам идет на порт шарда-владельца очереди, иначе ее команды
+    # пересылает шард, которому ядро отдало соединение.
+    if direct and shards > 1:
+        port += 1 + zlib.crc32(queue) % shards
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    commands = [b'ADD ' + queue + b' 5 12345\nGET ' + queue + b'\n'] * (count // 2)
+    for start in range(0, len(commands), depth):
+        batch = commands[start:start + depth]
+        started = time.perf_counter()
+        writer.write(b''.join(batch))
+        for _ in range(2 * len(batch)):
+            await reader.readline()
+        latencies.extend([time.perf_counter() - started] * 2 * len(batch))
+    writer.close()
+
+
+def run_client_process(port, shards, process, clients, count, depth, direct):
+    async def main():
+        latencies = []
+        workers = [routed_client(port, shards, b'q%d-%d' % (process, i), count, depth, direct, latencies)
+                   for i in range(clients)]
+        started = time.perf_counter()
+        await asyncio.gather(*workers)
+        return time.perf_counter() - started, latencies
+
+    return asyncio.run(main())
+
+
+def bench_shards(args):
+    # Нагрузку создают несколько процессов, иначе упремся в один клиентский процесс, а не в сервер.
+    print(f'{multiprocessing.cpu_count()} cores')
+    for shards in args.shards:
+        proc = start_server(args.port, '-n', str(shards))
+        try:
+            for direct in (False, True):
+                with multiprocessing.Pool(args.processes) as pool:
+                    results = pool.starmap(run_client_process, [
+                        (args.port, shards, process, args.clients, args.commands, args.depth, direct)
+                        for process in range(args.processes)])
+                elapsed = max(elapsed for elapsed, _ in results)
+                latencies = [latency for _, part in results for latency in part]
+                report(f'{shards} shards, ' + ('direct' if direct else 'routed'), len(latencies), elapsed, latencies)
+        finally:
+            stop_server(proc)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Task queue server benchmarks')
+    parser.add_argument('-p', action="store", dest="port", type=int, default=5600, help='Port for the benchmarked server')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    load = subparsers.add_parser('load', help='Commands/sec and latency of the blocking and event loop engines')
+    load.add_argument('--clients', type=int, default=1000, help='Concurrent clients')
+    load.add_argument('--one-shot-clients', type=int, default=10,
+                      help='Concurrent clients opening a connection per command')
+    load.add_argument('--commands', type=int, default=200, help='Commands sent by every client')
+    load.add_argument('--depth', type=int, default=32, help='Pipeline depth of persistent clients')
+    load.set_defaults(func=bench_load)
+
+    depth = subparsers.add_parser('depth', help='Per-command cost of GET/IN/ACK as the queue grows')
+    depth.add_argument('--depths', type=int, nargs='+', default=[10**3, 10**4, 10**5, 10**6], help='Queue depths')
+    depth.add_argument('--ops', type=int, default=1000, help='Commands timed at every depth')
+    depth.set_defaults(func=bench_depth)
+
+    priority = subparsers.add_parser('priority', help='ADD/GET cost of FIFO, priority and delayed tasks by depth')
+    priority.add_argument('--depths', type=int, nargs='+', default=[10**3, 10**4, 10**5, 10**6], help='Queue depths')
+    priority.add_argument('--ops', type=int, default=1000, help='GET commands timed at every depth')
+    priority.set_defaults(func=bench_priority)
+
+    metrics = subparsers.add_parser('metrics', help='Cost of latency histograms and counters per command')
+    metrics.add_argument('--clients', type=int, default=100, help='Concurrent clients of the server')
+    metrics.add_argument('--load-commands', type=int, default=2000, help='Commands sent by every client')
+    metrics.add_argument('--depth', type=int, default=32, help='Pipeline depth of every client')
+    metrics.add_argument('--commands', type=int, default=200000, help='Commands executed in process in every round')
+    metrics.add_argument('--rounds', type=int, default=5, help='Rounds of every measurement, the fastest one is reported')
+    metrics.set_defaults(func=bench_metrics)
+
+    client = subparsers.add_parser('client', help='Client library modes against raw sockets')
+    client.add_argument('--concurrency', type=int, default=64, help='Threads or coroutines driving the server')
+    client.add_argument('--pool-size', type=int, default=4, help='Connections per port of AsyncClient')
+    client.add_argument('--tasks', type=int, default=20000, help='Tasks passed through ADD, GET and ACK')
+    client.add_argument('--batch', type=int, default=32, help='Tasks per pipeline or batch command')
+    client.add_argument('--size', type=int, default=100, help='Task size in bytes')
+    client.add_argument('--shards', type=int, default=1, help='Start the server with this many shards')
+    client.set_defaults(func=bench_client)
+
+    durability = subparsers.add_parser('durability', help='ADD throughput with and without the journal')
+    durability.add_argument('--clients', type=int, default=100, help='Concurrent clients')
+    durability.add_argument('--commands', type=int, default=1000, help='ADD commands sent by every client')
+    durability.add_argument('--depth', type=int, default=16, help='Pipeline depth of every client')
+    durability.set_defaults(func=bench_durability)
+
+    payload = subparsers.add_parser('payload', help='Text and binary protocol throughput by task size')
+    payload.add_argument('--sizes', type=int, nargs='+', default=[100, 10**4, 10**6], help='Payload sizes')
+    payload.add_argument('--count', type=int, default=200, help='ADD+GET pairs for every size')
+    payload.set_defaults(func=bench_payload)
+
+    long_poll = subparsers.add_parser('longpoll', help='ADD to consumer latency with busy polling and long poll')
+    long_poll.add_argument('--consumers', type=int, default=1000, help='Consumers waiting for tasks')
+    long_poll.add_argument('--tasks', type=int, default=500, help='Tasks added by the producer')
+    long_poll.add_argument('--interval', type=float, default=0.005, help='Pause between ADDs in seconds')
+    long_poll.set_defaults(func=bench_long_poll)
+
+    shards = subparsers.add_parser('shards', help='Throughput as the number of shard processes grows')
+    shards.add_argument('--shards', type=int, nargs='+',
+                        default=sorted({1, 2, 4, multiprocessing.cpu_count()}), help='Shard counts to measure')
+    shards.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='Client processes')
+    shards.add_argument('--clients', type=int, default=50, help='Connections opened by every client process')
+    shards.add_argument('--commands', type=int, default=2000, help='Commands sent by every connection')
+    shards.add_argument('--depth', type=int, default=32, help='ADD+GET pairs in flight on every connection')
+    shards.set_defaults(func=bench_shards)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    args.func(args)
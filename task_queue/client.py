@@ -0,0 +1,458 @@
+import asyncio
+import socket
+import threading
+import zlib
+from collections import deque
+from queue import LifoQueue
+
+from server import request_header, response_header
+from server import BINARY_ADD, BINARY_GET, BINARY_ACK, BINARY_IN, BINARY_SAVE, BINARY_TEXT
+from server import STATUS_OK, STATUS_NONE, STATUS_ERROR
+
+
+class TaskQueueError(Exception):
+    pass
+
+
+# Клиент говорит с сервером бинарным протоколом: ответы в нем сами сообщают свою длину,
+# поэтому их можно разбирать по мере прихода, не зная, на какую команду они.
+# Пакетные команды и STATS отправляются кадром BINARY_TEXT с текстом команды.
+
+max_frame = 10**6
+
+
+def encode_options(options):
+    return b' '.join(b'%s=%s' % (str(key).encode(), str(value).encode()) for key, value in options.items())
+
+
+def frame(op, queue=b'', options=b'', payload=b''):
+    return [request_header.pack(op, len(queue), len(options), len(payload)), queue, options, payload]
+
+
+def check(status, task_id, data):
+    if status == STATUS_ERROR:
+        raise TaskQueueError('Server replied ERROR')
+    return status, task_id, data
+
+
+def decode_add(reply):
+    return check(*reply)[1]
+
+
+def decode_get(reply):
+    status, task_id, data = check(*reply)
+    return None if status == STATUS_NONE else (task_id, data)
+
+
+def decode_flag(reply):
+    return check(*reply)[0] == STATUS_OK
+
+
+def decode_text(reply):
+    data = check(*reply)[2]
+    if data == b'ERROR':
+        raise TaskQueueError('Server replied ERROR')
+    return data
+
+
+def decode_lines(reply):
+    return decode_text(reply).split(b'\n')[1:]
+
+
+def decode_flags(reply):
+    return [line == b'YES' for line in decode_lines(reply)]
+
+
+def decode_tasks(reply):
+    # Ответ MGET: число заданий, затем "<id> <length> <data>", данные могут содержать переводы строк.
+    data = decode_text(reply)
+    count_end = data.index(b'\n') if b'\n' in data else len(data)
+    tasks = []
+    pos = count_end + 1
+    for _ in range(int(data[:count_end])):
+        id_end = data.index(b' ', pos)
+        length_end = data.index(b' ', id_end + 1)
+        end = length_end + 1 + int(data[id_end + 1:length_end])
+        tasks.append((data[pos:id_end], data[length_end + 1:end]))
+        pos = end + 1
+    return tasks
+
+
+def decode_none(reply):
+    check(*reply)
+
+
+def madd_frames(queue, items):
+    # Кадр ограничен 10^6 байт, поэтому большой пакет уходит несколькими MADD.
+    frames = []
+    chunk = []
+    size = 0
+    for data in items:
+        item = b'%d %s' % (len(data), data)
+        if chunk and size + len(item) + 64 + len(queue) > max_frame:
+            frames.append(chunk)
+            chunk, size = [], 0
+        chunk.append(item)
+        size += len(item) + 1
+    if chunk:
+        frames.append(chunk)
+    return [frame(BINARY_TEXT, payload=b'MADD %s %d %s' % (queue, len(chunk), b' '.join(chunk))) for chunk in frames]
+
+
+class Commands:
+    # Команды сервера в виде запросов (очередь, части кадров, разбор ответов); общие
+    # для синхронного и асинхронного клиентов и для конвейера.
+
+    def add_request(self, queue, data, **options):
+        return queue, [frame(BINARY_ADD, queue, encode_options(options), data)], decode_add
+
+    def get_request(self, queue, timeout=None):
+        options = b'timeout=%r' % timeout if timeout else b''
+        return queue, [frame(BINARY_GET, queue, options)], decode_get
+
+    def ack_request(self, queue, task_id):
+        return queue, [frame(BINARY_ACK, queue, payload=task_id)], decode_flag
+
+    def contains_request(self, queue, task_id):
+        return queue, [frame(BINARY_IN, queue, payload=task_id)], decode_flag
+
+    def save_request(self):
+        return None, [frame(BINARY_SAVE)], decode_none
+
+    def stats_request(self):
+        return None, [frame(BINARY_TEXT, payload=b'STATS')], decode_lines
+
+    def add_many_request(self, queue, items):
+        return queue, madd_frames(queue, items), decode_lines
+
+    def get_many_request(self, queue, count):
+        return queue, [frame(BINARY_TEXT, payload=b'MGET %s %d' % (queue, count))], decode_tasks
+
+    def ack_many_request(self, queue, task_ids):
+        return queue, [frame(BINARY_TEXT, payload=b'MACK %s %s' % (queue, b' '.join(task_ids)))], decode_flags
+
+
+def join_results(decode, replies):
+    # add_many может занять несколько кадров, их ответы складываются в один список.
+    if len(replies) == 1:
+        return decode(replies[0])
+    return [item for reply in replies for item in decode(reply)]
+
+
+class Connection:
+    def __init__(self, host, port, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile('rb')
+        self.sock.sendall(b'BINARY\n')
+        if self.file.readline() != b'OK\n':
+            raise TaskQueueError('Server does not support the binary protocol')
+
+    def send(self, frames):
+        self.sock.sendall(b''.join(part for parts in frames for part in parts))
+
+    def receive(self):
+        header = self.file.read(response_header.size)
+        if len(header) < response_header.size:
+            raise ConnectionError('Connection closed by server')
+        status, id_len, data_len = response_header.unpack(header)
+        body = self.file.read(id_len + data_len)
+        return status, body[:id_len], body[id_len:]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class Client(Commands):
+    # Синхронный клиент с пулом соединений, им можно пользоваться из нескольких потоков.
+    # shards - число шардов сервера, запущенного с -n: тогда команды очереди идут прямо
+    # на порт ее шарда, минуя пересылку (такие порты слушаются только на 127.0.0.1).
+
+    def __init__(self, host='127.0.0.1', port=5555, pool_size=8, timeout=None, shards=1):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.shards = shards
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def port_for(self, queue):
+        if queue is None or self.shards <= 1:
+            return self.port
+        return self.port + 1 + zlib.crc32(queue) % self.shards
+
+    def pool(self, port):
+        with self.lock:
+            pool = self.pools.get(port)
+            if pool is None:
+                pool = self.pools[port] = LifoQueue()
+                for _ in range(self.pool_size):
+                    pool.put(None)
+            return pool
+
+    def call(self, port, frames, count):
+        pool = self.pool(port)
+        connection = pool.get()
+        try:
+            if connection is None:
+                connection = Connection(self.host, port, self.timeout)
+            connection.send(frames)
+            replies = [connection.receive() for _ in range(count)]
+        except BaseException:
+            if connection is not None:
+                connection.close()
+            pool.put(None)
+            raise
+        pool.put(connection)
+        return replies
+
+    def request(self, queue, frames, decode):
+        return join_results(decode, self.call(self.port_for(queue), frames, len(frames)))
+
+    def add(self, queue, data, **options):
+        return self.request(*self.add_request(queue, data, **options))
+
+    def get(self, queue, timeout=None):
+        return self.request(*self.get_request(queue, timeout))
+
+    def ack(self, queue, task_id):
+        return self.request(*self.ack_request(queue, task_id))
+
+    def contains(self, queue, task_id):
+        return self.request(*self.contains_request(queue, task_id))
+
+    def save(self):
+        return self.request(*self.save_request())
+
+    def stats(self):
+        return self.request(*self.stats_request())
+
+    def add_many(self, queue, items):
+        return self.request(*self.add_many_request(queue, items))
+
+    def get_many(self, queue, count):
+        return self.request(*self.get_many_request(queue, count))
+
+    def ack_many(self, queue, task_ids):
+        return self.request(*self.ack_many_request(queue, task_ids))
+
+    def pipeline(self):
+        return Pipeline(self)
+
+    def close(self):
+        with self.lock:
+            pools, self.pools = self.pools, {}
+        for pool in pools.values():
+            while not pool.empty():
+                connection = pool.get_nowait()
+                if connection is not None:
+                    connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Pipeline(Commands):
+    # Команды копятся и уходят одной записью на соединение каждого шарда, ответы
+    # возвращаются списком в порядке команд:
+    #     with client.pipeline() as pipe:
+    #         pipe.add(b'q', b'data')
+    #         pipe.get(b'q')
+    #     task_id, task = pipe.results
+
+    def __init__(self, client):
+        self.client = client
+        self.requests = []
+        self.results = None
+
+    def __getattr__(self, name):
+        build = getattr(Commands, name + '_request', None)
+        if build is None:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.requests.append(build(self, *args, **kwargs))
+
+    def execute(self):
+        by_port = {}
+        for index, (queue, frames, decode) in enumerate(self.requests):
+            by_port.setdefault(self.client.port_for(queue), []).append((index, frames, decode))
+        results = [None] * len(self.requests)
+        for port, requests in by_port.items():
+            frames = [parts for _, request_frames, _ in requests for parts in request_frames]
+            replies = iter(self.client.call(port, frames, len(frames)))
+            for index, request_frames, decode in requests:
+                results[index] = join_results(decode, [next(replies) for _ in request_frames])
+        self.requests = []
+        self.results = results
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.execute()
+
+
+class AsyncConnection(asyncio.Protocol):
+    # Все корутины, которым досталось соединение, пишут в него сразу, а ответы
+    # раздаются ожидающим по порядку: так запросы конвейеризуются сами.
+
+    def __init__(self):
+        self.transport = None
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.handshake = True
+        self.closed = None
+
+    @classmethod
+    async def open(cls, host, port):
+        loop = asyncio.get_running_loop()
+        _, connection = await loop.create_connection(cls, host, port)
+        return connection
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.closed = asyncio.get_running_loop().create_future()
+        transport.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport.write(b'BINARY\n')
+
+    def send(self, frames):
+        if self.transport is None or self.transport.is_closing():
+            raise ConnectionError('Connection closed')
+        loop = asyncio.get_running_loop()
+        futures = []
+        for parts in frames:
+            future = loop.create_future()
+            self.pending.append(future)
+            futures.append(future)
+            self.transport.writelines(parts)
+        return futures
+
+    def data_received(self, data):
+        buffer = self.buffer
+        buffer += data
+        pos = 0
+        if self.handshake:
+            if len(buffer) < 3:
+                return
+            self.handshake = False
+            pos = 3
+        while len(buffer) - pos >= response_header.size:
+            status, id_len, data_len = response_header.unpack_from(buffer, pos)
+            start = pos + response_header.size
+            end = start + id_len + data_len
+            if end > len(buffer):
+                break
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_result((status, bytes(buffer[start:start + id_len]), bytes(buffer[start + id_len:end])))
+            pos = end
+        del buffer[:pos]
+
+    def connection_lost(self, exc):
+        self.transport = None
+        pending, self.pending = self.pending, deque()
+        for future in pending:
+            if not future.done():
+                future.set_exception(ConnectionError('Connection closed by server'))
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class AsyncClient(Commands):
+    # Асинхронный клиент: pool_size соединений на порт, запросы раскладываются по ним
+    # по кругу. GET с ожиданием держит соединение до ответа, поэтому получает свое
+    # соединение из отдельного пула.
+
+    def __init__(self, host='127.0.0.1', port=5555, pool_size=4, shards=1):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.shards = shards
+        self.pools = {}
+        self.idle = {}
+
+    port_for = Client.port_for
+
+    async def connection(self, port):
+        pool = self.pools.get(port)
+        if pool is None:
+            pool = self.pools[port] = {'connections': [None] * self.pool_size, 'next': 0, 'opening': {}}
+        index = pool['next']
+        pool['next'] = (index + 1) % self.pool_size
+        connection = pool['connections'][index]
+        if connection is None or connection.transport is None:
+            opening = pool['opening'].get(index)
+            if opening is None:
+                opening = pool['opening'][index] = asyncio.ensure_future(AsyncConnection.open(self.host, port))
+            try:
+                connection = pool['connections'][index] = await opening
+            finally:
+                pool['opening'].pop(index, None)
+        return connection
+
+    async def request(self, queue, frames, decode, blocking=False):
+        port = self.port_for(queue)
+        if blocking:
+            idle = self.idle.setdefault(port, [])
+            connection = idle.pop() if idle else await AsyncConnection.open(self.host, port)
+            try:
+                replies = await asyncio.gather(*connection.send(frames))
+            except BaseException:
+                connection.close()
+                raise
+            idle.append(connection)
+        else:
+            connection = await self.connection(port)
+            replies = await asyncio.gather(*connection.send(frames))
+        return join_results(decode, replies)
+
+    async def add(self, queue, data, **options):
+        return await self.request(*self.add_request(queue, data, **options))
+
+    async def get(self, queue, timeout=None):
+        return await self.request(*self.get_request(queue, timeout), blocking=bool(timeout))
+
+    async def ack(self, queue, task_id):
+        return await self.request(*self.ack_request(queue, task_id))
+
+    async def contains(self, queue, task_id):
+        return await self.request(*self.contains_request(queue, task_id))
+
+    async def save(self):
+        return await self.request(*self.save_request())
+
+    async def stats(self):
+        return await self.request(*self.stats_request())
+
+    async def add_many(self, queue, items):
+        return await self.request(*self.add_many_request(queue, items))
+
+    async def get_many(self, queue, count):
+        return await self.request(*self.get_many_request(queue, count))
+
+    async def ack_many(self, queue, task_ids):
+        return await self.request(*self.ack_many_request(queue, task_ids))
+
+    async def close(self):
+        connections = [connection for pool in self.pools.values() for connection in pool['connections'] if connection]
+        connections += [connection for idle in self.idle.values() for connection in idle]
+        self.pools, self.idle = {}, {}
+        for connection in connections:
+            connection.close()
+        await asyncio.gather(*(connection.closed for connection in connections))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,126 @@
+import os
+import re
+import struct
+import zlib
+
+ADD, GET, ACK, RELEASE, TIMEOUT, SCHEDULED_ADD, READY = range(1, 8)
+
+# приоритет и время, раньше которого задание не выдается, перед данными SCHEDULED_ADD
+schedule_header = struct.Struct('!qd')
+
+# crc32, операция, длины имени очереди, id задания и данных
+record_header = struct.Struct('!IBHHI')
+
+
+def segment_path(path, number):
+    return f'{path}.{number}.log'
+
+
+def list_segments(path):
+    directory = os.path.dirname(path) or '.'
+    pattern = re.compile(re.escape(os.path.basename(path)) + r'\.(\d+)\.log$')
+    numbers = []
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match:
+            numbers.append(int(match.group(1)))
+    return sorted(numbers)
+
+
+def encode_record(op, queue, task_id, data=b''):
+    body = struct.pack('!BHHI', op, len(queue), len(task_id), len(data)) + queue + task_id
+    crc = zlib.crc32(data, zlib.crc32(body))
+    return struct.pack('!I', crc) + body, data
+
+
+def read_segment(file_path):
+    with open(file_path, 'rb') as file:
+        content = file.read()
+    offset = 0
+    while offset + record_header.size <= len(content):
+        crc, op, queue_len, id_len, data_len = record_header.unpack_from(content, offset)
+        end = offset + record_header.size + queue_len + id_len + data_len
+        if end > len(content) or zlib.crc32(content[offset + 4:end]) != crc:
+            break
+        start = offset + record_header.size
+        queue = content[start:start + queue_len]
+        task_id = content[start + queue_len:start + queue_len + id_len]
+        data = content[start + queue_len + id_len:end]
+        yield op, queue, task_id, data
+        offset = end
+    if offset != len(content):
+        # хвост, недописанный при падении, отбрасываем
+        with open(file_path, 'r+b') as file:
+            file.truncate(offset)
+
+
+class Journal:
+    def __init__(self, path, sync_interval, loop=None):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.loop = loop
+        self.pending = []
+        self.waiters = []
+        self.sync_handle = None
+        self.file = None
+        self.segment = 0
+        self.size = 0
+
+    def open(self):
+        segments = list_segments(self.path)
+        self.segment = segments[-1] if segments else 0
+        self.file = open(segment_path(self.path, self.segment), 'ab')
+        self.size = self.file.tell()
+
+    def replay(self, first_segment):
+        for number in list_segments(self.path):
+            if number >= first_segment:
+                yield from read_segment(segment_path(self.path, number))
+
+    def append(self, op, queue, task_id, data=b''):
+        header, data = encode_record(op, queue, task_id, data)
+        self.pending.append(header)
+        if data:
+            self.pending.append(data)
+        self.size += len(header) + len(data)
+
+    def commit(self, callback):
+        # Групповая запись: ответы клиентам отправляются после одного общего fsync.
+        if not self.pending and not self.waiters:
+            callback()
+            return
+        self.waiters.append(callback)
+        if self.loop is None:
+            self.flush()
+        elif self.sync_handle is None:
+            self.sync_handle = self.loop.call_later(self.sync_interval, self.flush)
+
+    def flush(self):
+        if self.sync_handle is not None:
+            self.sync_handle.cancel()
+            self.sync_handle = None
+        if self.pending:
+            self.file.writelines(self.pending)
+            self.pending.clear()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        waiters, self.waiters = self.waiters, []
+        for callback in waiters:
+            callback()
+
+    def rotate(self):
+        self.flush()
+        self.file.close()
+        self.segment += 1
+        self.file = open(segment_path(self.path, self.segment), 'ab')
+        self.size = 0
+        return self.segment
+
+    def remove_segments(self, before):
+        for number in list_segments(self.path):
+            if number < before:
+                os.remove(segment_path(self.path, number))
+
+    def close(self):
+        self.flush()
+        self.file.close()
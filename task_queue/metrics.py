@@ -0,0 +1,95 @@
+import asyncio
+import time
+from collections import defaultdict
+
+
+# Гистограмма команды - список: корзина i считает команды, выполненные за
+# [2^(i-1), 2^i) единиц по 1024 нс, последний элемент - сумма времени в нс.
+# Запись - одно bit_length без поиска по границам.
+BUCKETS = 32
+
+
+def label(value):
+    return value.decode(errors='replace').replace('\\', '\\\\').replace('"', '\\"').encode()
+
+
+class Metrics:
+    def __init__(self, labels=b''):
+        # Метки всех рядов, например shard="1": в режиме -n по ним различаются шарды
+        self.labels = labels
+        self.started = time.time()
+        self.latency = {}
+        self.redelivered = defaultdict(int)
+
+    def observe(self, command, elapsed):
+        counts = self.latency.get(command)
+        if counts is None:
+            counts = self.latency[command] = [0] * (BUCKETS + 1)
+        bucket = (elapsed >> 10).bit_length()
+        counts[bucket if bucket < BUCKETS else BUCKETS - 1] += 1
+        counts[BUCKETS] += elapsed
+
+    def redelivery(self, queue_name):
+        self.redelivered[queue_name] += 1
+
+    def render(self, queues):
+        # Текстовый формат Prometheus: его же отдают STATS и HTTP.
+        now = time.time()
+        lines = [b'task_queue_uptime_seconds %.3f' % (now - self.started)]
+        for command, counts in sorted(self.latency.items()):
+            name = label(command)
+            cumulative = 0
+            last = max(bucket for bucket in range(BUCKETS) if counts[bucket])
+            for bucket in range(last + 1):
+                cumulative += counts[bucket]
+                lines.append(b'task_queue_command_seconds_bucket{command="%s",le="%g"} %d'
+                             % (name, 2 ** bucket * 1024 / 10**9, cumulative))
+            lines.append(b'task_queue_command_seconds_bucket{command="%s",le="+Inf"} %d' % (name, cumulative))
+            lines.append(b'task_queue_command_seconds_sum{command="%s"} %.6f' % (name, counts[BUCKETS] / 10**9))
+            lines.append(b'task_queue_command_seconds_count{command="%s"} %d' % (name, cumulative))
+        for name, queue in sorted(queues.items()):
+            ready = len(queue.ready) + len(queue.heap)
+            for state, count in ((b'ready', ready), (b'in_work', len(queue.in_work)),
+                                 (b'delayed', len(queue.delayed)),
+                                 (b'spilled', sum(len(segment) for segment in queue.spilled))):
+                lines.append(b'task_queue_tasks{queue="%s",state="%s"} %d' % (label(name), state, count))
+            lines.append(b'task_queue_oldest_task_age_seconds{queue="%s"} %.3f' % (label(name), oldest_age(queue, now)))
+            lines.append(b'task_queue_redelivered_total{queue="%s"} %d' % (label(name), self.redelivered[name]))
+        if self.labels:
+            lines = [with_labels(line, self.labels) for line in lines]
+        return lines
+
+
+def with_labels(line, labels):
+    series, _, value = line.rpartition(b' ')
+    if series.endswith(b'}'):
+        return b'%s,%s} %s' % (series[:-1], labels, value)
+    return b'%s{%s} %s' % (series, labels, value)
+
+
+def oldest_age(queue, now):
+    # Словарь заданий хранит порядок добавления, а в старших битах id - миллисекунды
+    # его добавления, поэтому возраст старейшего задания берется из первого ключа.
+    for task_id in queue.tasks:
+        return max(0.0, now - (task_id >> 22) / 1000)
+    return 0.0
+
+
+class MetricsEndpoint(asyncio.Protocol):
+    # Минимальный HTTP для сборщиков метрик: на любой запрос отдает render() и закрывает соединение.
+    def __init__(self, render):
+        self.render = render
+        self.transport = None
+        self.buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        if b'\r\n\r\n' not in self.buffer and b'\n\n' not in self.buffer:
+            return
+        body = b'\n'.join(self.render()) + b'\n'
+        self.transport.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                             b'Content-Length: %d\r\n\r\n' % len(body) + body)
+        self.transport.close()
@@ -1,113 +1,1317 @@
 import socket
 import argparse
+import asyncio
 import os
-import uuid
-import re
 import time
+import heapq
+import math
 import pickle
-from collections import defaultdict
+import struct
+import signal
+import shutil
+import zlib
+import multiprocessing
+from collections import deque, OrderedDict
+
+import journal
+from journal import Journal
+from arena import PayloadArena
+from metrics import Metrics, MetricsEndpoint
+from spill import MemoryBudget, SegmentReaper, SpillSegment
 
 
 class Task:
-    def __init__(self, length, data):
-        self.task_id = uuid.uuid4()
-        self.length = length
-        self.data = data
-        self.in_work = False
+    __slots__ = ('task_id', 'buffer', 'offset', 'length', 'deadline', 'priority')
+
+    def __init__(self, task_id, buffer, offset=0, length=None, priority=0):
+        self.task_id = task_id
+        self.buffer = buffer
+        self.offset = offset
+        self.length = len(buffer) if length is None else length
+        self.deadline = None
+        self.priority = priority
+
+    @property
+    def data(self):
+        if self.offset == 0 and self.length == len(self.buffer):
+            return self.buffer
+        return memoryview(self.buffer)[self.offset:self.offset + self.length]
+
+
+class TaskQueue:
+    # Сколько байт хвоста читается с диска за раз, когда голова очереди кончилась
+    refill_size = 2**20
+    budget = None
+    reaper = None
+
+    def __init__(self, name):
+        self.name = name
+        self.tasks = {}
+        # Обычные задания лежат в deque в порядке добавления. Задания с приоритетом,
+        # вернувшиеся по таймауту и дождавшиеся своего времени - в куче
+        # по (-приоритет, id).
+        self.ready = deque()
+        self.heap = []
+        self.delayed = {}
+        self.in_work = {}
+        self.timeout = None
+        # Хвост обычных заданий, вынесенный на диск сверх бюджета памяти: сегменты
+        # в порядке добавления, все задания в них новее заданий в ready.
+        self.spilled = deque()
+
+    def __len__(self):
+        return len(self.tasks) + sum(len(segment) for segment in self.spilled)
+
+    def __contains__(self, task_id):
+        return task_id in self.tasks or any(task_id in segment for segment in self.spilled)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('budget', None)
+        state.pop('reaper', None)
+        return state
+
+    def __setstate__(self, state):
+        # Снимки прежних версий: вернувшиеся по таймауту задания лежали в returned
+        # парами (id, задание), приоритетов и отложенных заданий не было.
+        returned = state.pop('returned', None)
+        if returned is not None:
+            for task in state['tasks'].values():
+                task.priority = 0
+            state['heap'] = [(0, task_id, task) for task_id, task in returned]
+            state['delayed'] = {}
+        state.setdefault('spilled', deque())
+        self.__dict__.update(state)
+
+    def has_ready(self):
+        return bool(self.ready or self.heap or self.spilled)
+
+    def charge(self, size):
+        if self.budget is not None:
+            self.budget.charge(size)
+
+    @staticmethod
+    def footprint(task):
+        # Данные из арены оплачены вместе с сегментом, остальные - своей длиной
+        return 0 if PayloadArena.owns(task.buffer) else task.length
+
+    def add(self, task):
+        self.tasks[task.task_id] = task
+        self.charge(self.footprint(task))
+        if task.priority:
+            heapq.heappush(self.heap, (-task.priority, task.task_id, task))
+        else:
+            self.ready.append(task)
+
+    def delay(self, task, not_before):
+        self.tasks[task.task_id] = task
+        self.charge(self.footprint(task))
+        self.delayed[task.task_id] = not_before
+
+    def promote(self, task_id):
+        if self.delayed.pop(task_id, None) is None:
+            return None
+        task = self.tasks[task_id]
+        heapq.heappush(self.heap, (-task.priority, task_id, task))
+        return task
+
+    def get(self, default_timeout):
+        # Из двух кандидатов выдается задание с большим приоритетом, при равном - более
+        # старое. Id заданий возрастают, поэтому служат и порядковым номером.
+        if not self.ready and self.spilled:
+            self.refill()
+        heap, ready = self.heap, self.ready
+        if heap and (not ready or heap[0][0] < 0 or (heap[0][0] == 0 and heap[0][1] < ready[0].task_id)):
+            task = heapq.heappop(heap)[2]
+        elif ready:
+            task = ready.popleft()
+        else:
+            return None
+        task.deadline = time.time() + (self.timeout or default_timeout)
+        self.in_work[task.task_id] = task
+        return task
+
+    def ack(self, task_id):
+        task = self.in_work.pop(task_id, None)
+        if task is None:
+            return False
+        del self.tasks[task_id]
+        self.charge(-self.footprint(task))
+        return True
+
+    def refill(self):
+        # Следующая порция хвоста копируется с диска в голову очереди, прочитанный
+        # до конца сегмент удаляется.
+        segment = self.spilled[0]
+        size = 0
+        for task_id, data in segment.read(self.refill_size):
+            task = self.tasks[task_id] = Task(task_id, data)
+            self.ready.append(task)
+            size += task.length
+        self.charge(size)
+        if not segment:
+            if self.reaper is not None:
+                self.reaper.remove(segment)
+            else:
+                segment.remove()
+            self.spilled.popleft()
+
+    def release(self, task_id):
+        task = self.in_work.pop(task_id)
+        task.deadline = None
+        heapq.heappush(self.heap, (-task.priority, task.task_id, task))
+        return task
+
+    def is_working(self, task_id, deadline):
+        task = self.in_work.get(task_id)
+        return task is not None and task.deadline == deadline
+
+    def expire(self, task_id, deadline):
+        if not self.is_working(task_id, deadline):
+            return None
+        return self.release(task_id)
+
+
+class RedeliveryScheduler:
+    # Сколько записей подтвержденных заданий терпим в куче, прежде чем ее чистить
+    min_stale = 1024
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.deadlines = []
+        self.stale = 0
+        self.loop = None
+        self.timer = None
+        self.timer_deadline = None
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, deadline, queue, task_id):
+        heapq.heappush(self.deadlines, (deadline, task_id, queue))
+        self.rearm(deadline)
+
+    def due(self, now):
+        # Записи о заданиях, подтвержденных или выданных заново, отбрасываются лениво.
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, task_id, queue = heapq.heappop(self.deadlines)
+            yield queue, task_id, deadline
+
+    def discard(self):
+        # Запись подтвержденного задания остается в куче до своего срока. Когда таких
+        # записей становится больше половины, куча пересобирается из заданий в работе:
+        # иначе при долгом таймауте она растет с каждым GET. Счетчик может завышать
+        # число мертвых записей, ушедших через due, но пересборка считает их точно.
+        self.stale += 1
+        if self.stale > max(len(self.deadlines) // 2, self.min_stale):
+            self.deadlines = [entry for entry in self.deadlines if entry[2].is_working(entry[1], entry[0])]
+            heapq.heapify(self.deadlines)
+            self.stale = 0
+
+    def next_deadline(self):
+        return self.deadlines[0][0] if self.deadlines else None
+
+    def start(self, loop):
+        self.loop = loop
+        self.arm()
+
+    def rearm(self, deadline):
+        if self.loop is not None and (self.timer is None or deadline < self.timer_deadline):
+            self.arm()
+
+    def arm(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        deadline = self.next_deadline()
+        if deadline is not None:
+            self.timer_deadline = deadline
+            self.timer = self.loop.call_later(max(0, deadline - time.time()), self.fire)
+
+    def fire(self):
+        self.timer = None
+        self.callback(time.time())
+        self.arm()
+
+
+class DelayWheel(RedeliveryScheduler):
+    # Отложенные задания раскладываются по слотам длиной tick секунд, добавление - O(1).
+    # Номера занятых слотов лежат в куче, так что пустые слоты не перебираются.
+    tick = 0.01
+
+    def __init__(self, callback):
+        super().__init__(callback)
+        self.slots = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, not_before, queue, task_id):
+        # слот не раньше not_before, чтобы задание не выдали до срока
+        slot = math.ceil(not_before / self.tick)
+        entries = self.slots.get(slot)
+        if entries is None:
+            entries = self.slots[slot] = []
+            heapq.heappush(self.deadlines, slot)
+            self.rearm(slot * self.tick)
+        entries.append((queue, task_id))
+        self.count += 1
+
+    def due(self, now):
+        while self.deadlines and self.deadlines[0] * self.tick <= now:
+            entries = self.slots.pop(heapq.heappop(self.deadlines))
+            self.count -= len(entries)
+            yield from entries
+
+    def next_deadline(self):
+        return self.deadlines[0] * self.tick if self.deadlines else None
+
+
+# операция, длины имени очереди, параметров (key=value через пробел) и данных задания
+request_header = struct.Struct('!BHHI')
+# статус, длины id задания и данных
+response_header = struct.Struct('!BHI')
+
+BINARY_ADD, BINARY_GET, BINARY_ACK, BINARY_IN, BINARY_SAVE, BINARY_TEXT = range(1, 7)
+STATUS_OK, STATUS_NONE, STATUS_NO, STATUS_ERROR = range(4)
+
+
+def parse_timeout(raw):
+    # nan и inf в дедлайнах ломают порядок кучи и отключают возврат заданий
+    timeout = float(raw)
+    if not math.isfinite(timeout) or timeout <= 0:
+        raise ValueError('Timeout must be a positive number of seconds')
+    return timeout
+
+
+def parse_options(raw):
+    # Необязательные параметры команды вида key=value после основных аргументов.
+    if not raw:
+        return {}
+    if not raw.startswith(b' '):
+        raise ValueError('Options must be separated by space')
+    return dict(option.split(b'=', 1) for option in raw.split())
+
+
+def read_token(buffer, pos):
+    end = buffer.find(b' ', pos)
+    if buffer.find(b'\n', pos, len(buffer) if end == -1 else end) != -1:
+        raise ValueError('Command ended before its payload')
+    if end == -1:
+        return None, -1
+    return bytes(buffer[pos:end]), end + 1
+
+
+def framed_end(buffer):
+    # Конец данных ADD/MADD, которые читаются по заявленной длине и поэтому могут
+    # содержать пробелы и переводы строк. None - команда без таких данных или
+    # некорректная, значение больше длины буфера - нужно дождаться еще байт.
+    try:
+        name, pos = read_token(buffer, 0)
+        if name is None or name.upper() not in (b'ADD', b'MADD'):
+            return None
+        _, pos = read_token(buffer, pos)
+        count = 1
+        if name.upper() == b'MADD' and pos != -1:
+            count, pos = read_token(buffer, pos)
+            count = int(count) if count is not None else 1
+        for idx in range(count):
+            if pos == -1:
+                return len(buffer) + 1
+            length, pos = read_token(buffer, pos)
+            if pos == -1:
+                return len(buffer) + 1
+            length = int(length)
+            if not 0 <= length <= 10**6:
+                return None
+            pos += length
+            if idx < count - 1:
+                if pos >= len(buffer):
+                    return pos + 1
+                if buffer[pos:pos + 1] != b' ':
+                    return None
+                pos += 1
+        return pos
+    except ValueError:
+        return None
+
+
+def split_command(buffer):
+    end = framed_end(buffer)
+    if end is not None and end > len(buffer):
+        return None, 0
+    end = buffer.find(b'\n', end or 0)
+    if end == -1:
+        return None, 0
+    return bytes(buffer[:end]), end + 1
+
+
+def send_reply(server, transport, parts, close=False):
+    # Пока журнал не сброшен на диск, ответы ждут общего fsync в порядке поступления.
+    def write():
+        if transport.is_closing():
+            return
+        transport.writelines(parts)
+        if close:
+            transport.close()
+
+    if server.journal is None:
+        write()
+    else:
+        server.journal.commit(write)
+
+
+class Forwarded(asyncio.Future):
+    # Ответ, который придет от шарда-владельца очереди. Соединение не ждет его
+    # и выполняет следующие команды, ответы на них отправляются после этого.
+    pass
+
+
+class ReplyQueue:
+    # Ответы соединения в порядке команд: готовые части ответов и ожидаемые Future.
+    def __init__(self, server, transport):
+        self.server = server
+        self.transport = transport
+        self.items = deque()
+        self.ready = []
+        self.closing = False
+
+    def add(self, parts):
+        if self.items:
+            self.items.append(parts)
+        else:
+            self.ready += parts
+
+    def add_future(self, future, render):
+        self.items.append((future, render))
+        if isinstance(future, Forwarded):
+            future.add_done_callback(self.flush)
+
+    def close(self):
+        self.closing = True
+        self.flush()
+
+    def flush(self, _=None):
+        items = self.items
+        while items:
+            item = items[0]
+            if isinstance(item, tuple):
+                future, render = item
+                if not future.done():
+                    break
+                if future.cancelled():
+                    items.clear()
+                    return
+                item = render(future.result())
+            items.popleft()
+            self.ready += item
+        close = self.closing and not items
+        if self.ready or close:
+            send_reply(self.server, self.transport, self.ready, close)
+            self.ready = []
+
+
+class TaskQueueProtocol(asyncio.Protocol):
+    legacy_grace = 0.05
+
+    def __init__(self, server, local=False):
+        self.server = server
+        self.local = local
+        self.transport = None
+        self.replies = None
+        self.buffer = bytearray()
+        self.persistent = None
+        self.legacy_timer = None
+        self.parked = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.replies = ReplyQueue(self.server, transport)
+
+    def connection_lost(self, exc):
+        if self.legacy_timer:
+            self.legacy_timer.cancel()
+        if self.parked is not None:
+            self.parked.cancel()
+
+    def data_received(self, data):
+        self.buffer += data
+        if self.persistent is None:
+            self.detect_mode()
+        elif self.persistent and self.parked is None:
+            self.process_pipeline()
+
+    def detect_mode(self):
+        # Старые клиенты шлют одну команду без перевода строки и ждут закрытия соединения.
+        # Режим понятен, когда первая команда пришла целиком, включая данные ADD/MADD.
+        if self.legacy_timer:
+            self.legacy_timer.cancel()
+            self.legacy_timer = None
+        end = framed_end(self.buffer)
+        if end is not None and end > len(self.buffer):
+            loop = asyncio.get_event_loop()
+            self.legacy_timer = loop.call_later(self.legacy_grace, self.reply_legacy)
+            return
+        if self.buffer.find(b'\n', end or 0) == -1:
+            self.reply_legacy()
+        else:
+            self.persistent = True
+            self.process_pipeline()
+
+    def reply(self, data, close=False):
+        send_reply(self.server, self.transport, [data], close)
+
+    @staticmethod
+    def render(reply):
+        return [reply, b'\n']
+
+    def process_pipeline(self):
+        replies = self.replies
+        while True:
+            command, consumed = split_command(self.buffer)
+            if not consumed:
+                break
+            del self.buffer[:consumed]
+            if command.strip().upper() == b'BINARY':
+                replies.add([b'OK\n'])
+                replies.flush()
+                self.switch_to_binary()
+                return
+            reply = self.server.execute(command, self.local)
+            if isinstance(reply, asyncio.Future):
+                replies.add_future(reply, self.render)
+                if not isinstance(reply, Forwarded):
+                    # GET с ожиданием: следующие команды соединения ждут его ответа
+                    self.park(reply)
+                    break
+            else:
+                replies.add([reply, b'\n'])
+        replies.flush()
+
+    def park(self, future, close=False):
+        self.parked = future
+        future.add_done_callback(lambda _: self.unpark(close))
+
+    def unpark(self, close):
+        future, self.parked = self.parked, None
+        if future.cancelled() or self.transport.is_closing():
+            return
+        if close:
+            self.reply(future.result(), close=True)
+            return
+        self.replies.flush()
+        self.process_pipeline()
+
+    def switch_to_binary(self):
+        protocol = BinaryTaskQueueProtocol(self.server, self.transport, self.local, self.replies)
+        self.transport.set_protocol(protocol)
+        protocol.buffer += self.buffer
+        self.buffer.clear()
+        protocol.process_frames()
+
+    def reply_legacy(self):
+        self.legacy_timer = None
+        self.persistent = False
+        reply = self.server.execute(bytes(self.buffer), self.local)
+        self.buffer.clear()
+        if isinstance(reply, asyncio.Future):
+            self.park(reply, close=True)
+        else:
+            self.reply(reply, close=True)
+
+
+class BinaryTaskQueueProtocol(asyncio.BufferedProtocol):
+    read_size = 2**16
+
+    def __init__(self, server, transport, local=False, replies=None):
+        self.server = server
+        self.transport = transport
+        self.local = local
+        # ответы текстовых команд, отправленных до BINARY, еще могут быть в пути
+        self.replies = replies or ReplyQueue(server, transport)
+        self.read_buffer = bytearray(self.read_size)
+        self.buffer = bytearray()
+        self.frame = None
+        self.payload = None
+        self.payload_view = None
+        self.filled = 0
+        self.parked = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.replies = ReplyQueue(self.server, transport)
+
+    def connection_lost(self, exc):
+        if self.parked is not None:
+            self.parked.cancel()
+
+    def get_buffer(self, sizehint):
+        # Данные задания читаются из сокета сразу в заранее выделенный буфер нужного размера.
+        if self.payload is not None:
+            return self.payload_view[self.filled:]
+        return self.read_buffer
+
+    def buffer_updated(self, nbytes):
+        if self.payload is None:
+            self.buffer += memoryview(self.read_buffer)[:nbytes]
+            if self.parked is None:
+                self.process_frames()
+            return
+        self.filled += nbytes
+        if self.filled == len(self.payload):
+            payload = self.payload
+            self.payload_view.release()
+            self.payload = self.payload_view = None
+            if self.respond(self.execute(*self.frame, payload)):
+                self.process_frames()
+            else:
+                self.replies.flush()
+
+    def respond(self, reply):
+        # False, если соединение встало ждать ответа GET с ожиданием
+        if not isinstance(reply, asyncio.Future):
+            self.replies.add(reply)
+            return True
+        self.replies.add_future(reply, self.render_result)
+        if isinstance(reply, Forwarded):
+            return True
+        self.parked = reply
+        reply.add_done_callback(self.unpark)
+        return False
+
+    def unpark(self, future):
+        self.parked = None
+        if future.cancelled() or self.transport.is_closing():
+            return
+        self.replies.flush()
+        self.process_frames()
+
+    def process_frames(self):
+        buffer = self.buffer
+        pos = 0
+        while len(buffer) - pos >= request_header.size:
+            op, queue_len, options_len, payload_len = request_header.unpack_from(buffer, pos)
+            if payload_len > 10**6:
+                self.replies.add([response_header.pack(STATUS_ERROR, 0, 0)])
+                self.replies.close()
+                buffer.clear()
+                return
+            queue_start = pos + request_header.size
+            head_end = queue_start + queue_len + options_len
+            if len(buffer) < head_end:
+                break
+            queue = bytes(buffer[queue_start:queue_start + queue_len])
+            options = bytes(buffer[queue_start + queue_len:head_end])
+            if len(buffer) - head_end >= payload_len:
+                pos = head_end + payload_len
+                if not self.respond(self.execute(op, queue, options, bytes(buffer[head_end:pos]))):
+                    break
+            else:
+                self.payload = bytearray(payload_len)
+                self.payload_view = memoryview(self.payload)
+                self.filled = len(buffer) - head_end
+                self.payload_view[:self.filled] = buffer[head_end:]
+                self.frame = (op, queue, options)
+                pos = len(buffer)
+                break
+        del buffer[:pos]
+        self.replies.flush()
+
+    def execute(self, op, queue, options, payload):
+        result = self.server.execute_binary(op, queue, options, payload, self.local)
+        if isinstance(result, asyncio.Future):
+            return result
+        return self.render(*result)
+
+    def render_result(self, result):
+        return self.render(*result)
+
+    @staticmethod
+    def render(status, task_id, data):
+        # id из ответа другого шарда уже приходит строкой байт
+        if task_id is None:
+            task_id = b''
+        elif isinstance(task_id, int):
+            task_id = b'%d' % task_id
+        return [response_header.pack(status, len(task_id), len(data)), task_id, data]
+
+
+class ShardLink(asyncio.Protocol):
+    # Постоянное соединение с другим шардом. Команды для его очередей пересылаются
+    # кадрами бинарного протокола, ответы приходят в порядке отправки.
+    connect_attempts = 40
+    connect_delay = 0.05
+
+    def __init__(self, loop, address):
+        self.loop = loop
+        self.address = address
+        self.transport = None
+        self.connecting = False
+        self.backlog = []
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.handshake = True
+
+    def send(self, op, queue, options=b'', payload=b''):
+        future = self.loop.create_future()
+        self.pending.append(future)
+        parts = [request_header.pack(op, len(queue), len(options), len(payload)), queue, options, payload]
+        if self.transport is not None:
+            self.transport.writelines(parts)
+        else:
+            self.backlog += parts
+            if not self.connecting:
+                self.connecting = True
+                self.loop.create_task(self.connect())
+        return future
+
+    async def connect(self):
+        # Соседние шарды запускаются одновременно с этим и могут еще не слушать порт.
+        for _ in range(self.connect_attempts):
+            try:
+                await self.loop.create_connection(lambda: self, *self.address)
+                return
+            except OSError:
+                await asyncio.sleep(self.connect_delay)
+        self.connecting = False
+        self.fail()
+
+    def connection_made(self, transport):
+        self.connecting = False
+        self.transport = transport
+        self.handshake = True
+        backlog, self.backlog = self.backlog, []
+        # кадры можно слать сразу за BINARY: сервер передаст их бинарному протоколу
+        transport.writelines([b'BINARY\n'] + backlog)
+
+    def data_received(self, data):
+        buffer = self.buffer
+        buffer += data
+        pos = 0
+        if self.handshake:
+            if len(buffer) < 3:
+                return
+            self.handshake = False
+            pos = 3
+        while len(buffer) - pos >= response_header.size:
+            status, id_len, data_len = response_header.unpack_from(buffer, pos)
+            start = pos + response_header.size
+            end = start + id_len + data_len
+            if end > len(buffer):
+                break
+            result = status, bytes(buffer[start:start + id_len]) or None, bytes(buffer[start + id_len:end])
+            pos = end
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_result(result)
+        del buffer[:pos]
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.buffer.clear()
+        self.fail()
+
+    def fail(self):
+        pending, self.pending = self.pending, deque()
+        self.backlog = []
+        for future in pending:
+            if not future.done():
+                future.set_result((STATUS_ERROR, None, b''))
 
 
 class TaskQueueServer:
-    def __init__(self, ip, port, path, timeout):
+    checkpoint_size = 64 * 2**20
+
+    def __init__(self, ip, port, path, timeout, blocking=False, durable=False, sync_interval=0.002,
+                 shards=1, shard=0, metrics=True, metrics_port=None, memory_budget=None):
         self.ip = ip
         self.port = port
         self.path = path
         self.timeout = timeout
+        self.blocking = blocking
+        self.shards = shards
+        self.shard = shard
+        self.links = {}
+        self.idle_links = {}
+        self.metrics = Metrics(b'shard="%d"' % shard if shards > 1 else b'') if metrics else None
+        self.metrics_port = metrics_port
+        self.journal = None
+        self.checkpoint_pid = None
+        self.checkpoint_segment = None
+        self.scheduler = RedeliveryScheduler(self.check_tasks_timeout)
+        self.delays = DelayWheel(self.promote_tasks)
+        self.loop = None
+        self.waiters = {}
+        self.commands = {b'add': self.add_cmd, b'get': self.get_cmd, b'ack': self.ack_cmd,
+                         b'in': self.check_task_cmd, b'save': self.save_cmd, b'madd': self.madd_cmd,
+                         b'mget': self.mget_cmd, b'mack': self.mack_cmd, b'stats': self.stats_cmd}
+        self.budget = MemoryBudget(int(memory_budget * 2**20)) if memory_budget else None
+        self.arena = PayloadArena(self.budget)
+        self.reaper = SegmentReaper()
+        # Вынесенные на диск хвосты восстанавливаются из снимка и журнала,
+        # поэтому файлы прошлого запуска не нужны.
+        self.spill_dir = path + '.spill'
+        self.spill_count = 0
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+        # 64-битные id: миллисекунды запуска в старших битах, чтобы id не повторялись после рестарта
+        self.next_task_id = int(time.time() * 1000) << 22
+        first_segment = 0
+        self.queues = {}
         if os.path.exists(path):
-            load_queues = pickle.load(open(path, 'rb'))
-            self.queues = load_queues['_queues']
-            self.tasks_in_work = load_queues['_tasks_in_work']
+            with open(path, 'rb') as snapshot:
+                load_queues = pickle.load(snapshot)
+                self.queues = load_queues['_queues']
+                segments = {}
+                for queue in self.queues.values():
+                    self.adopt_queue(queue, snapshot)
+                    segments.update((id(task.buffer), task.buffer) for task in queue.tasks.values()
+                                    if PayloadArena.owns(task.buffer))
+            first_segment = load_queues.get('_journal', 0)
+            self.next_task_id = max(self.next_task_id, load_queues.get('_next_task_id', 0))
+            # сегменты арены общие для очередей, каждый учитывается в бюджете один раз
+            for segment in segments.values():
+                self.arena.adopt(segment)
+        if durable:
+            self.journal = Journal(path, sync_interval)
+            self.replay_journal(first_segment)
+            self.journal.open()
+        for queue in self.queues.values():
+            for task in queue.in_work.values():
+                self.scheduler.schedule(task.deadline, queue, task.task_id)
+            for task_id, not_before in queue.delayed.items():
+                self.delays.schedule(not_before, queue, task_id)
+
+    def replay_journal(self, first_segment):
+        for op, name, task_id, data in self.journal.replay(first_segment):
+            queue = self.get_queue(name)
+            task_id = int.from_bytes(task_id, 'big')
+            if op == journal.ADD:
+                self.put_task(queue, task_id, data)
+                self.next_task_id = max(self.next_task_id, task_id + 1)
+            elif op == journal.SCHEDULED_ADD:
+                priority, not_before = journal.schedule_header.unpack_from(data)
+                data = data[journal.schedule_header.size:]
+                if not_before:
+                    queue.delay(Task(task_id, *self.arena.store(data), len(data), priority), not_before)
+                else:
+                    self.put_task(queue, task_id, data, priority)
+                self.next_task_id = max(self.next_task_id, task_id + 1)
+            elif op == journal.READY:
+                queue.promote(task_id)
+            elif op == journal.GET:
+                queue.get(self.timeout)
+            elif op == journal.ACK:
+                queue.ack(task_id)
+            elif op == journal.RELEASE:
+                queue.release(task_id)
+            elif op == journal.TIMEOUT:
+                queue.timeout = float(data)
+
+    def log(self, op, queue, task_id, data=b''):
+        if self.journal is not None:
+            self.journal.append(op, queue.name, task_id.to_bytes(8, 'big'), data)
+
+    def get_queue(self, name):
+        # Имя очереди хранится один раз в объекте TaskQueue, а не в каждой записи о задании.
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = self.queues[name] = TaskQueue(name)
+            queue.budget = self.budget
+            queue.reaper = self.reaper
+        return queue
+
+    def adopt_queue(self, queue, snapshot):
+        # Очередь из снимка: данные вынесенных хвостов лежат в снимке после самих
+        # очередей и частями переносятся обратно на диск, бюджет пересчитывается
+        # по оставшимся в памяти заданиям.
+        queue.budget = self.budget
+        queue.reaper = self.reaper
+        queue.charge(sum(queue.footprint(task) for task in queue.tasks.values()))
+        for segment in queue.spilled:
+            segment.restore(self.spill_path(), snapshot)
+
+    def spill_path(self):
+        if not self.spill_count:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        self.spill_count += 1
+        return os.path.join(self.spill_dir, '%d.spill' % self.spill_count)
+
+    @staticmethod
+    def parse_task_id(raw):
+        try:
+            return int(raw)
+        except ValueError:
+            return None
+
+    def add_task(self, name, data, options=None):
+        # Параметры проверяются и запись журнала собирается до изменения очереди:
+        # ошибка не должна оставить в ней задание, которого нет в журнале.
+        priority = not_before = 0
+        timeout = None
+        if options:
+            options = dict(options)
+            timeout = parse_timeout(options.pop(b'timeout')) if b'timeout' in options else None
+            priority = int(options.pop(b'priority', 0))
+            not_before = float(options.pop(b'not_before', 0))
+            if options:
+                raise ValueError('Unknown ADD options')
+            if not -2**63 <= priority < 2**63 or not math.isfinite(not_before):
+                raise ValueError('Priority or not_before out of range')
+            if not_before <= time.time():
+                not_before = 0
+        if priority or not_before:
+            op, record = journal.SCHEDULED_ADD, journal.schedule_header.pack(priority, not_before) + bytes(data)
+        else:
+            op, record = journal.ADD, data
+        queue = self.get_queue(name)
+        if timeout is not None and timeout != queue.timeout:
+            queue.timeout = timeout
+            self.log(journal.TIMEOUT, queue, 0, str(timeout).encode())
+        # В старших битах id - миллисекунды добавления, по ним считается возраст задания
+        task_id = max(self.next_task_id, int(time.time() * 1000) << 22)
+        self.next_task_id = task_id + 1
+        self.put_task(queue, task_id, data, priority, not_before)
+        self.log(op, queue, task_id, record)
+        if queue.name in self.waiters:
+            self.wake_waiters(queue)
+        return task_id
+
+    def put_task(self, queue, task_id, data, priority=0, not_before=0):
+        # Сверх бюджета памяти обычные задания дописываются в хвост на диске. Пока хвост
+        # не прочитан, туда же идут и все следующие, иначе нарушится порядок FIFO.
+        if not priority and not not_before and (
+                queue.spilled or (self.budget is not None and self.budget.exceeded(len(data)))):
+            if not queue.spilled or not queue.spilled[-1].writable():
+                if queue.spilled:
+                    queue.spilled[-1].seal()
+                queue.spilled.append(SpillSegment(self.spill_path()))
+            queue.spilled[-1].append(task_id, data)
+            return
+        task = Task(task_id, *self.arena.store(data), len(data), priority)
+        if not_before:
+            queue.delay(task, not_before)
+            self.delays.schedule(not_before, queue, task_id)
         else:
-            self.queues = defaultdict(list)
-            self.tasks_in_work = defaultdict(list)
+            queue.add(task)
+
+    def promote_tasks(self, now):
+        # Задания, дождавшиеся времени not_before, переходят в кучу готовых.
+        promoted = set()
+        for queue, task_id in self.delays.due(now):
+            if queue.promote(task_id):
+                self.log(journal.READY, queue, task_id)
+                promoted.add(queue)
+        for queue in promoted:
+            if queue.name in self.waiters:
+                self.wake_waiters(queue)
+        if promoted and self.journal is not None:
+            self.journal.commit(lambda: None)
+
+    def take_task(self, name):
+        queue = self.queues.get(name)
+        task = queue.get(self.timeout) if queue is not None else None
+        if task is not None:
+            self.log(journal.GET, queue, task.task_id)
+            self.scheduler.schedule(task.deadline, queue, task.task_id)
+        return task
+
+    def wait_task(self, name, timeout, render):
+        # Long-poll: если заданий нет, запрос ждет ADD или истечения таймаута.
+        task = self.take_task(name)
+        if task is not None or timeout <= 0 or self.loop is None:
+            return render(task)
+        future = self.loop.create_future()
+        waiters = self.waiters.setdefault(name, OrderedDict())
+        waiters[future] = render
+        timer = self.loop.call_later(timeout, self.stop_waiting, name, future)
+        future.add_done_callback(lambda _: self.forget_waiter(name, future, timer))
+        return future
+
+    def stop_waiting(self, name, future):
+        # Ожидающий мог быть разбужен в этой же итерации цикла, до отмены таймера.
+        if future.done():
+            return
+        render = self.waiters[name].pop(future)
+        future.set_result(render(None))
+
+    def forget_waiter(self, name, future, timer):
+        timer.cancel()
+        waiters = self.waiters.get(name)
+        if waiters is None:
+            return
+        waiters.pop(future, None)
+        if not waiters:
+            del self.waiters[name]
+
+    def wake_waiters(self, queue):
+        waiters = self.waiters.get(queue.name)
+        while waiters and queue.has_ready():
+            future, render = waiters.popitem(last=False)
+            # клиент отключился, а колбэк forget_waiter еще не успел убрать ожидающего
+            if not future.done():
+                future.set_result(render(self.take_task(queue.name)))
+
+    def ack_task(self, name, task_id):
+        queue = self.queues.get(name)
+        if queue is not None and queue.ack(task_id):
+            self.log(journal.ACK, queue, task_id)
+            self.scheduler.discard()
+            return True
+        return False
+
+    def has_task(self, name, task_id):
+        queue = self.queues.get(name)
+        return queue is not None and task_id in queue
+
+    def shard_of(self, name):
+        return zlib.crc32(name) % self.shards
+
+    def shard_address(self, shard):
+        # Кроме общего порта каждый шард слушает свой: port + 1 + номер шарда.
+        return '127.0.0.1', self.port + 1 + shard
+
+    def forward(self, shard, op, queue, options=b'', payload=b'', blocking=False):
+        # GET с ожиданием занимает соединение до ответа, поэтому для него берется
+        # отдельное соединение из пула, чтобы не задерживать остальные команды.
+        if not blocking:
+            link = self.links.get(shard)
+            if link is None:
+                link = self.links[shard] = ShardLink(self.loop, self.shard_address(shard))
+            return link.send(op, queue, options, payload)
+        idle = self.idle_links.setdefault(shard, [])
+        link = idle.pop() if idle else ShardLink(self.loop, self.shard_address(shard))
+        future = link.send(op, queue, options, payload)
+        future.add_done_callback(lambda _: idle.append(link))
+        return future
+
+    def relay(self, future, convert, blocking=False):
+        result = self.loop.create_future() if blocking else Forwarded(loop=self.loop)
+
+        def done(_):
+            if not result.done():
+                result.set_result(convert(future.result()))
+
+        future.add_done_callback(done)
+        return result
+
+    def save_all(self, render):
+        self.save_cmd(None)
+        futures = [self.forward(shard, BINARY_SAVE, b'') for shard in range(self.shards) if shard != self.shard]
+        return self.relay(asyncio.gather(*futures),
+                          lambda results: render(all(status == STATUS_OK for status, _, _ in results)))
+
+    def stats_all(self):
+        # STATS с общего порта собирает метрики всех шардов, а не только принявшего
+        # соединение. Строки шардов различаются меткой shard.
+        lines = self.stats()
+        futures = [self.forward(shard, BINARY_TEXT, b'', payload=b'STATS')
+                   for shard in range(self.shards) if shard != self.shard]
+
+        def merge(results):
+            merged = list(lines)
+            for status, _, reply in results:
+                if status != STATUS_OK:
+                    return b'ERROR'
+                merged += reply.split(b'\n')[1:]
+            return b'\n'.join([b'%d' % len(merged)] + merged)
+
+        return self.relay(asyncio.gather(*futures), merge)
+
+    def route(self, current_command, local):
+        # Команда для чужой очереди пересылается шарду-владельцу целиком, SAVE и STATS - всем шардам.
+        cmd_name, _, rest = current_command.partition(b' ')
+        cmd_name = cmd_name.strip().lower()
+        if cmd_name == b'save':
+            return None if local else self.save_all(lambda ok: b'OK' if ok else b'ERROR')
+        if cmd_name == b'stats':
+            return None if local else self.stats_all()
+        queue = rest.split(None, 1)[0] if rest.strip() else None
+        if cmd_name not in self.commands or queue is None or self.shard_of(queue) == self.shard:
+            return None
+        blocking = cmd_name == b'get' and b'timeout=' in rest
+        future = self.forward(self.shard_of(queue), BINARY_TEXT, b'', payload=current_command, blocking=blocking)
+        return self.relay(future, lambda result: result[2] if result[0] == STATUS_OK else b'ERROR', blocking)
 
     def add_cmd(self, current_command):
-        add_cmd_pattern = re.compile('(?P<method>.*) (?P<queue>.*) (?P<length>.*) (?P<data>.*)')
-        match = add_cmd_pattern.match(current_command.rstrip())
-        if not match:
-            return 'ERROR'
-        if int(match.group('length')) > 10**6 or int(match.group('length')) != len(match.group('data')):
-            return 'ERROR'
-        added_task = Task(match.group('length'), match.group('data'))
-        self.queues[match.group('queue')].append(added_task)
-        return str(added_task.task_id)
+        try:
+            _, queue, length, payload = current_command.rstrip(b'\r\n').split(b' ', 3)
+            length = int(length)
+            data, options = payload[:length], parse_options(payload[length:])
+            if length > 10**6 or length != len(data):
+                return b'ERROR'
+            return b'%d' % self.add_task(queue, data, options)
+        except (ValueError, OverflowError, struct.error):
+            return b'ERROR'
 
     def get_cmd(self, current_command):
-        get_cmd_pattern = re.compile('(?P<method>.*) (?P<queue>.*)')
-        match = get_cmd_pattern.match(current_command.rstrip())
-        if not match:
-            return 'ERROR'
-        res = 'NONE'
-        for task in self.queues[match.group('queue')]:
-            if not task.in_work:
-                res = f'{task.task_id} {task.length} {task.data}'
-                task.in_work = True
-                task.issue_time = time.time()
-                self.tasks_in_work[match.group('queue')].append(task)
-                break
-        return res
+        try:
+            _, queue, *options = current_command.split()
+            options = dict(option.split(b'=', 1) for option in options)
+            timeout = parse_timeout(options.pop(b'timeout')) if b'timeout' in options else 0
+        except ValueError:
+            return b'ERROR'
+        if options:
+            return b'ERROR'
+        return self.wait_task(queue, timeout, self.render_task)
+
+    @staticmethod
+    def render_task(task):
+        if task is None:
+            return b'NONE'
+        return b'%d %d %s' % (task.task_id, task.length, task.data)
 
     def ack_cmd(self, current_command):
-        ack_cmd_pattern = re.compile('(?P<method>.*) (?P<queue>.*) (?P<id>.*)')
-        match = ack_cmd_pattern.match(current_command.rstrip())
-        if not match:
-            return 'ERROR'
-        for task in self.queues[match.group('queue')]:
-            if str(task.task_id) == match.group('id'):
-                self.queues[match.group('queue')].remove(task)
-                self.tasks_in_work[match.group('queue')].remove(task)
-                return 'YES'
-        return 'NO'
+        try:
+            _, queue, task_id = current_command.split()
+        except ValueError:
+            return b'ERROR'
+        return b'YES' if self.ack_task(queue, self.parse_task_id(task_id)) else b'NO'
 
-    def check_task_cmd(self, current_command):
-        in_cmd_pattern = re.compile('(?P<method>.*) (?P<queue>.*) (?P<id>.*)')
-        match = in_cmd_pattern.match(current_command.rstrip())
-        if not match:
-            return 'ERROR'
-        res = 'NO'
-        for task in self.queues[match.group('queue')]:
-            if str(task.task_id) == match.group('id'):
-                res = 'YES'
+    def madd_cmd(self, current_command):
+        try:
+            _, queue, count, payload = current_command.rstrip(b'\r\n').split(b' ', 3)
+            count = int(count)
+            items = []
+            pos = 0
+            for _ in range(count):
+                length_end = payload.index(b' ', pos)
+                length = int(payload[pos:length_end])
+                data = payload[length_end + 1:length_end + 1 + length]
+                if length > 10**6 or length != len(data):
+                    return b'ERROR'
+                items.append(data)
+                pos = length_end + 2 + length
+        except ValueError:
+            return b'ERROR'
+        if count < 1 or pos != len(payload) + 1:
+            return b'ERROR'
+        task_ids = [b'%d' % self.add_task(queue, data) for data in items]
+        return b'%d\n' % len(task_ids) + b'\n'.join(task_ids)
+
+    def mget_cmd(self, current_command):
+        try:
+            _, queue, count = current_command.split()
+            count = int(count)
+        except ValueError:
+            return b'ERROR'
+        replies = []
+        for _ in range(count):
+            task = self.take_task(queue)
+            if task is None:
                 break
-        return res
+            replies.append(b'%d %d %s' % (task.task_id, task.length, task.data))
+        return b'\n'.join([b'%d' % len(replies)] + replies)
+
+    def mack_cmd(self, current_command):
+        try:
+            _, queue, *task_ids = current_command.split()
+        except ValueError:
+            return b'ERROR'
+        if not task_ids:
+            return b'ERROR'
+        replies = [b'YES' if self.ack_task(queue, self.parse_task_id(task_id)) else b'NO' for task_id in task_ids]
+        return b'\n'.join([b'%d' % len(replies)] + replies)
+
+    def check_task_cmd(self, current_command):
+        try:
+            _, queue, task_id = current_command.split()
+        except ValueError:
+            return b'ERROR'
+        return b'YES' if self.has_task(queue, self.parse_task_id(task_id)) else b'NO'
+
+    def stats_cmd(self, _):
+        lines = self.stats()
+        return b'\n'.join([b'%d' % len(lines)] + lines)
+
+    def stats(self):
+        if self.metrics is None:
+            return []
+        return self.metrics.render(self.queues)
 
     def save_cmd(self, _):
-        queues_to_save = {'_queues': self.queues, '_tasks_in_work': self.tasks_in_work}
-        pickle.dump(queues_to_save, open(self.path, 'wb'))
-        return 'OK'
+        if self.journal is None:
+            self.write_snapshot(self.path, 0)
+        else:
+            # Журнал уже содержит все изменения, поэтому снимок делается в фоне.
+            self.checkpoint()
+        return b'OK'
+
+    def write_snapshot(self, path, first_segment):
+        with open(path + '.tmp', 'wb') as file:
+            pickle.dump({'_queues': self.queues, '_journal': first_segment, '_next_task_id': self.next_task_id}, file)
+            # данные хвостов идут следом в том же порядке, в котором их читает adopt_queue
+            for queue in self.queues.values():
+                for segment in queue.spilled:
+                    segment.copy_to(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+
+    def checkpoint(self):
+        self.reap_checkpoint()
+        if self.checkpoint_pid is not None:
+            return
+        segment = self.journal.rotate()
+        if not hasattr(os, 'fork'):
+            self.write_snapshot(self.path, segment)
+            self.journal.remove_segments(segment)
+            return
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self.write_snapshot(self.path, segment)
+                status = 0
+            finally:
+                os._exit(status)
+        self.checkpoint_pid = pid
+        self.checkpoint_segment = segment
+        self.reaper.pin()
 
-    def check_tasks_timeout(self):
-        for queue in self.tasks_in_work.values():
-            for task in queue:
-                if time.time() - task.issue_time > self.timeout:
-                    task.in_work = False
-                    self.tasks_in_work[queue].remove(task)
+    def reap_checkpoint(self):
+        if self.checkpoint_pid is None:
+            return
+        pid, status = os.waitpid(self.checkpoint_pid, os.WNOHANG)
+        if pid == 0:
+            return
+        if status == 0:
+            self.journal.remove_segments(self.checkpoint_segment)
+        self.checkpoint_pid = None
+        self.reaper.unpin()
+
+    def close(self):
+        # Файлы сегментов хвоста и журнала закрываются при остановке сервера
+        for queue in self.queues.values():
+            for segment in queue.spilled:
+                segment.seal()
+        if self.journal is not None:
+            self.journal.close()
+
+    def check_tasks_timeout(self, now):
+        released = set()
+        for queue, task_id, deadline in self.scheduler.due(now):
+            if queue.expire(task_id, deadline):
+                self.log(journal.RELEASE, queue, task_id)
+                released.add(queue)
+                if self.metrics is not None:
+                    self.metrics.redelivery(queue.name)
+        for queue in released:
+            if queue.name in self.waiters:
+                self.wake_waiters(queue)
+        if released and self.journal is not None:
+            self.journal.commit(lambda: None)
+
+    def execute_binary(self, op, queue, options, payload, local=False):
+        if self.shards > 1:
+            if op == BINARY_SAVE and not local:
+                return self.save_all(lambda ok: (STATUS_OK if ok else STATUS_ERROR, None, b''))
+            if op not in (BINARY_SAVE, BINARY_TEXT) and self.shard_of(queue) != self.shard:
+                blocking = op == BINARY_GET and b'timeout=' in options
+                future = self.forward(self.shard_of(queue), op, queue, options, payload, blocking)
+                return self.relay(future, lambda result: result, blocking)
+        if op == BINARY_TEXT:
+            # текстовая команда, например пересланная другим шардом
+            reply = self.execute(bytes(payload), local)
+            if isinstance(reply, asyncio.Future):
+                return self.relay(reply, lambda result: (STATUS_OK, None, result), not isinstance(reply, Forwarded))
+            return STATUS_OK, None, reply
+        try:
+            options = parse_options(b' ' + options) if options else None
+            if op == BINARY_ADD:
+                return STATUS_OK, self.add_task(queue, payload, options), b''
+            if op == BINARY_GET:
+                timeout = parse_timeout(options.pop(b'timeout')) if options and b'timeout' in options else 0
+                if options:
+                    raise ValueError('Unknown GET options')
+                return self.wait_task(queue, timeout, self.render_binary_task)
+            if op == BINARY_ACK:
+                return (STATUS_OK if self.ack_task(queue, self.parse_task_id(payload)) else STATUS_NO), None, b''
+            if op == BINARY_IN:
+                return (STATUS_OK if self.has_task(queue, self.parse_task_id(payload)) else STATUS_NO), None, b''
+            if op == BINARY_SAVE:
+                self.save_cmd(None)
+                return STATUS_OK, None, b''
+        except Exception:
+            pass
+        return STATUS_ERROR, None, b''
+
+    @staticmethod
+    def render_binary_task(task):
+        if task is None:
+            return STATUS_NONE, None, b''
+        return STATUS_OK, task.task_id, task.data
 
     def handle_connection(self, current_command):
+        started = time.perf_counter_ns()
         try:
-            cmd_name, *args = current_command.split(' ')
+            cmd_name = current_command.split(b' ', 1)[0]
             if not cmd_name:
-                return 'RECV ERROR'
+                return b'RECV ERROR'
             cmd_name = cmd_name.strip().lower()
-            cmd = {'add': self.add_cmd, 'get': self.get_cmd, 'ack': self.ack_cmd,
-                   'in': self.check_task_cmd, 'save': self.save_cmd}.get(cmd_name)
+            cmd = self.commands.get(cmd_name)
             if not cmd:
-                return 'ERROR'
+                return b'ERROR'
             resp = cmd(current_command)
-        except Exception as e:
-            resp = e
+        except Exception:
+            resp = b'ERROR'
+        if self.metrics is not None:
+            self.metrics.observe(cmd_name, time.perf_counter_ns() - started)
+        return resp
+
+    def execute(self, current_command, local=False):
+        if self.shards > 1:
+            resp = self.route(current_command, local)
+            if resp is not None:
+                return resp
+        resp = self.handle_connection(current_command)
+        if self.checkpoint_pid is not None:
+            self.reap_checkpoint()
+        if self.journal is not None and self.journal.size > self.checkpoint_size:
+            self.checkpoint()
         return resp
 
     def run(self):
+        if self.blocking:
+            self.run_blocking()
+        else:
+            self.run_event_loop()
+
+    def run_event_loop(self):
+        print('Starting the server...')
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.loop = loop
+        if self.journal is not None:
+            self.journal.loop = loop
+        self.scheduler.start(loop)
+        self.delays.start(loop)
+        # Шарды слушают общий порт вместе (SO_REUSEPORT), ядро распределяет между ними соединения.
+        servers = [loop.run_until_complete(loop.create_server(
+            lambda: TaskQueueProtocol(self), self.ip, self.port, reuse_address=True, reuse_port=self.shards > 1,
+            backlog=4096))]
+        if self.shards > 1:
+            servers.append(loop.run_until_complete(loop.create_server(
+                lambda: TaskQueueProtocol(self, local=True), *self.shard_address(self.shard),
+                reuse_address=True, backlog=4096)))
+        if self.metrics_port:
+            # у каждого шарда свой порт метрик: metrics_port + номер шарда
+            servers.append(loop.run_until_complete(loop.create_server(
+                lambda: MetricsEndpoint(self.stats), '127.0.0.1', self.metrics_port + self.shard,
+                reuse_address=True)))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            print('Shutting down...')
+        finally:
+            for server in servers:
+                server.close()
+                loop.run_until_complete(server.wait_closed())
+            loop.close()
+            self.close()
+        print('Done')
+
+    def run_blocking(self):
         print('Starting the server...')
         connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -116,15 +1320,22 @@ class TaskQueueServer:
         while True:
             try:
                 current_connection, address = connection.accept()
-                command = (current_connection.recv(2**20)).decode('utf')
-                self.check_tasks_timeout()
-                res = self.handle_connection(command)
-                current_connection.send(res.encode('utf'))
-                current_connection.shutdown(1)
-                current_connection.close()
+                with current_connection:
+                    command = current_connection.recv(2**20)
+                    self.check_tasks_timeout(time.time())
+                    self.promote_tasks(time.time())
+                    res = self.execute(command)
+                    if self.journal is not None:
+                        self.journal.flush()
+                    current_connection.send(res)
+                    current_connection.shutdown(socket.SHUT_WR)
+            except OSError:
+                # клиент отключился, не дождавшись ответа; соединение уже закрыто
+                continue
             except KeyboardInterrupt:
                 print('Shutting down...')
                 connection.close()
+                self.close()
                 break
         print('Done')
 
@@ -159,10 +1370,83 @@ def parse_args():
         type=int,
         default=300,
         help='Task maximum GET timeout in seconds')
-    return parser.parse_args()
+    parser.add_argument(
+        '-b',
+        action="store_true",
+        dest="blocking",
+        default=False,
+        help='Serve one connection at a time instead of the event loop')
+    parser.add_argument(
+        '-d',
+        action="store_true",
+        dest="durable",
+        default=False,
+        help='Write every change to an append-only journal next to the checkpoint')
+    parser.add_argument(
+        '-s',
+        action="store",
+        dest="sync_interval",
+        type=float,
+        default=0.002,
+        help='Journal group commit interval in seconds')
+    parser.add_argument(
+        '-n',
+        action="store",
+        dest="shards",
+        type=int,
+        default=1,
+        help='Number of shard processes sharing the port, each owns a part of the queues')
+    parser.add_argument(
+        '-M',
+        action="store_false",
+        dest="metrics",
+        default=True,
+        help='Do not collect metrics')
+    parser.add_argument(
+        '-m',
+        action="store",
+        dest="metrics_port",
+        type=int,
+        default=None,
+        help='Serve metrics over HTTP on this local port')
+    parser.add_argument(
+        '-B',
+        action="store",
+        dest="memory_budget",
+        type=float,
+        default=None,
+        help='Memory budget for task data in MiB, longer queue tails are kept on disk')
+    args = parser.parse_args()
+    if args.shards > 1 and args.blocking:
+        parser.error('-n cannot be combined with -b')
+    return args
+
+
+def serve_shard(options, shard):
+    # У каждого шарда свои очереди, снимок и журнал, поэтому общих блокировок нет.
+    options = dict(options, path='%s.shard%d' % (options['path'], shard), shard=shard)
+    TaskQueueServer(**options).run()
+
+
+def run_shards(options):
+    processes = [multiprocessing.Process(target=serve_shard, args=(options, shard))
+                 for shard in range(options['shards'])]
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGTERM, lambda *_: [process.terminate() for process in processes])
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # Ctrl+C получают все процессы группы, шарды завершаются сами
+        for process in processes:
+            process.join()
 
 
 if __name__ == '__main__':
     args = parse_args()
-    server = TaskQueueServer(**args.__dict__)
-    server.run()
+    if args.shards > 1:
+        run_shards(args.__dict__)
+    else:
+        server = TaskQueueServer(**args.__dict__)
+        server.run()
@@ -0,0 +1,143 @@
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+
+# id задания и длина данных перед каждой записью сегмента
+record_header = struct.Struct('!QI')
+
+
+class MemoryBudget:
+    # Сколько байт данных заданий сейчас в памяти. Общий для всех очередей сервера.
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def charge(self, size):
+        self.used += size
+
+    def exceeded(self, size):
+        return self.used + size > self.limit
+
+
+class SegmentReaper:
+    # Удаляет прочитанные сегменты хвоста. Форк, пишущий снимок, копирует сегменты
+    # по путям, поэтому пока он работает, файлы только закрываются, а удаляются
+    # после его завершения. Общий для всех очередей сервера.
+    def __init__(self):
+        self.pinned = False
+        self.retired = []
+
+    def remove(self, segment):
+        if self.pinned:
+            segment.seal()
+            self.retired.append(segment)
+        else:
+            segment.remove()
+
+    def pin(self):
+        self.pinned = True
+
+    def unpin(self):
+        self.pinned = False
+        for segment in self.retired:
+            segment.remove()
+        self.retired.clear()
+
+
+class SpillSegment:
+    # Файл с частью хвоста очереди: записи (id, длина, данные) подряд. Пишется только
+    # в конец, читается с начала через mmap, после прочтения удаляется. Id в памяти
+    # хранятся массивом по 8 байт, чтобы IN работал без чтения файла.
+    max_size = 2**24
+
+    def __init__(self, path):
+        self.path = path
+        # Без буфера: в форке, пишущем снимок, не останется недописанных данных,
+        # которые закрытие файла допишет второй раз.
+        self.file = open(path, 'wb', buffering=0)
+        self.ids = array('Q')
+        self.size = 0
+        self.read_offset = 0
+        self.read_index = 0
+        self.data = None
+
+    def __len__(self):
+        return len(self.ids) - self.read_index
+
+    def __contains__(self, task_id):
+        index = bisect_left(self.ids, task_id, self.read_index)
+        return index < len(self.ids) and self.ids[index] == task_id
+
+    def writable(self):
+        return self.file is not None and self.size < self.max_size
+
+    def append(self, task_id, data):
+        self.file.write(record_header.pack(task_id, len(data)) + data)
+        self.ids.append(task_id)
+        self.size += record_header.size + len(data)
+
+    def seal(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def read(self, max_bytes):
+        # Копирует из файла записи общим размером около max_bytes (минимум одну).
+        self.seal()
+        records = []
+        with open(self.path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            offset = self.read_offset
+            read = 0
+            while offset < self.size and (not records or read < max_bytes):
+                task_id, length = record_header.unpack_from(view, offset)
+                start = offset + record_header.size
+                records.append((task_id, view[start:start + length]))
+                offset = start + length
+                read += length
+        self.read_offset = offset
+        self.read_index += len(records)
+        return records
+
+    def remove(self):
+        self.seal()
+        os.remove(self.path)
+
+    def __getstate__(self):
+        # Файлы сегментов снимку не принадлежат. В самом объекте остаются только id,
+        # а непрочитанные данные снимок дописывает после себя через copy_to.
+        return {'ids': self.ids[self.read_index:], 'size': self.size - self.read_offset}
+
+    def __setstate__(self, state):
+        self.ids = state['ids']
+        # в снимках прежних версий данные хвоста лежали прямо в объекте
+        self.data = state.get('data')
+        self.size = state['size'] if self.data is None else len(self.data)
+        self.path = self.file = None
+        self.read_offset = self.read_index = 0
+
+    def copy_to(self, target):
+        # Непрочитанные данные копируются в снимок частями, не больше copy_size за раз.
+        with open(self.path, 'rb') as source:
+            source.seek(self.read_offset)
+            copy_bytes(source, target, self.size - self.read_offset)
+
+    def restore(self, path, source):
+        # После загрузки снимка данные сегмента переносятся из него в новый файл.
+        self.path = path
+        with open(path, 'wb') as file:
+            if self.data is not None:
+                file.write(self.data)
+            else:
+                copy_bytes(source, file, self.size)
+        self.data = None
+
+
+def copy_bytes(source, target, size, chunk_size=2**20):
+    while size:
+        chunk = source.read(min(size, chunk_size))
+        if not chunk:
+            raise EOFError('Spilled tail is truncated')
+        target.write(chunk)
+        size -= len(chunk)
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import tempfile
+import threading
+
+from client import Client, AsyncClient, TaskQueueError
+from tests.test_server import ServerTestCase
+
+
+class ClientServerTestCase(ServerTestCase):
+    # Снимок сервера пишется во временный каталог, а не в db.pickle рядом с кодом
+    server_options = []
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server_args = self.server_options + ['-c', os.path.join(self.directory.name, 'db.pickle')]
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.directory.cleanup()
+
+
+class ClientTest(ClientServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = Client(pool_size=2)
+
+    def tearDown(self):
+        self.client.close()
+        super().tearDown()
+
+    def test_base_scenario(self):
+        task_id = self.client.add(b'1', b'hello\nworld')
+        self.assertTrue(self.client.contains(b'1', task_id))
+        self.assertEqual((task_id, b'hello\nworld'), self.client.get(b'1'))
+        self.assertIsNone(self.client.get(b'1'))
+        self.assertTrue(self.client.ack(b'1', task_id))
+        self.assertFalse(self.client.ack(b'1', task_id))
+        self.assertIsNone(self.client.save())
+        self.assertEqual(['db.pickle'], os.listdir(self.directory.name))
+
+    def test_batches(self):
+        items = [b'a', b'b c', b'x' * 600000, b'y' * 600000]
+        task_ids = self.client.add_many(b'1', items)
+        self.assertEqual(4, len(task_ids))
+        self.assertEqual(list(zip(task_ids, items)), self.client.get_many(b'1', 10))
+        self.assertEqual([True, False], self.client.ack_many(b'1', [task_ids[0], b'1']))
+
+    def test_pipeline(self):
+        with self.client.pipeline() as pipe:
+            pipe.add(b'1', b'a', priority=1)
+            pipe.get(b'1')
+            pipe.get(b'1')
+        task_id, task, empty = pipe.results
+        self.assertEqual((task_id, b'a'), task)
+        self.assertIsNone(empty)
+
+    def test_error(self):
+        with self.assertRaises(TaskQueueError):
+            self.client.add(b'1', b'a', size=1)
+        self.assertTrue(self.client.add(b'1', b'a'))
+
+    def test_threads_share_pool(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.extend(self.client.add(b'1', b'a') for _ in range(50)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(400, len(set(results)))
+        self.assertEqual(2, self.client.pools[5555].qsize())
+
+
+class AsyncClientTest(ClientServerTestCase):
+    def test_concurrent_requests(self):
+        async def main():
+            async with AsyncClient(pool_size=2) as client:
+                task_ids = await asyncio.gather(*[client.add(b'1', b'%d' % i) for i in range(200)])
+                tasks = await asyncio.gather(*[client.get(b'1') for _ in range(200)])
+                flags = await asyncio.gather(*[client.ack(b'1', task_id) for task_id, _ in tasks])
+                return task_ids, tasks, flags
+
+        task_ids, tasks, flags = asyncio.run(main())
+        self.assertEqual(sorted(task_ids), sorted(task_id for task_id, _ in tasks))
+        self.assertTrue(all(flags))
+
+    def test_waiting_get_does_not_block_pool(self):
+        async def main():
+            async with AsyncClient(pool_size=1) as client:
+                waiting = asyncio.ensure_future(client.get(b'1', timeout=5))
+                await asyncio.sleep(0.1)
+                self.assertEqual([], await client.get_many(b'1', 1))
+                task_id = await client.add(b'1', b'a')
+                self.assertEqual((task_id, b'a'), await waiting)
+
+        asyncio.run(main())
+
+
+class ShardedClientTest(ClientServerTestCase):
+    server_options = ['-n', '3']
+
+    def test_direct_routing(self):
+        with Client(shards=3) as client, Client() as routed:
+            task_ids = [client.add(b'q%d' % i, b'%d' % i) for i in range(9)]
+            self.assertEqual(3, len(client.pools))
+            for i, task_id in enumerate(task_ids):
+                self.assertEqual((task_id, b'%d' % i), routed.get(b'q%d' % i))
@@ -1,16 +1,30 @@
 from unittest import TestCase
 
+import asyncio
+import os
 import time
 import socket
+import struct
+import zlib
+import tempfile
+import tracemalloc
 
 import subprocess
 
-from server import TaskQueueServer
+from server import TaskQueueServer, TaskQueue, Task
+from server import request_header, response_header, BINARY_ADD, BINARY_GET, BINARY_ACK, BINARY_IN
+from server import STATUS_OK, STATUS_NONE, STATUS_NO, STATUS_ERROR
+from client import Client
 
 
-class ServerBaseTest(TestCase):
+class ServerTestCase(TestCase):
+    server_args = []
+
     def setUp(self):
-        self.server = subprocess.Popen(['python3', 'server.py'])
+        self.start_server()
+
+    def start_server(self):
+        self.server = subprocess.Popen(['python3', 'server.py'] + self.server_args)
         # даем серверу время на запуск
         time.sleep(0.5)
 
@@ -26,6 +40,18 @@ class ServerBaseTest(TestCase):
         s.close()
         return data
 
+    def connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        return s.makefile('rwb')
+
+    def call(self, conn, *commands):
+        conn.write(b''.join(command + b'\n' for command in commands))
+        conn.flush()
+        return [conn.readline().rstrip(b'\n') for _ in commands]
+
+
+class ServerBaseTest(ServerTestCase):
     def test_base_scenario(self):
         task_id = self.send(b'ADD 1 5 12345')
         self.assertEqual(b'YES', self.send(b'IN 1 ' + task_id))
@@ -71,5 +97,689 @@ class ServerBaseTest(TestCase):
         data = data.encode('utf')
         self.assertEqual(b'ERROR', self.send(b'ADD 1 10 ' + data))
 
+
+class BlockingServerTest(ServerTestCase):
+    server_args = ['-b']
+
+    def test_client_gone_before_reply(self):
+        s = socket.create_connection(('127.0.0.1', 5555))
+        # закрытие с RST: ответ сервера упадет с ошибкой
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        s.send(b'ADD 1 5 12345')
+        s.close()
+        time.sleep(0.1)
+        self.assertEqual(b'ERROR', self.send(b'ADDD 1 5 12345'))
+        self.assertTrue(self.send(b'GET 1').endswith(b' 5 12345'))
+
+
+class PersistentConnectionTest(ServerTestCase):
+    def test_many_commands_per_connection(self):
+        conn = self.connect()
+        task_id, = self.call(conn, b'ADD 1 5 12345')
+        self.assertEqual([b'YES', task_id + b' 5 12345', b'YES', b'NO'],
+                         self.call(conn, b'IN 1 ' + task_id, b'GET 1', b'ACK 1 ' + task_id, b'IN 1 ' + task_id))
+        conn.close()
+
+    def test_data_with_spaces(self):
+        conn = self.connect()
+        task_id, = self.call(conn, b'ADD 1 11 hello world')
+        self.assertEqual([task_id + b' 11 hello world'], self.call(conn, b'GET 1'))
+        conn.close()
+
+    def test_concurrent_clients(self):
+        clients = [self.connect() for _ in range(50)]
+        task_ids = [self.call(conn, b'ADD 1 5 12345')[0] for conn in clients]
+        self.assertEqual(50, len(set(task_ids)))
+        # старые клиенты продолжают работать, пока открыты постоянные соединения
+        self.assertEqual(task_ids[0] + b' 5 12345', self.send(b'GET 1'))
+        for conn in clients:
+            conn.close()
+
+
+class BatchCommandsTest(ServerTestCase):
+    def call_batch(self, conn, command):
+        conn.write(command + b'\n')
+        conn.flush()
+        count = int(conn.readline())
+        return [conn.readline().rstrip(b'\n') for _ in range(count)]
+
+    def test_batch_scenario(self):
+        conn = self.connect()
+        task_ids = self.call_batch(conn, b'MADD 1 3 5 12345 3 a b 1 c')
+        self.assertEqual(3, len(task_ids))
+        self.assertEqual([b'YES'], self.call(conn, b'IN 1 ' + task_ids[1]))
+        self.assertEqual([task_ids[0] + b' 5 12345', task_ids[1] + b' 3 a b'], self.call_batch(conn, b'MGET 1 2'))
+        self.assertEqual([b'YES', b'NO', b'NO'],
+                         self.call_batch(conn, b'MACK 1 ' + b' '.join([task_ids[0], task_ids[0], task_ids[2]])))
+        self.assertEqual([task_ids[2] + b' 1 c'], self.call_batch(conn, b'MGET 1 10'))
+        self.assertEqual([], self.call_batch(conn, b'MGET 1 10'))
+        conn.close()
+
+    def test_wrong_batch(self):
+        self.assertEqual(b'ERROR', self.send(b'MADD 1 2 5 12345'))
+        self.assertEqual(b'ERROR', self.send(b'MADD 1 1 5 123456'))
+        self.assertEqual(b'ERROR', self.send(b'MACK 1'))
+
+    def test_batch_throughput(self):
+        count = 300
+        started = time.perf_counter()
+        for _ in range(count):
+            self.send(b'ADD single 5 12345')
+        single_time = time.perf_counter() - started
+
+        conn = self.connect()
+        started = time.perf_counter()
+        task_ids = self.call_batch(conn, b'MADD batch %d ' % count + b' '.join([b'5 12345'] * count))
+        batch_time = time.perf_counter() - started
+        conn.close()
+
+        print(f'\nADD x{count}: single commands {count / single_time:.0f} tasks/s, '
+              f'MADD {count / batch_time:.0f} tasks/s')
+        self.assertEqual(count, len(task_ids))
+        self.assertLess(batch_time, single_time)
+
+
+class BinaryProtocolTest(ServerTestCase):
+    def binary_connect(self):
+        conn = self.connect()
+        self.assertEqual([b'OK'], self.call(conn, b'BINARY'))
+        return conn
+
+    def call_binary(self, conn, op, queue, payload=b'', options=b''):
+        conn.write(request_header.pack(op, len(queue), len(options), len(payload)) + queue + options + payload)
+        conn.flush()
+        status, id_len, data_len = response_header.unpack(conn.read(response_header.size))
+        return status, conn.read(id_len), conn.read(data_len)
+
+    def test_binary_scenario(self):
+        conn = self.binary_connect()
+        data = bytes(range(256)) * 3900
+        status, task_id, _ = self.call_binary(conn, BINARY_ADD, b'1', data, b'timeout=30')
+        self.assertEqual(STATUS_OK, status)
+        self.assertEqual((STATUS_OK, b'', b''), self.call_binary(conn, BINARY_IN, b'1', task_id))
+        self.assertEqual((STATUS_OK, task_id, data), self.call_binary(conn, BINARY_GET, b'1'))
+        self.assertEqual((STATUS_NONE, b'', b''), self.call_binary(conn, BINARY_GET, b'1'))
+        self.assertEqual((STATUS_OK, b'', b''), self.call_binary(conn, BINARY_ACK, b'1', task_id))
+        self.assertEqual((STATUS_NO, b'', b''), self.call_binary(conn, BINARY_ACK, b'1', task_id))
+        conn.close()
+
+    def test_binary_and_text_clients(self):
+        conn = self.binary_connect()
+        status, task_id, _ = self.call_binary(conn, BINARY_ADD, b'1', b'hello world\n')
+        self.assertEqual(task_id + b' 12 hello world\n', self.send(b'GET 1'))
+        self.assertEqual((STATUS_ERROR, b'', b''), self.call_binary(conn, BINARY_ADD, b'1', b'x', b'size=1'))
+        conn.close()
+
+    def test_too_long_payload(self):
+        conn = self.binary_connect()
+        conn.write(request_header.pack(BINARY_ADD, 1, 0, 10**6 + 1) + b'1')
+        conn.flush()
+        self.assertEqual(response_header.pack(STATUS_ERROR, 0, 0), conn.read())
+        conn.close()
+
+
+class LongPollTest(ServerTestCase):
+    def test_get_waits_for_add(self):
+        consumer = self.connect()
+        consumer.write(b'GET 1 timeout=5\nIN 1 0\n')
+        consumer.flush()
+        time.sleep(0.2)
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(task_id + b' 5 12345\n', consumer.readline())
+        self.assertEqual(b'NO\n', consumer.readline())
+        consumer.close()
+
+    def test_get_timeout(self):
+        started = time.time()
+        self.assertEqual(b'NONE', self.send(b'GET 1 timeout=0.3'))
+        self.assertGreaterEqual(time.time() - started, 0.3)
+
+    def test_waiters_are_woken_in_order(self):
+        consumers = [self.connect() for _ in range(3)]
+        for conn in consumers:
+            conn.write(b'GET 1 timeout=5\n')
+            conn.flush()
+            time.sleep(0.1)
+        consumers[1].close()
+        task_ids = [self.send(b'ADD 1 1 %d' % i) for i in range(2)]
+        self.assertEqual(task_ids[0] + b' 1 0\n', consumers[0].readline())
+        self.assertEqual(task_ids[1] + b' 1 1\n', consumers[2].readline())
+        for conn in consumers:
+            conn.close()
+
+    def test_binary_get_waits_for_add(self):
+        consumer = self.connect()
+        self.assertEqual([b'OK'], self.call(consumer, b'BINARY'))
+        consumer.write(request_header.pack(BINARY_GET, 1, 9, 0) + b'1timeout=5')
+        consumer.flush()
+        time.sleep(0.2)
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(response_header.pack(STATUS_OK, len(task_id), 5) + task_id + b'12345',
+                         consumer.read(response_header.size + len(task_id) + 5))
+        consumer.close()
+
+
+class WaiterTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = TaskQueueServer('127.0.0.1', 5555, os.path.join(self.directory.name, 'db.pickle'), 10)
+        self.server.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.server.loop.close()
+        self.directory.cleanup()
+
+    def test_cancelled_waiter_is_skipped(self):
+        cancelled = self.server.get_cmd(b'GET q timeout=5')
+        waiting = self.server.get_cmd(b'GET q timeout=5')
+        # колбэки отмены выполнятся только на следующей итерации цикла
+        cancelled.cancel()
+        task_id = self.server.execute(b'ADD q 1 a')
+        self.assertTrue(task_id.isdigit())
+        self.assertEqual(task_id + b' 1 a', waiting.result())
+        second_task_id = self.server.execute(b'ADD q 1 b')
+        self.assertEqual(second_task_id + b' 1 b', self.server.get_cmd(b'GET q'))
+        self.assertEqual(2, len(self.server.queues[b'q'].in_work))
+
+
+class DurableServerTest(ServerTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server_args = ['-d', '-c', os.path.join(self.directory.name, 'db.pickle')]
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.directory.cleanup()
+
+    def restart(self):
+        self.server.kill()
+        self.server.wait()
+        self.start_server()
+
+    def test_journal_replay(self):
+        first_task_id = self.send(b'ADD 1 5 12345')
+        second_task_id = self.send(b'ADD 1 5 67890')
+        self.assertEqual(first_task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + first_task_id))
+        self.restart()
+        self.assertEqual(b'NO', self.send(b'IN 1 ' + first_task_id))
+        self.assertEqual(second_task_id + b' 5 67890', self.send(b'GET 1'))
+
+    def test_replay_scheduled_tasks(self):
+        delayed_task_id = self.send(b'ADD 1 1 a not_before=%f' % (time.time() + 1.5))
+        urgent_task_id = self.send(b'ADD 1 1 b priority=1')
+        self.restart()
+        self.assertEqual(urgent_task_id + b' 1 b', self.send(b'GET 1'))
+        self.assertEqual(b'NONE', self.send(b'GET 1'))
+        time.sleep(1.5)
+        self.assertEqual(delayed_task_id + b' 1 a', self.send(b'GET 1'))
+
+    def test_replay_after_checkpoint(self):
+        first_task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(b'OK', self.send(b'SAVE'))
+        second_task_id = self.send(b'ADD 1 5 67890')
+        self.restart()
+        self.assertEqual(b'YES', self.send(b'IN 1 ' + first_task_id))
+        self.assertEqual(b'YES', self.send(b'IN 1 ' + second_task_id))
+        self.assertEqual(first_task_id + b' 5 12345', self.send(b'GET 1'))
+
+
+class ShardedServerTest(ServerTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server_args = ['-n', '3', '-c', os.path.join(self.directory.name, 'db.pickle')]
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.directory.cleanup()
+
+    def restart(self):
+        self.server.terminate()
+        self.server.wait()
+        self.start_server()
+
+    def test_queues_on_all_shards(self):
+        conn = self.connect()
+        queues = [b'q%d' % i for i in range(12)]
+        task_ids = self.call(conn, *[b'ADD ' + queue + b' 5 12345' for queue in queues])
+        for queue, task_id in zip(queues, task_ids):
+            self.assertEqual([task_id + b' 5 12345'], self.call(conn, b'GET ' + queue))
+            self.assertEqual([b'YES'], self.call(conn, b'ACK ' + queue + b' ' + task_id))
+        conn.close()
+
+    def test_save_every_shard(self):
+        task_ids = [self.send(b'ADD q%d 5 12345' % i) for i in range(6)]
+        self.assertEqual(b'OK', self.send(b'SAVE'))
+        self.assertEqual(['db.pickle.shard0', 'db.pickle.shard1', 'db.pickle.shard2'],
+                         sorted(os.listdir(self.directory.name)))
+        self.restart()
+        for i, task_id in enumerate(task_ids):
+            self.assertEqual(b'YES', self.send(b'IN q%d ' % i + task_id))
+
+    def test_stats_from_every_shard(self):
+        for i in range(6):
+            self.send(b'ADD q%d 5 12345' % i)
+        count, *lines = self.send(b'STATS').split(b'\n')
+        self.assertEqual(int(count), len(lines))
+        shards = {line.split(b'shard="', 1)[1][:1] for line in lines}
+        self.assertEqual({b'0', b'1', b'2'}, shards)
+        for i in range(6):
+            self.assertIn(b'task_queue_tasks{queue="q%d",state="ready",shard="%d"} 1' % (i, zlib.crc32(b'q%d' % i) % 3),
+                          lines)
+
+    def test_binary_frames_keep_order(self):
+        conn = self.connect()
+        queues = [b'b%d' % i for i in range(12)]
+        self.assertEqual([b'OK'], self.call(conn, b'BINARY'))
+        conn.write(b''.join(request_header.pack(BINARY_ADD, len(queue), 0, len(queue)) + queue + queue
+                            for queue in queues))
+        conn.write(b''.join(request_header.pack(BINARY_GET, len(queue), 0, 0) + queue for queue in queues))
+        conn.flush()
+        replies = []
+        for _ in range(2 * len(queues)):
+            status, id_len, data_len = response_header.unpack(conn.read(response_header.size))
+            replies.append((status, conn.read(id_len), conn.read(data_len)))
+        for queue, (status, task_id, _), reply in zip(queues, replies, replies[len(queues):]):
+            self.assertEqual(STATUS_OK, status)
+            self.assertEqual((STATUS_OK, task_id, queue), reply)
+        conn.close()
+
+    def test_get_waits_on_other_shard(self):
+        consumers = [self.connect() for _ in range(6)]
+        for i, consumer in enumerate(consumers):
+            consumer.write(b'GET w%d timeout=5\n' % i)
+            consumer.flush()
+        time.sleep(0.2)
+        for i, consumer in enumerate(consumers):
+            task_id = self.send(b'ADD w%d 1 %d' % (i, i))
+            self.assertEqual(task_id + b' 1 %d\n' % i, consumer.readline())
+            consumer.close()
+
+
+class TaskQueueTest(TestCase):
+    def setUp(self):
+        self.queue = TaskQueue(b'1')
+        self.tasks = [Task(i, b'%d' % i) for i in range(3)]
+        for task in self.tasks:
+            self.queue.add(task)
+
+    def test_released_tasks_keep_order(self):
+        first, second, third = self.tasks
+        self.assertIs(first, self.queue.get(10))
+        self.assertIs(second, self.queue.get(10))
+        self.queue.release(second.task_id)
+        self.assertIs(first, self.queue.expire(first.task_id, first.deadline))
+        self.assertIs(first, self.queue.get(10))
+        self.assertIs(second, self.queue.get(10))
+        self.assertIs(third, self.queue.get(10))
+        self.assertIsNone(self.queue.get(10))
+
+    def test_ack_only_tasks_in_work(self):
+        first = self.tasks[0]
+        self.assertFalse(self.queue.ack(first.task_id))
+        self.queue.get(10)
+        deadline = first.deadline
+        self.assertTrue(first.task_id in self.queue)
+        self.assertTrue(self.queue.ack(first.task_id))
+        self.assertFalse(first.task_id in self.queue)
+        self.assertIsNone(self.queue.expire(first.task_id, deadline))
+        self.assertEqual(2, len(self.queue))
+
+    def test_priority_before_order(self):
+        first, second, third = self.tasks
+        urgent = Task(3, b'3', priority=5)
+        low = Task(4, b'4', priority=-1)
+        self.queue.add(low)
+        self.queue.add(urgent)
+        self.assertIs(urgent, self.queue.get(10))
+        self.assertIs(first, self.queue.get(10))
+        self.queue.release(urgent.task_id)
+        self.assertIs(urgent, self.queue.get(10))
+        self.assertEqual([second, third, low], [self.queue.get(10) for _ in range(3)])
+
+    def test_delayed_task_waits_for_promotion(self):
+        delayed = Task(3, b'3')
+        self.queue.delay(delayed, time.time() + 100)
+        self.assertEqual([self.tasks[0], self.tasks[1], self.tasks[2], None], [self.queue.get(10) for _ in range(4)])
+        self.assertTrue(delayed.task_id in self.queue)
+        self.assertIs(delayed, self.queue.promote(delayed.task_id))
+        self.assertIsNone(self.queue.promote(delayed.task_id))
+        self.assertIs(delayed, self.queue.get(10))
+
+
+class RedeliveryTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = TaskQueueServer('127.0.0.1', 5555, os.path.join(self.directory.name, 'db.pickle'), 10)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_only_due_tasks_expire(self):
+        first_task_id = self.server.add_cmd(b'ADD 1 1 a')
+        self.server.add_cmd(b'ADD 2 1 b timeout=100')
+        self.server.get_cmd(b'GET 1')
+        self.server.get_cmd(b'GET 2')
+        self.server.check_tasks_timeout(time.time() + 11)
+        self.assertEqual(1, len(self.server.scheduler))
+        self.assertEqual(first_task_id + b' 1 a', self.server.get_cmd(b'GET 1'))
+        self.assertEqual(b'NONE', self.server.get_cmd(b'GET 2'))
+
+    def test_acked_task_is_not_redelivered(self):
+        task_id = self.server.add_cmd(b'ADD 1 1 a')
+        self.server.get_cmd(b'GET 1')
+        self.assertEqual(b'YES', self.server.ack_cmd(b'ACK 1 ' + task_id))
+        self.server.check_tasks_timeout(time.time() + 11)
+        self.assertEqual(b'NONE', self.server.get_cmd(b'GET 1'))
+        self.assertEqual(0, len(self.server.scheduler))
+
+    def test_not_before(self):
+        now = time.time()
+        late_task_id = self.server.add_cmd(b'ADD 1 1 a not_before=%f' % (now + 5))
+        early_task_id = self.server.add_cmd(b'ADD 1 1 b not_before=%f priority=2' % (now + 1))
+        self.server.promote_tasks(now + 0.5)
+        self.assertEqual(b'NONE', self.server.get_cmd(b'GET 1'))
+        self.server.promote_tasks(now + 6)
+        self.assertEqual(0, len(self.server.delays))
+        self.assertEqual(early_task_id + b' 1 b', self.server.get_cmd(b'GET 1'))
+        self.assertEqual(late_task_id + b' 1 a', self.server.get_cmd(b'GET 1'))
+
+    def test_wrong_timeout_option(self):
+        self.assertEqual(b'ERROR', self.server.add_cmd(b'ADD 1 1 a timeout=-1'))
+        self.assertEqual(b'ERROR', self.server.add_cmd(b'ADD 1 1 a size=1'))
+        for timeout in (b'nan', b'inf', b'-inf', b'0'):
+            self.assertEqual(b'ERROR', self.server.add_cmd(b'ADD 1 1 a timeout=' + timeout))
+            self.assertEqual(b'ERROR', self.server.get_cmd(b'GET 1 timeout=' + timeout))
+        self.assertIsNone(self.server.get_queue(b'1').timeout)
+        self.assertEqual(0, len(self.server.get_queue(b'1')))
+
+    def test_out_of_range_options(self):
+        path = os.path.join(self.directory.name, 'durable.pickle')
+        server = TaskQueueServer('127.0.0.1', 5555, path, 10, durable=True)
+        for option in (b'priority=99999999999999999999', b'priority=-99999999999999999999', b'not_before=nan',
+                       b'not_before=inf'):
+            self.assertEqual(b'ERROR', server.add_cmd(b'ADD 1 1 a ' + option))
+        self.assertEqual(b'NONE', server.get_cmd(b'GET 1'))
+        task_id = server.add_cmd(b'ADD 1 1 b priority=%d' % (2**63 - 1))
+        server.journal.close()
+        server = TaskQueueServer('127.0.0.1', 5555, path, 10, durable=True)
+        self.assertEqual(task_id + b' 1 b', server.get_cmd(b'GET 1'))
+        self.assertEqual(b'NONE', server.get_cmd(b'GET 1'))
+        server.journal.close()
+
+    def test_acked_entries_do_not_pile_up(self):
+        for _ in range(20000):
+            task_id = self.server.add_cmd(b'ADD 1 1 a')
+            self.server.get_cmd(b'GET 1')
+            self.server.ack_cmd(b'ACK 1 ' + task_id)
+        self.assertLessEqual(len(self.server.scheduler), 2 * self.server.scheduler.min_stale)
+        task_id = self.server.add_cmd(b'ADD 1 1 b')
+        self.server.get_cmd(b'GET 1')
+        for _ in range(5000):
+            other_task_id = self.server.add_cmd(b'ADD 2 1 a')
+            self.server.get_cmd(b'GET 2')
+            self.server.ack_cmd(b'ACK 2 ' + other_task_id)
+        self.server.check_tasks_timeout(time.time() + 11)
+        self.assertEqual(task_id + b' 1 b', self.server.get_cmd(b'GET 1'))
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = TaskQueueServer('127.0.0.1', 5555, os.path.join(self.directory.name, 'db.pickle'), 10)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def stats(self):
+        count, *lines = self.server.execute(b'STATS').split(b'\n')
+        self.assertEqual(int(count), len(lines))
+        return dict(line.rsplit(b' ', 1) for line in lines)
+
+    def test_queue_stats(self):
+        for data in (b'a', b'b', b'c'):
+            self.server.execute(b'ADD 1 1 ' + data)
+        self.server.execute(b'ADD 1 1 d not_before=%f' % (time.time() + 100))
+        self.server.execute(b'GET 1')
+        self.server.execute(b'GET 1')
+        self.server.check_tasks_timeout(time.time() + 11)
+        self.server.execute(b'GET 1')
+        stats = self.stats()
+        self.assertEqual(b'2', stats[b'task_queue_tasks{queue="1",state="ready"}'])
+        self.assertEqual(b'1', stats[b'task_queue_tasks{queue="1",state="in_work"}'])
+        self.assertEqual(b'1', stats[b'task_queue_tasks{queue="1",state="delayed"}'])
+        self.assertEqual(b'2', stats[b'task_queue_redelivered_total{queue="1"}'])
+        self.assertLess(float(stats[b'task_queue_oldest_task_age_seconds{queue="1"}']), 5)
+
+    def test_oldest_age_counts_from_add(self):
+        # Возраст отсчитывается от добавления задания, а не от запуска сервера
+        time.sleep(0.5)
+        self.server.execute(b'ADD 1 1 a')
+        self.assertLess(float(self.stats()[b'task_queue_oldest_task_age_seconds{queue="1"}']), 0.2)
+        time.sleep(0.3)
+        self.server.execute(b'ADD 1 1 b')
+        self.assertGreaterEqual(float(self.stats()[b'task_queue_oldest_task_age_seconds{queue="1"}']), 0.3)
+
+    def test_command_latency(self):
+        for _ in range(10):
+            self.server.execute(b'ADD 1 1 a')
+        self.server.execute(b'GET 1')
+        stats = self.stats()
+        self.assertEqual(b'10', stats[b'task_queue_command_seconds_count{command="add"}'])
+        self.assertEqual(b'10', stats[b'task_queue_command_seconds_bucket{command="add",le="+Inf"}'])
+        self.assertEqual(b'1', stats[b'task_queue_command_seconds_count{command="get"}'])
+
+
+class MetricsEndpointTest(ServerTestCase):
+    server_args = ['-m', '5599']
+
+    def test_http_metrics(self):
+        self.send(b'ADD 1 5 12345')
+        s = socket.create_connection(('127.0.0.1', 5599))
+        s.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+        response = b''
+        while True:
+            data = s.recv(65536)
+            if not data:
+                break
+            response += data
+        s.close()
+        self.assertTrue(response.startswith(b'HTTP/1.0 200 OK'))
+        self.assertIn(b'task_queue_tasks{queue="1",state="ready"} 1\n', response)
+
+
+class TaskMemoryTest(TestCase):
+    def test_bytes_per_queued_task(self):
+        directory = tempfile.TemporaryDirectory()
+        server = TaskQueueServer('127.0.0.1', 5555, os.path.join(directory.name, 'db.pickle'), 10)
+        count = 100000
+        data = b'x' * 16
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(count):
+            server.add_task(b'1', data)
+        per_task = (tracemalloc.get_traced_memory()[0] - before) / count
+        tracemalloc.stop()
+        directory.cleanup()
+
+        print(f'\n{per_task:.0f} bytes per queued task with {len(data)} bytes of data')
+        self.assertLess(per_task, 300)
+
+
+class SpillTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'db.pickle')
+        # бюджет на три задания по 100 байт, у каждого задания свой сегмент арены
+        self.server = TaskQueueServer('127.0.0.1', 5555, self.path, 10, memory_budget=300 / 2**20)
+        self.server.arena.segment_size = 100
+
+    def tearDown(self):
+        self.server.close()
+        self.directory.cleanup()
+
+    def add(self, data, options=b''):
+        return self.server.add_cmd(b'ADD 1 %d %s %s' % (len(data), data, options)).strip()
+
+    def test_tail_keeps_order(self):
+        items = [b'%04d' % i * 25 for i in range(20)]
+        task_ids = [self.add(data) for data in items]
+        queue = self.server.queues[b'1']
+        self.assertEqual(3, len(queue.ready))
+        self.assertEqual(17, sum(len(segment) for segment in queue.spilled))
+        self.assertEqual(20, len(queue))
+        self.assertEqual(b'YES', self.server.check_task_cmd(b'IN 1 ' + task_ids[-1]))
+        urgent_task_id = self.add(b'u', b'priority=1')
+        self.assertEqual(urgent_task_id + b' 1 u', self.server.get_cmd(b'GET 1'))
+        for task_id, data in zip(task_ids, items):
+            self.assertEqual(b'%s 100 %s' % (task_id, data), self.server.get_cmd(b'GET 1'))
+            self.assertEqual(b'YES', self.server.ack_cmd(b'ACK 1 ' + task_id))
+        self.assertEqual(b'NONE', self.server.get_cmd(b'GET 1'))
+        self.assertEqual([], os.listdir(self.path + '.spill'))
+        # сегмент невыполненного задания u
+        self.assertEqual(100, self.server.budget.used)
+
+    def test_snapshot_streams_tail(self):
+        # 32 МБ хвоста при бюджете 1 МБ: ни SAVE, ни загрузка снимка не держат хвост в памяти
+        server = TaskQueueServer('127.0.0.1', 5555, self.path, 10, memory_budget=1)
+        data = os.urandom(2**16)
+        for _ in range(512):
+            server.add_task(b'1', data)
+        tracemalloc.start()
+        server.save_cmd(b'SAVE')
+        saved_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        server.close()
+        server = TaskQueueServer('127.0.0.1', 5555, self.path, 10, memory_budget=1)
+        loaded_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'\npeak {saved_peak / 2**20:.1f} MB on SAVE, {loaded_peak / 2**20:.1f} MB on load with 32 MB spilled')
+        self.assertLess(saved_peak, 4 * 2**20)
+        self.assertLess(loaded_peak, 4 * 2**20)
+        self.assertEqual(512, len(server.queues[b'1']))
+        for _ in range(512):
+            self.assertTrue(server.get_cmd(b'GET 1').endswith(b' %d %s' % (len(data), data)))
+        server.close()
+
+    def test_budget_pays_for_pinned_segments(self):
+        server = TaskQueueServer('127.0.0.1', 5555, self.path, 10, memory_budget=1)
+        server.arena.segment_size = 2**12
+        per_segment = server.arena.segment_size // 16
+        for _ in range(200 * per_segment):
+            server.add_task(b'1', b'x' * 16)
+        survivors = []
+        for i in range(200 * per_segment):
+            task = server.take_task(b'1')
+            if i % per_segment:
+                server.ack_task(b'1', task.task_id)
+            else:
+                survivors.append(task.task_id)
+        # 200 заданий по 16 байт держат 200 сегментов
+        self.assertEqual(200 * server.arena.segment_size, server.budget.used)
+        # 800 КБ сегментов и задание на 256 КБ уже не помещаются в 1 МБ
+        server.add_task(b'1', b'y' * 2**18)
+        self.assertEqual(1, len(server.queues[b'1'].spilled))
+        for task_id in survivors:
+            server.ack_task(b'1', task_id)
+        self.assertEqual(server.arena.segment_size, server.budget.used)
+        server.close()
+
+    def test_snapshot_keeps_tail(self):
+        task_ids = [self.add(b'%04d' % i * 25) for i in range(10)]
+        self.assertEqual(b'OK', self.server.save_cmd(b'SAVE'))
+        self.server.close()
+        self.server = TaskQueueServer('127.0.0.1', 5555, self.path, 10)
+        self.assertEqual(7, sum(len(segment) for segment in self.server.queues[b'1'].spilled))
+        self.add(b'x')
+        for i, task_id in enumerate(task_ids):
+            self.assertEqual(b'%s 100 %s' % (task_id, b'%04d' % i * 25), self.server.get_cmd(b'GET 1'))
+        self.assertTrue(self.server.get_cmd(b'GET 1').endswith(b' 1 x'))
+
+    def test_checkpoint_keeps_read_segments(self):
+        self.server.close()
+        server = self.server = TaskQueueServer('127.0.0.1', 5555, self.path, 10, durable=True,
+                                               memory_budget=300 / 2**20)
+        server.arena.segment_size = 100
+        task_ids = [self.add(b'%04d' % i * 25) for i in range(10)]
+        # фоновый процесс копирует хвост с задержкой, а сервер тем временем дочитывает сегмент
+        segment = server.queues[b'1'].spilled[0]
+        copy_to = segment.copy_to
+        segment.copy_to = lambda target: (time.sleep(0.5), copy_to(target))
+        self.assertEqual(b'OK', server.save_cmd(b'SAVE'))
+        for task_id in task_ids:
+            self.assertTrue(server.get_cmd(b'GET 1').startswith(task_id + b' '))
+        self.assertEqual(['1.spill'], os.listdir(self.path + '.spill'))
+        while server.checkpoint_pid is not None:
+            time.sleep(0.05)
+            server.reap_checkpoint()
+        self.assertEqual([], os.listdir(self.path + '.spill'))
+        # в снимке очередь на момент SAVE вместе с хвостом
+        snapshot = TaskQueueServer('127.0.0.1', 5555, self.path, 10)
+        self.assertEqual(7, sum(len(segment) for segment in snapshot.queues[b'1'].spilled))
+        for i, task_id in enumerate(task_ids):
+            self.assertEqual(b'%s 100 %s' % (task_id, b'%04d' % i * 25), snapshot.get_cmd(b'GET 1'))
+        snapshot.close()
+
+
+class SpillServerTest(ServerTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server_args = ['-B', '2', '-c', os.path.join(self.directory.name, 'db.pickle')]
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.directory.cleanup()
+
+    def rss(self):
+        with open('/proc/%d/status' % self.server.pid) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+
+    def test_rss_stays_bounded(self):
+        # 64 МБ в очереди при бюджете 2 МБ
+        data = os.urandom(2**16)
+        with Client(pool_size=1) as client:
+            before = self.rss()
+            for _ in range(64):
+                client.add_many(b'1', [data] * 16)
+            grown = self.rss() - before
+            count = 0
+            while True:
+                tasks = client.get_many(b'1', 64)
+                if not tasks:
+                    break
+                self.assertTrue(all(task == data for _, task in tasks))
+                client.ack_many(b'1', [task_id for task_id, _ in tasks])
+                count += len(tasks)
+            drained = self.rss() - before
+        print(f'\nRSS +{grown / 2**20:.1f} MB after 64 MB of tasks, +{drained / 2**20:.1f} MB after draining')
+        self.assertEqual(1024, count)
+        self.assertLess(grown, 16 * 2**20)
+        self.assertLess(drained, 16 * 2**20)
+
+
+class TimerRedeliveryTest(ServerTestCase):
+    def test_redelivery_without_requests(self):
+        task_id = self.send(b'ADD 1 5 12345 timeout=0.3')
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(b'NONE', self.send(b'GET 1'))
+        time.sleep(0.5)
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+
+    def test_delayed_task_wakes_waiter(self):
+        conn = self.connect()
+        conn.write(b'GET 1 timeout=5\n')
+        conn.flush()
+        started = time.time()
+        task_id = self.send(b'ADD 1 5 12345 not_before=%f' % (started + 0.3))
+        self.assertEqual(task_id + b' 5 12345\n', conn.readline())
+        self.assertGreaterEqual(time.time(), started + 0.3)
+        conn.close()
+
+
 if __name__ == '__main__':
     unittest.main()